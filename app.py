@@ -22,7 +22,8 @@ from textwrap import indent
 # Flask
 from flask import (
     Flask, render_template, request, redirect, send_from_directory,
-    Response, url_for, jsonify, session, abort, flash, send_file 
+    Response, url_for, jsonify, session, abort, flash, send_file,
+    stream_with_context
 )
  
 from flask_session import Session
@@ -35,30 +36,74 @@ from sqlalchemy.exc import NoResultFound
 # App-specific modules
 from config import DevelopmentConfig, ProductionConfig
 from utils.llm import (
+    soumettre,
+    moderation_batch,
     moderation_par_llm,
     feedback_final,
-    correction_et_explication,
+    correction_et_explication_cachee,
+    correction_et_explication_stream_cachee,
+    correction_cache,
+    moderation_cache,
+    correction_cache_key,
+    memoriser_correction,
+    invalider_cache_corrections,
+    choisir_route,
+    stats_routes,
+    contexte_usage,
+    ajouter_observateur_usage,
     should_summarize,
-    summarize_history
+    should_presummarize,
+    lancer_resume,
+    resume_pret,
+    oublier_resume,
+    message_resume,
+    strategie_compaction,
+    tronquer_historique
 )
 from utils.session_utils import (
     extract_niveau,
     clean_prompt,
     has_feedback,
-    load_json_from_db,
+    scenario_actif,
+    scenario_cache,
+    conversation_cache,
+    invalider_cache_scenarios,
     load_done_refs,
+    ajouter_done_ref,
     init_session_context,
+    bootstrap_eleve,
     clean_temp_folder,
-    latest_scenarios_without_feedback_matiere
+    historique,
+    history_tokens,
+    history_append,
+    history_pop,
+    history_reset,
+    history_token_total,
+    cconv_append,
+    tour_ouvrir,
+    tour_ecrire,
+    tour_annuler,
+    latest_scenarios_without_feedback_matiere,
+    etats_scenarios
 )
+from utils.answer_utils import verifier_reponse
+from utils.session_backend import CompactSessionInterface
+from utils.telemetry_utils import demarrer_telemetrie, enregistrer_usage, rapport_usage
+from utils.migrations import verifier_schema
+from utils.log_writer import demarrer_journal, journaliser, tampon_journal
+from utils.attempts_writer import demarrer_tentatives, enregistrer_tentative
+from utils.conversation_store import transcription_existe
 from utils.export_utils import (
     build_conversation_pdf,
     build_conversation_txt,
+    rapport_classe_txt,
+    rapport_classe_tex,
     sanitize_tex # a enlever quand j'aurai deplacé les export txt pdf profs
 )
 
 from rgpd import (
-    clean_export_folder, verifier_integrite_worm, init_export_directories, handle_consent,
+    clean_export_folder, verifier_integrite_worm, verifier_integrite_worm_incrementale,
+    init_export_directories, handle_consent, compter_logs_rejetes,
     delete_student, download_latest_worm, download_worm, export_flags_graves,archive_and_purge,
     export_worm, purge_old_logs, prepare_audit, PURGE_DAYS, export_logs_eleve_csv
 )
@@ -83,12 +128,50 @@ else:
     app.config.from_object(DevelopmentConfig)
 
 
-Session(app)
+if app.config.get("SESSION_BACKEND") == "compact":
+    # sessions msgpack compressées, écrites seulement si modifiées (cf. utils/session_backend.py)
+    app.session_interface = CompactSessionInterface.depuis_config(app)
+else:
+    Session(app)
 
 engine = create_engine(app.config["DATABASE_URL"], future=True, pool_pre_ping=True)
 engine_log = create_engine(app.config["DATABASE_URL_LOG"], future=True, pool_pre_ping=True) # 🔒 moteur dédié au logging (app_log)
 engine_rgpd = create_engine(app.config["DATABASE_URL_RGPD"], future=True, pool_pre_ping=True) # 🔐 moteur dédié aux exports RGPD et vérifications WORM (lecture seule, utilisateur rgpd_bot)
 
+# 🧱 schéma : tables / index / fonctions livrés par migrations (python -m utils.migrations), aucun DDL à l'exécution
+verifier_schema(engine)
+
+# 📊 télémétrie des appels LLM (table llm_usage, écriture asynchrone par lots)
+demarrer_telemetrie(engine)
+ajouter_observateur_usage(enregistrer_usage)
+
+# 🔒 journal WORM (chat_logs) : écriture groupée en arrière-plan, hash chaîné par la base
+demarrer_journal(engine_log)
+
+# 📝 tentatives (attempts) : écriture synchrone, visible de toutes les lectures
+demarrer_tentatives(engine)
+
+
+@app.before_request
+def reset_contexte_usage():
+    """
+    Contexte d'usage LLM de la requête (classe, scénario, exercice), repris par la télémétrie.
+    """
+    contexte_usage.set({
+        "class_name": session.get("class_name"),
+        "scenario_id": session.get("active_scenario_id"),
+        "ordinal": session.get("exo_courant"),
+    })
+
+
+@app.teardown_request
+def fermer_tour_conversation(exc):
+    """
+    Un tour de conversation resté ouvert (erreur avant son écriture) est abandonné.
+    Avec une réponse en streaming, appelé une fois le flux terminé.
+    """
+    tour_annuler()
+
 
 
 
@@ -105,17 +188,16 @@ app.jinja_env.globals.update(is_pdflatex_available=is_pdflatex_available)
 # ─────────── helpers DB ──────────────────────────────────────────────
 
 
-def exo_row(conn, ordinal: int):
-    scenario_id = session["active_scenario_id"]
-    row = conn.execute(text("""
-        SELECT exercise_id
-        FROM exercises
-        JOIN exercise_sets es ON es.set_id = exercises.set_id
-        WHERE es.scenario_id = :scid AND ordinal = :o
-    """), {"scid": scenario_id, "o": ordinal}).mappings().first()
-    if not row:
+def exo_row(ordinal: int):
+    """
+    Renvoie {"exercise_id": ...} pour l'exercice `ordinal` du scénario actif
+    (table ordinal → exercise_id du cache des scénarios, sans requête).
+    """
+    scenario = scenario_actif(engine)
+    exercise_id = scenario["exercise_ids"].get(ordinal) if scenario else None
+    if exercise_id is None:
         raise NoResultFound
-    return row
+    return {"exercise_id": exercise_id}
 
 # ─────────── WPA ──────────────────────────────────────────────────
 @app.route('/manifest.json')
@@ -142,23 +224,16 @@ def login():
         consent_given = request.form.get("consent")  # Vérifier si la case de consentement est cochée
         
         if sid:
-            with engine.connect() as cn:
-                # Vérifier si l'identifiant existe dans la base
-                ok = cn.scalar(text(
-                    "SELECT 1 FROM students WHERE student_id=:sid"), {"sid": sid})
+            # Élève, consentement et contexte de session complet : un seul aller-retour
+            eleve = bootstrap_eleve(engine, sid)
             
-            if ok:
+            if eleve:
                 # Si l'identifiant est correct, vérifier si le consentement RGPD est déjà donné
-                with engine.connect() as cn:
-                    consent_date = cn.scalar(text("""
-                        SELECT rgpd_consent_date FROM students WHERE student_id = :sid
-                    """), {"sid": sid})
-                
-                if consent_date:
+                if eleve["rgpd_consent_date"]:
                     # Si le consentement RGPD a déjà été donné, on passe à l'interface IA
                     session.clear()
                     session["student_id"] = sid
-                    init_session_context(engine,sid)
+                    init_session_context(engine, sid, eleve)
                     return redirect(url_for("interface_ia"))
                 else:
                     # Sinon, on garde l'identifiant dans la session et on affiche la modale RGPD
@@ -205,60 +280,31 @@ def interface_ia():
     class_name = student_id.split("-")[0]
     scenario_id=session["active_scenario_id"]
 
-        
-    if "MAP_JSON" not in session:
-        map_json, ans_json, cat_json = load_json_from_db(engine,class_name,scenario_id)
-        session["MAP_JSON"] = map_json
-        session["ANS_JSON"] = ans_json
-        session["CAT_JSON"] = cat_json
-
-    MAP_JSON = session["MAP_JSON"]
-    ANS_JSON = session["ANS_JSON"]
-    CAT_JSON = session["CAT_JSON"]
-
-
-
+    # 1. Récupérer le scénario actif de l'eleve (cache partagé du worker)
+    scenario = scenario_actif(engine)
+    if not scenario or scenario["class_name"] != class_name:
+        return "❌ Aucun scénario actif pour cette classe."
 
-    with engine.connect() as cn:
-        # 1. Récupérer le scénario actif de l'eleve
-        scenario_id = session["active_scenario_id"]
-        row = cn.execute(text("""
-            SELECT name, matiere, content
-            FROM scenarios
-            WHERE class_name = :cls AND id = :scid
-            LIMIT 1
-        """), {"cls": class_name, "scid": scenario_id}).mappings().first()
+    MAP_JSON = scenario["MAP_JSON"]
 
-        if not row:
-            return "❌ Aucun scénario actif pour cette classe."
+    content = scenario["content"]
+    scenario_nom = scenario["name"]
+    scenario_matiere = scenario["matiere"]
 
-        content = row["content"]
-        scenario_nom = row["name"]
-        scenario_matiere = row["matiere"]
+    # 2. Extraire l’intro élève
 
-        # 2. Extraire l’intro élève
+    match = re.search(r"⏱️ DEBUT_PROMPT_ELEVE(.*?)⏹️ FIN_PROMPT_ELEVE", content, flags=re.DOTALL)
+    intro = match.group(1).strip() if match else "👋 Bienvenue !"
 
-        match = re.search(r"⏱️ DEBUT_PROMPT_ELEVE(.*?)⏹️ FIN_PROMPT_ELEVE", content, flags=re.DOTALL)
-        intro = match.group(1).strip() if match else "👋 Bienvenue !"
-
-        # 3. Récupérer l'exercice 1
-        exo = cn.execute(text("""
-            SELECT exercise_id, prompt
-            FROM exercises e
-            JOIN exercise_sets s ON s.set_id = e.set_id
-            WHERE s.is_active = true AND e.ordinal = 1
-            LIMIT 1
-        """)).mappings().first()
-
-        if not exo:
-            return "❌ Aucun exercice trouvé."
+    # 3. Vérifier qu'il y a des exercices
+    if not MAP_JSON:
+        return "❌ Aucun exercice trouvé."
 
     # déterminer le prochain exercice à faire
     next_ref = get_next_exercise_ref(MAP_JSON, session["exo_valide"])
     exo_num = int(next_ref.split("_")[1])
 
-    with engine.connect() as cn:
-        exo = exo_row(cn, exo_num)
+    exo = exo_row(exo_num)
 
     session.update(
         exo_courant = exo_num,
@@ -286,12 +332,11 @@ def interface_ia():
     texte = f"{intro}\n\n{reprise_msg}\n\n{MAP_JSON[next_ref]}".strip()
     html = Markup("<br>".join(texte.splitlines()))
 
-    # Ajouter l'intro et le premier exercice dans cconv s'ils ne sont pas encore là
-    if not session.get("cconv"):
-        session["cconv"] = []
+    # Ajouter l'intro et le premier exercice dans la transcription s'ils ne sont pas encore là
+    if not transcription_existe(engine, session["student_id"], session["active_scenario_id"]):
 
         # Meta : intro + message de reprise
-        session["cconv"].append({
+        cconv_append(engine, {
             "role": "meta",
             "subtype": "intro",
             "content": f"{intro}\n\n{reprise_msg}".strip()
@@ -299,8 +344,7 @@ def interface_ia():
 
         # Nouvelle section d'exercice
         ref = f"exo_{exo_num}"
-        map_json = session.get("MAP_JSON", {})
-        prompt = map_json.get(ref, "").strip()
+        prompt = MAP_JSON.get(ref, "").strip()
 
         # 🔍 Recherche ligne de titre enrichie (avec [niveau x])
         match = re.search(r"EXERCICE\s+\d+[^\n]*?\[niveau\s*\d+\]", prompt, re.IGNORECASE)
@@ -309,7 +353,7 @@ def interface_ia():
         else:
             titre = f"🧩 EXERCICE {exo_num}"
 
-        session["cconv"].append({
+        cconv_append(engine, {
             "role": "exo",
             "content": titre
         })
@@ -341,53 +385,18 @@ def interface_ia():
 def scenario_prompt() -> str:
     student_id = session.get("student_id", "")
     class_name = student_id.split("-")[0]
-    with engine.connect() as cn:
-        scenario_id = session["active_scenario_id"]
-        row = cn.execute(text("""
-            SELECT content
-            FROM scenarios
-            WHERE class_name = :cls AND id = :scid
-            LIMIT 1
-        """), {"cls": class_name, "scid": scenario_id}).mappings().first()
+    scenario = scenario_actif(engine)
 
-    if not row:
+    if not scenario or scenario["class_name"] != class_name:
         return "❌ Aucun scénario actif trouvé pour cette classe."
-    content = row["content"]
-    return content
-
-# ─────────── Sauvegarde des exercices faits ──────────────────────────
-def update_done_refs(student_id: str, exo_ref: str):
-    """
-    Ajoute un exercice validé à la table done_refs pour un élève donné.
-    """
-    class_name = student_id.split("-")[0]
-    with engine.begin() as cn:
-        scenario_id = session["active_scenario_id"]
-
-        row = cn.execute(text("""
-            SELECT refs FROM done_refs
-            WHERE student_id = :sid AND scenario_id = :scid
-            LIMIT 1
-        """), {"sid": student_id, "scid": scenario_id}).mappings().first()
-
-        if row:
-            if exo_ref not in row["refs"]:
-                new_refs = row["refs"] + [exo_ref]
-                cn.execute(text("""
-                    UPDATE done_refs SET refs = :r WHERE student_id = :sid AND scenario_id = :scid
-                """), {"r": json.dumps(new_refs), "sid": student_id, "scid": scenario_id})
-        else:
-            cn.execute(text("""
-                INSERT INTO done_refs(student_id, scenario_id, refs)
-                VALUES (:sid, :scid, :r)
-            """), {"sid": student_id, "scid": scenario_id, "r": json.dumps([exo_ref])})
+    return scenario["content"]
 
 def generate_feedback():
     """
     Génère un feedback final basé sur les exercices de l'élève et les compétences travaillées.
     """
-    # Ajoute un message dans l'historique pour guider l'IA dans la génération du feedback
-    session["history"].append({
+    # Consigne éphémère pour guider l'IA (non conservée dans l'historique)
+    consigne = {
         "role": "system",
         "content": (
             "Tu dois maintenant féliciter l'élève d'avoir terminé tous les exercices, "
@@ -395,10 +404,10 @@ def generate_feedback():
             "Résume en 2-3 phrases les compétences travaillées dans la fiche. "
             "Reste bref, positif, et ne répète pas toutes les réponses."
         )
-    })
+    }
 
     # Appel à l'API pour générer le feedback final
-    feedback = feedback_final(session["history"], user_id=session["student_id"])
+    feedback = feedback_final(historique(engine) + [consigne], user_id=session["student_id"])
 
     # Marquer que l'élève a reçu un feedback
     session["has_feedback"] = True
@@ -418,7 +427,7 @@ def generate_feedback():
         })
 
     # Ajouter le feedback généré à l'historique pour qu'il soit envoyé à l'élève
-    session["history"].append({"role": "assistant", "content": feedback})
+    history_append(engine, {"role": "assistant", "content": feedback})
     
     # Remettre l'exercice courant à -1 pour indiquer que tous les exercices sont terminés
     session["exo_courant"] = -1
@@ -432,54 +441,27 @@ def generate_feedback():
 
 
 
-def save_log(user_id, prompt, completion, flags, model, prev_hash):
+def save_log(user_id, prompt, completion, flags, model):
     """
-    Sauvegarde un échange élève → IA dans chat_logs.
-    Utilise le dernier hash connu pour assurer le chaînage WORM RGPD.
-    Met à jour students.last_this_hash et session["last_this_hash"].
+    Sauvegarde un échange élève → IA dans chat_logs (écriture groupée, cf. utils/log_writer.py).
+    Le chaînage WORM RGPD (prev_hash / this_hash) est calculé par la base à partir du dernier log
+    de l'élève : il ne dépend pas de la session. session["last_this_hash"] (hash initial du
+    consentement) ne sert qu'au premier log de l'élève.
     """
-    # chaînage hash global
-    now = datetime.now(timezone.utc)
-    prev_hash = session.get("last_this_hash") or "0" * 64
-
-    raw = f"{now.isoformat()}{user_id}{prompt}{completion}{json.dumps(flags)}{model}{prev_hash}"
-    this_hash = hashlib.sha256(raw.encode()).hexdigest()
-
-    with engine_log.begin() as cn:
-        cn.execute(text("""
-            INSERT INTO chat_logs(user_id,prompt,completion,flags,model,prev_hash,this_hash)
-            VALUES (:u,:p,:c,(:f)::jsonb,:m,:ph,:th)
-        """), {
-            "u": user_id,
-            "p": prompt,
-            "c": completion,
-            "f": json.dumps(flags),
-            "m": model,
-            "ph": prev_hash or "",
-            "th": this_hash
-        })
-    # Mettre à jour last_this_hash dans students
-    with engine.begin() as cn:
-        cn.execute(text("""
-            UPDATE students
-            SET last_this_hash = :th
-            WHERE student_id = :sid
-        """), {"th": this_hash, "sid": user_id})
-
-    # Mettre à jour aussi la session
-    session["last_this_hash"] = this_hash
-    return this_hash
+    journaliser(user_id, prompt, completion, flags, model,
+                prev_initial=session.get("last_this_hash"))
 
 # ─────────── Moderation des logs  ───────────────────────────────────────
 
 
 
-def moderate_API(conversation: str) -> dict:
+def moderate_API(conversation: str, cacheable: bool = True) -> dict:
     """
     Appelle l'API OpenAI pour modérer la conversation et renvoyer un dict des flags.
+    cacheable=False pour un texte contenant une réponse IA (pas de cache de modération).
     """
     try:
-        return moderation_par_llm(conversation)  # Conversion en dict des catégories
+        return moderation_par_llm(conversation, cacheable=cacheable)  # Conversion en dict des catégories
     except Exception as e:
         app.logger.error(f"Modération échouée pour la conversation : {e}")
         return {"error": True}
@@ -500,14 +482,14 @@ def send_mod_alert_via_email(content: str):
         server.sendmail(msg["From"], [msg["To"]], msg.as_string())
         app.logger.warning(f"Alerte envoyée : Contenu modéré, message : {content[:50]}...")
 
-def moderation(user_msg, reply: str) -> dict:
+MODERATION_ACTIVE = os.getenv("MODERATION_ACTIVE", "0") == "1"  # désactivée par défaut (tests)
+
+
+def verdict_moderation(user_msg, reply: str, flags: dict) -> dict:
     """
-    Appelle l’endpoint OpenAI Moderation, sauvegarde des logs et renvoie un boolean
-    indiquant si la conversation doit être bloquée.
+    Interprète les flags renvoyés par l'API de modération : en cas de flag, sauvegarde
+    le log et renvoie {"blocked": True, ...} ; en cas d'erreur d'API, renvoie les flags d'erreur.
     """
-    return {"blocked": False}  # Contenu autorisé (pas de moderation en test)
-    full_conversation = user_msg+reply
-    flags = moderate_API(full_conversation)
     # Vérification de l'erreur d'API
     if flags.get("error"):
         app.logger.warning(f"Erreur lors de la modération pour l'élève {session.get('student_id')}")
@@ -517,14 +499,12 @@ def moderation(user_msg, reply: str) -> dict:
     blocked = any(flag for key, flag in flags.items() if key != "error" and flag is True)
 
     if blocked:
-        prev_hash = session.get("last_hash", None)
-        session["last_hash"] = save_log(
+        save_log(
             session["student_id"],
             user_msg,
             completion=reply, 
             flags=flags,
-            model="moderation-latest",
-            prev_hash=prev_hash
+            model="moderation-latest"
         )
 
         # Envoi de l'alerte par email
@@ -535,6 +515,71 @@ def moderation(user_msg, reply: str) -> dict:
         return {"blocked": True, "reason": flags} # Bloquer la conversation si un flag est présent
     return {"blocked": False}  # Contenu autorisé
 
+
+def moderation(user_msg, reply: str) -> dict:
+    """
+    Appelle l’endpoint OpenAI Moderation, sauvegarde des logs et renvoie un boolean
+    indiquant si la conversation doit être bloquée.
+    """
+    if not MODERATION_ACTIVE:
+        return {"blocked": False}  # Contenu autorisé (pas de moderation en test)
+    full_conversation = user_msg+reply
+    flags = moderate_API(full_conversation, cacheable=not reply)
+    return verdict_moderation(user_msg, reply, flags)
+
+
+def lancer_moderation_entree(user_msg: str):
+    """
+    Lance la modération du message élève en arrière-plan, en parallèle de la complétion.
+
+    Retourne un Future, ou None si la modération est désactivée.
+    """
+    if not MODERATION_ACTIVE:
+        return None
+    return soumettre(moderation_par_llm, user_msg)
+
+
+def moderation_entree(user_msg: str, future) -> dict:
+    """
+    Attend le résultat de la modération du message élève lancée par `lancer_moderation_entree`.
+    Sans Future, renvoie {"blocked": False} (contrôle différé à `moderation_tour`).
+    """
+    if future is None:
+        return {"blocked": False}
+    try:
+        flags = future.result(timeout=30)
+    except Exception as e:
+        app.logger.error(f"Modération échouée pour le message élève : {e}")
+        flags = {"error": True}
+    return verdict_moderation(user_msg, "", flags)
+
+
+def moderation_tour(user_msg: str, reply: str, future=None) -> dict:
+    """
+    Modération complète d'un tour (message élève, puis message élève + réponse IA).
+
+    - avec Future : l'entrée a été modérée en parallèle de la complétion, seule la sortie reste à vérifier
+    - sans Future : les deux textes partent dans un seul appel `moderations.create(input=[...])`
+
+    Retour : même format que `moderation`, avec "entree": True si c'est le message élève qui est en cause
+    (la réponse IA doit alors être jetée).
+    """
+    if not MODERATION_ACTIVE:
+        return {"blocked": False}
+
+    if future is not None:
+        resultat = moderation_entree(user_msg, future)
+        if resultat.get("error") or resultat.get("blocked"):
+            return {**resultat, "entree": True}
+        flags_sortie = moderate_API(user_msg + reply, cacheable=False)
+    else:
+        flags_entree, flags_sortie = moderation_batch([user_msg, user_msg + reply], cacheable=[True, False])
+        resultat = verdict_moderation(user_msg, "", flags_entree)
+        if resultat.get("error") or resultat.get("blocked"):
+            return {**resultat, "entree": True}
+
+    return verdict_moderation(user_msg, reply, flags_sortie)
+
     
 @app.route('/api/report', methods=['POST'])
 @login_required
@@ -550,68 +595,132 @@ def api_report():
 
 
 # ─────────── API conversation ───────────────────────────────────────
-@app.route("/api/message", methods=["POST"])
-@login_required
-def api_message():
-    user_msg = request.json.get("message", "")
+def contexte_tour(elapsed: int | None, all_refs: list[str], verdict: bool | None = None) -> str:
+    """
+    Construit le bloc de contexte frais du tour : exercice courant, temps écoulé,
+    catégorie, verdict de la vérification locale (si décidable) et exercices restants.
 
+    Ce bloc est recalculé à chaque message et n'est jamais stocké dans l'historique :
+    seules les vraies répliques élève / assistant y sont conservées.
+    elapsed=None : temps écoulé omis (tour dont la correction peut être mise en cache).
+    """
+    CAT_JSON = scenario_actif(engine)["CAT_JSON"]
 
-    
+    # temps écoulé
+    if elapsed is None:
+        lignes = [f"[INFO] exo_courant={session['exo_courant']}"]
+    else:
+        lignes = [f"[INFO] exo_courant={session['exo_courant']}; elapsed_s={elapsed}"]
+
+    # Categorie
+    current_ref = f"exo_{session['exo_courant']}"
+    lignes.append(f"# Catégorie de l'exercice : {CAT_JSON.get(current_ref, 'Sans catégorie')}")
+
+    # Verdict pré-calculé par comparaison avec la réponse attendue (ANS_JSON)
+    if verdict is True:
+        lignes.append(
+            "[VÉRIFICATION AUTOMATIQUE] La réponse de l’élève correspond à la réponse attendue. "
+            "Valide-la sans refaire tout le calcul : confirmation et explication brèves."
+        )
+    elif verdict is False:
+        lignes.append(
+            "[VÉRIFICATION AUTOMATIQUE] La réponse de l’élève ne correspond pas à la réponse attendue. "
+            "Ne la valide pas : signale l’erreur brièvement et donne un indice sans donner la solution."
+        )
+
+    # Liste des exercices non encore faits
+    done_refs = session.get("exo_valide", [])
+    pending_refs = [ref for ref in all_refs if ref not in done_refs]
+
+    if pending_refs:
+        exo_nums = [ref.split("_")[1] for ref in pending_refs]
+        lignes.append(
+            f"⚠️ Attention : l’élève n’a pas encore terminé la fiche. "
+            f"Il reste à faire les exercices : {', '.join(exo_nums)}. "
+            f"Adapte ta réponse pour l’encourager à les compléter, "
+            f"et évite de dire que tout est fini."
+        )
+    else:
+        lignes.append(
+            "✅ L’élève a terminé tous les exercices de la fiche. "
+            "Tu peux lui proposer d'utiliser la fonctionnalité proposant des exercices similaires ou l'encourager à consulter une autre activité."
+        )    # test mode libre
+
+    return "\n".join(lignes)
+
+
+def assembler_messages(contexte: str) -> list[dict]:
+    """
+    Assemble la requête envoyée au LLM : prompt du scénario + répliques de la conversation
+    (table conversation_messages) + un unique bloc de contexte éphémère en fin de liste.
+    """
+    return historique(engine) + [{"role": "system", "content": contexte}]
+
+
+def preparer_tour_message(user_msg: str):
+    """
+    Prépare un tour de conversation élève → IA, commun à /api/message et /api/message/stream.
+
+    - compacte l'historique (fenêtre glissante, ou résumé préparé en arrière-plan) si besoin
+    - traite la navigation « exercice N » (aucun appel GPT)
+    - lance la modération du message élève en parallèle de la complétion
+    - ajoute le message à l'historique et assemble la requête LLM avec le contexte du tour
+
+    Retour :
+    - (reponse_immediate, None) si le tour s'arrête avant l'appel LLM
+    - (None, contexte) sinon, avec contexte = {"elapsed": int, "all_refs": list[str], "messages": list[dict],
+      "cle_cache": tuple | None, "verdict": bool | None, "moderation_entree": Future | None,
+      "route": dict, "usage": dict}
+    """
     scenario_id = session["active_scenario_id"]
-    if "MAP_JSON" not in session:
-        student_id = session["student_id"]
-        class_name = student_id.split("-")[0]
-        map_json, ans_json, cat_json = load_json_from_db(class_name)
-        session["MAP_JSON"] = map_json
-        session["ANS_JSON"] = ans_json
-        session["CAT_JSON"] = cat_json
-
-    MAP_JSON = session["MAP_JSON"]
-    ANS_JSON = session["ANS_JSON"]
-    CAT_JSON = session["CAT_JSON"]
-    # 1ʳᵉ requête
-    if session.get("history") and session.get("history_scenario") != session["active_scenario_id"]:
-        session.pop("history", None)
-
-    if "history" not in session:
-
-        session["history"] = [
-            {"role": "system", "content": scenario_prompt()}
-        ]
-        session["history_scenario"] = session["active_scenario_id"]
-        
-    # 🔁 Résumer si nécessaire
-    if should_summarize(session["history"]):
-        try:
-            summary = summarize_history(session["history"])
-            session["history"] = [
-                {"role": "system", "content": scenario_prompt()},
-                {"role": "assistant", "content": summary}
-            ]
+    scenario = scenario_actif(engine)
+    MAP_JSON = scenario["MAP_JSON"]
+    ANS_JSON = scenario["ANS_JSON"]
+    CAT_JSON = scenario["CAT_JSON"]
+    # 🔁 Compaction de l'historique, selon la stratégie de la classe / du scénario :
+    # - fenêtre glissante : troncature immédiate, sans appel LLM
+    # - résumé : préparé en arrière-plan au seuil bas, substitué au seuil haut (jamais attendu)
+    cle_resume = (session["student_id"], scenario_id)
+    history = historique(engine)
+    total_tokens = history_token_total(engine)
+    if strategie_compaction(session.get("class_name"), scenario_id) == "fenetre":
+        if should_summarize(history, total_tokens=total_tokens):
+            enonce = MAP_JSON.get(f"exo_{session.get('exo_courant')}")
+            history_reset(engine, tronquer_historique(history, enonce, tokens=history_tokens(engine)))
+            app.logger.info("✂️ Historique tronqué (fenêtre glissante).")
+    elif should_summarize(history, total_tokens=total_tokens):
+        pret = resume_pret(cle_resume, history)
+        if pret is not None:
+            summary, n = pret
+            history_reset(engine, [
+                history[0],
+                message_resume(summary),
+                *history[n:]   # tours conservés mot pour mot + échanges postérieurs au lancement
+            ])
+            oublier_resume(cle_resume)
             app.logger.info("✅ Historique résumé pour éviter surcharge.")
-            print(summary)
-        except Exception as e:
-            app.logger.warning(f"❌ Échec résumé conversation : {e}")
+        else:
+            lancer_resume(cle_resume, history)  # pas encore prêt : on continue avec l'historique complet
+    elif should_presummarize(history, total_tokens=total_tokens):
+        if lancer_resume(cle_resume, history):
+            app.logger.info("⏳ Résumé de l'historique lancé en arrière-plan.")
 
-    nav_enonce = ""        # ← défaut pour éviter UnboundLocalError
+    # messages history / cconv du tour écrits ensemble (un INSERT) par tour_ecrire
+    tour_ouvrir()
 
     # ── navigation « exercice N »  ##################################  PATCH
     # accepte : « ex2 », « ex 2 », « exercice 2 », «   EXERCICE  12  », « exo2 », « exo 2 »,
     nav = re.fullmatch(r'\s*ex(?:o|ercice)?\s*(\d+)\s*', user_msg, re.I)
     if nav:
         session["exo_courant"] = int(nav.group(1))
+        session.pop("dernier_exo_corrige", None)  # nouvel affichage de l'énoncé → premier tour
 
         try:
-            with engine.connect() as cn:
-                exo = exo_row(cn, session["exo_courant"])
+            exo = exo_row(session["exo_courant"])
             session.update(exo_id=exo["exercise_id"], start=time.time())
         except NoResultFound:
-            return jsonify({"reply": "⚠️ Cet exercice n'existe pas dans cette fiche. Merci de vérifier le numéro."})
-
+            return "⚠️ Cet exercice n'existe pas dans cette fiche. Merci de vérifier le numéro.", None
 
-        next_ref   = f"exo_{session['exo_courant']}"
-        nav_enonce = "\n\n---\n" + MAP_JSON.get(next_ref,
-                                               "_Énoncé introuvable_")
         #   juste l’énoncé, pas de GPT
         ref   = f"exo_{session['exo_courant']}"
         texte = MAP_JSON.get(ref, "_Énoncé introuvable_")
@@ -620,11 +729,11 @@ def api_message():
         # **MAJ conversastion et  l'historique**
         
         
-        session["history"].append({"role":"user", 
-                                   "content": user_msg})
+        history_append(engine, {"role":"user", 
+                        "content": user_msg})
         
-        session["history"].append({"role":"assistant", 
-                                   "content": f"⏩ On passe à l’exercice {session['exo_courant']} :\n\n{texte}"})
+        history_append(engine, {"role":"assistant", 
+                        "content": f"⏩ On passe à l’exercice {session['exo_courant']} :\n\n{texte}"})
         
         # Nouvelle section d'exercice
         # 🔎 Recherche d’un titre enrichi dans le prompt
@@ -635,198 +744,318 @@ def api_message():
             titre = f"EXERCICE {session['exo_courant']}"
 
         # Marque la section pour le découpage
-        session["cconv"].append({
+        cconv_append(engine, {
             "role": "exo",
             "content": titre
         })
+        tour_ecrire(engine)
 
         
-        return jsonify({"reply": f"⏩  On passe à l’exercice {session['exo_courant']} :\n\n{texte}"})
+        return f"⏩  On passe à l’exercice {session['exo_courant']} :\n\n{texte}", None
 
     # -----------------------------------------------------------------
 
     # enregistrement en discussion si pas de nav
-    session["cconv"].append({
+    cconv_append(engine, {
         "role": "user",
         "content": user_msg.strip()
     })
     
     
-    ## ICI ON MODERE USER_MSG avant requete
-    moderation_result=moderation(user_msg,"")
-    if moderation_result.get("error"):
-        return jsonify({"reply": "🚫 Impossible d’analyser le message (modération indisponible)."})
+    contexte_usage.set({"class_name": session.get("class_name"), "scenario_id": scenario_id,
+                        "ordinal": session["exo_courant"]})
 
-    elif moderation_result.get("blocked"):
-        return jsonify({"reply": "Conversation modérée. Veuillez reformuler."})
+    ## ICI ON MODERE USER_MSG, en parallèle de la requete LLM (résultat attendu en fin de tour)
+    future_moderation = lancer_moderation_entree(user_msg)
     
     
     # temps écoulé
     elapsed = int(time.time() - session.get("start", time.time()))
-    info    = f"[INFO] exo_courant={session['exo_courant']}; elapsed_s={elapsed}"
-     
+    all_refs = sorted(MAP_JSON.keys(), key=lambda x: int(x.split("_")[1]))
 
-    session["history"].append({"role": "user", "content": info})
-    session["history"].append({"role": "user", "content": user_msg})
-    
-    
-    # Categorie
+    # seule la réplique de l'élève est conservée ; le contexte du tour reste éphémère
+    history_append(engine, {"role": "user", "content": user_msg})
+
+    # 🔎 Vérification locale de la réponse (sans LLM) : True / False / None si indécidable
     current_ref = f"exo_{session['exo_courant']}"
-    current_cat = CAT_JSON.get(current_ref, "Sans catégorie")
-    session["history"].append({"role": "system","content": f"# Catégorie de l'exercice : {current_cat}"})
+    verdict = verifier_reponse(user_msg, ANS_JSON.get(current_ref))
 
-    # Ajouter la liste des exercices non encore faits
-    all_refs = sorted(MAP_JSON.keys(), key=lambda x: int(x.split("_")[1]))
-    done_refs = session.get("exo_valide", [])
-    pending_refs = [ref for ref in all_refs if ref not in done_refs]
+    # cache de corrections : uniquement la première réponse sur l'exercice courant ;
+    # la clé porte le contexte propre à l'élève, et le temps écoulé n'est pas transmis sur ces tours
+    premier_tour = session.get("dernier_exo_corrige") != session["exo_courant"]
+    cle = None
+    if premier_tour:
+        restants = tuple(ref for ref in all_refs if ref not in session.get("exo_valide", []))
+        cle = correction_cache_key(scenario_id, session["exo_courant"], user_msg, (verdict, restants))
 
-    if pending_refs:
-        exo_nums = [ref.split("_")[1] for ref in pending_refs]
-        msg = (
-            f"⚠️ Attention : l’élève n’a pas encore terminé la fiche. "
-            f"Il reste à faire les exercices : {', '.join(exo_nums)}. "
-            f"Adapte ta réponse pour l’encourager à les compléter, "
-            f"et évite de dire que tout est fini."
-        )
-        session["history"].append({"role": "system", "content": msg})
-    else:
-        session["history"].append({
-            "role": "system",
-            "content": (
-                "✅ L’élève a terminé tous les exercices de la fiche. "
-                "Tu peux lui proposer d'utiliser la fonctionnalité proposant des exercices similaires ou l'encourager à consulter une autre activité."
-            )
-        })    # test mode libre
+    messages = assembler_messages(contexte_tour(None if premier_tour else elapsed, all_refs, verdict))
 
-    # appel LLM
-    reply = correction_et_explication(session["history"], user_id=session["student_id"])
-    session["history"].append({"role": "assistant", "content": reply})
-    session["cconv"].append({"role": "assistant", "content": reply})
-    
-    ## ICI ON MODERE USER_MSG+REPLY
-    moderation_result=moderation(user_msg,reply)
+    # routage du modèle selon le niveau, la catégorie et la taille de l'historique
+    route = choisir_route(extract_niveau(MAP_JSON.get(current_ref, "")),
+                          CAT_JSON.get(current_ref),
+                          history_token_total(engine))
+
+    return None, {"elapsed": elapsed, "all_refs": all_refs, "messages": messages,
+                  "cle_cache": cle, "verdict": verdict, "moderation_entree": future_moderation,
+                  "route": route, "usage": contexte_usage.get()}
+
+
+def finaliser_tour_message(user_msg: str, reply: str, contexte: dict) -> str:
+    """
+    Travail de fin de tour, une fois la réponse complète de l'IA connue :
+    modération, log WORM chaîné, tentative, done_refs, passage à l'exercice suivant
+    et feedback final éventuel, puis écriture des messages du tour (un seul INSERT).
+
+    Retourne le texte final à afficher à l'élève (réponse + éventuel énoncé suivant).
+    """
+    reply = conclure_tour_message(user_msg, reply, contexte)
+    tour_ecrire(engine)
+    return reply
+
+
+def conclure_tour_message(user_msg: str, reply: str, contexte: dict) -> str:
+    """
+    Corps de `finaliser_tour_message` (les messages history / cconv restent en attente dans le tour).
+    """
+    MAP_JSON = scenario_actif(engine)["MAP_JSON"]
+    elapsed = contexte["elapsed"]
+    all_refs = contexte["all_refs"]
+    session["dernier_exo_corrige"] = session["exo_courant"]
+
+    ## ICI ON MODERE USER_MSG (lancée en parallèle) puis USER_MSG+REPLY
+    moderation_result = moderation_tour(user_msg, reply, contexte.get("moderation_entree"))
+    if moderation_result.get("entree"):
+        history_pop(engine)  # message élève refusé : la réponse IA est jetée
     if moderation_result.get("error"):
-        return jsonify({"reply": "🚫 Impossible d’analyser le message (modération indisponible)."})
+        return "🚫 Impossible d’analyser le message (modération indisponible)."
 
     elif moderation_result.get("blocked"):
-        return jsonify({"reply": "Conversation modérée. Veuillez reformuler."})
+        return "Conversation modérée. Veuillez reformuler."
+
+    memoriser_correction(contexte.get("cle_cache"), reply)  # réponse validée par la modération
+    history_append(engine, {"role": "assistant", "content": reply})
+    cconv_append(engine, {"role": "assistant", "content": reply})
     
     # 3) Et on enregistre la réponse GPT en log meme si non flag
-    prev_hash = session.get("last_hash")
-    session["last_hash"] = save_log(
+    save_log(
         session["student_id"],
         user_msg,
         completion=reply,
         flags={},  # aucun flag levé ici normalement
-        model="gpt-4.1",
-        prev_hash=prev_hash
+        model=contexte["route"]["model"]  # modèle de la route choisie pour ce tour
     )
     
-    # tentative (ne compte pas la simple navigation)
-    if not nav:
+    # tentative (la simple navigation est traitée dans preparer_tour_message)
         
-        # ✅ On considère l'exercice terminé uniquement si la phrase attendue apparaît
-        is_finished = "EXERCICE TERMINE : ✅" in reply.upper()
+    # ✅ On considère l'exercice terminé uniquement si la phrase attendue apparaît
+    is_finished = "EXERCICE TERMINE : ✅" in reply.upper()
+
+    # ✅ On détecte au moins un succès partiel pour is_correct
+    # (le verdict de la vérification locale prime quand il est décidable)
+    is_ok = "✅" in reply and "❌" not in reply
+    if contexte.get("verdict") is not None:
+        is_ok = contexte["verdict"]
+    # ou peut etre plutot si on veut pas compter les aides is_ok = "✅" in reply re "❌" not in reply
+
+    # 🔁 Enregistrement dans attempts, même si partiel (écriture synchrone, cf. utils/attempts_writer.py)
+    enregistrer_tentative(session["student_id"], session["exo_id"], session.get("start", time.time()),
+                          elapsed, user_msg[:500], is_ok)
+        
+    # ✅ Si le message de fin apparaît → on valide l'exercice
+    if is_finished:
+        ref = f"exo_{session['exo_courant']}"
 
-        # ✅ On détecte au moins un succès partiel pour is_correct
-        is_ok = "✅" in reply and "❌" not in reply
-        # ou peut etre plutot si on veut pas compter les aides is_ok = "✅" in reply re "❌" not in reply
+        ####################### enregistrement done ref en bdd ##############################
+        # upsert atomique ; la session reprend l'état de la base (progression des autres onglets comprise)
+        session["exo_valide"] = ajouter_done_ref(engine, session["student_id"], session["active_scenario_id"], ref)
 
-        # 🔁 Enregistrement dans attempts, même si partiel
-        with engine.begin() as cn:
-            cn.execute(text("""
-                INSERT INTO attempts(student_id,exercise_id,started_at,ended_at,
-                                     elapsed_s,given_answer,is_correct)
-                VALUES (:sid,:eid,to_timestamp(:s),now(),:e,:ans,:ok)
-            """), {"sid": session["student_id"], "eid": session["exo_id"],
-                   "s": session.get("start", time.time()), "e": elapsed,
-                   "ans": user_msg[:500], "ok": is_ok})
-            
-        # ✅ Si le message de fin apparaît → on valide l'exercice
-        if is_finished:
-            ref = f"exo_{session['exo_courant']}"
-            if ref not in session.get("exo_valide", []):
-                session.setdefault("exo_valide", []).append(ref)
+        step = 1  # ou 2 si on veut sauter selon le temps
+        
+        # Liste des exos restants
+        done_refs = session.get("exo_valide", [])
+        pending_refs = [ref for ref in all_refs if ref not in done_refs]
+        
 
+        if pending_refs == [] and not session.get("has_feedback"):
+            # 🎉 Tous les exos faits → générer feedback
             
-            ####################### enregistrement done ref en bdd ##############################
-            update_done_refs(session["student_id"], ref)
-
-            step = 1  # ou 2 si on veut sauter selon le temps
             
-            # Liste des exos restants
-            done_refs = session.get("exo_valide", [])
-            pending_refs = [ref for ref in all_refs if ref not in done_refs]
+            feedback=generate_feedback()
+            cconv_append(engine, {
+                "role": "meta",
+                "subtype": "feedback",
+                "content": feedback
+            })
             
-
-            if pending_refs == [] and not session.get("has_feedback"):
-                # 🎉 Tous les exos faits → générer feedback
-                
+            ############# oubli moderation ici a ajouter et a mettre dans logs ###############
+            
+            
+            reply += "\n\n📘 " + feedback
+            return reply
+        else:
+            # 🔁 Avancer vers le prochain exo non fait après le courant, ou revenir au premier non fait
+            prochain = None
+            exo_actuel = session["exo_courant"]
+
+            for ref in pending_refs:
+                n = int(ref.split("_")[1])
+                if n > exo_actuel:
+                    prochain = ref
+                    break
+            badge = "⏩" if prochain else "↩️"
                 
-                feedback=generate_feedback()
-                session["cconv"].append({
-                    "role": "meta",
-                    "subtype": "feedback",
-                    "content": feedback
-                })
                 
-                ############# oubli moderation ici a ajouter et a mettre dans logs ###############
+            # Si aucun exo non fait après l’actuel, on reprend au début
+            if not prochain and pending_refs:
+                prochain = pending_refs[0]
+
+            if prochain:
+                session["exo_courant"] = int(prochain.split("_")[1])
+                session["start"] = time.time()
+                exo = exo_row(session["exo_courant"])
+                session["exo_id"] = exo["exercise_id"]
                 
+                enonce=MAP_JSON[prochain]
                 
-                nav_enonce = ""
-                reply += "\n\n📘 " + feedback
-                return jsonify({"reply": reply })
-            else:
-                # 🔁 Avancer vers le prochain exo non fait après le courant, ou revenir au premier non fait
-                prochain = None
-                exo_actuel = session["exo_courant"]
-
-                for ref in pending_refs:
-                    n = int(ref.split("_")[1])
-                    if n > exo_actuel:
-                        prochain = ref
-                        break
-                badge = "⏩" if prochain else "↩️"
-                    
-                    
-                # Si aucun exo non fait après l’actuel, on reprend au début
-                if not prochain and pending_refs:
-                    prochain = pending_refs[0]
+                # 1. Ajouter le titre "Exercice X"
+                # 🔎 Recherche d’un titre enrichi dans le prompt
+                match = re.search(r"EXERCICE\s+\d+\s*(\w*)?\s*\[niveau\s*\d+\]", enonce, re.IGNORECASE)
+                if match:
+                    titre = "🧩 " +match.group(0).strip()
+                else:
+                    titre = f"EXERCICE {session['exo_courant']}"
+
+                # Marque la section pour le découpage
+                cconv_append(engine, {
+                    "role": "exo",
+                    "content": titre
+                })
+
+
+                 
+
+                reply += f"\n\n{badge} On continue avec l’exercice {session['exo_courant']} :\n\n"
+
+                reply += enonce
+
+    return reply
+
+
+@app.route("/api/message", methods=["POST"])
+@login_required
+def api_message():
+    user_msg = request.json.get("message", "")
+
+    reponse_immediate, contexte = preparer_tour_message(user_msg)
+    if reponse_immediate is not None:
+        return jsonify({"reply": reponse_immediate})
+
+    # appel LLM
+    reply = correction_et_explication_cachee(contexte["messages"], user_id=session["student_id"],
+                                             cle=contexte["cle_cache"], route=contexte["route"])
+
+    # renvoi : réponse GPT + éventuel énoncé suivant
+    return jsonify({"reply": finaliser_tour_message(user_msg, reply, contexte)})
+
+
+def sse_event(data: dict, event: str | None = None) -> str:
+    """
+    Formate un message Server-Sent Events (une ligne `data:` JSON, event optionnel).
+    """
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route("/api/message/stream", methods=["POST"])
+@login_required
+def api_message_stream():
+    """
+    Variante streaming de /api/message (Server-Sent Events).
 
-                if prochain:
-                    session["exo_courant"] = int(prochain.split("_")[1])
-                    session["start"] = time.time()
-                    with engine.connect() as cn:
-                        exo = exo_row(cn, session["exo_courant"])
-                    session["exo_id"] = exo["exercise_id"]
-                    
-                    enonce=MAP_JSON[prochain]
-                    
-                    # 1. Ajouter le titre "Exercice X"
-                    # 🔎 Recherche d’un titre enrichi dans le prompt
-                    match = re.search(r"EXERCICE\s+\d+\s*(\w*)?\s*\[niveau\s*\d+\]", enonce, re.IGNORECASE)
-                    if match:
-                        titre = "🧩 " +match.group(0).strip()
-                    else:
-                        titre = f"EXERCICE {session['exo_courant']}"
+    - événements `data: {"delta": ...}` : fragments de la réponse au fil de la génération,
+      seulement si la modération est désactivée (MODERATION_ACTIVE=0)
+    - événement final `fin` : {"reply": ...} texte complet (réponse + éventuel énoncé suivant),
+      envoyé après le travail de fin de tour (attempts, done_refs, log WORM, exercice suivant)
+    - événement `erreur` : {"error": ...} si la génération échoue ou est interrompue
 
-                    # Marque la section pour le découpage
-                    session["cconv"].append({
-                        "role": "exo",
-                        "content": titre
-                    })
+    Avec MODERATION_ACTIVE=1, la réponse est retenue côté serveur jusqu'à la modération de sortie :
+    aucun fragment n'est envoyé, l'élève ne reçoit que le texte validé (ou le refus) dans `fin`.
+    Le streaming ne fait alors gagner que la connexion ouverte, pas l'affichage progressif.
 
+    Un flux interrompu (erreur OpenAI en cours de génération, client déconnecté) abandonne le tour :
+    le message élève est retiré de l'historique et la réponse partielle n'est pas enregistrée.
 
-                     
+    La réponse HTTP part avant la fin du générateur : la session est donc
+    sauvegardée explicitement une fois le tour terminé.
+    """
+    user_msg = request.json.get("message", "")
 
-                    reply += f"\n\n{badge} On continue avec l’exercice {session['exo_courant']} :\n\n"
+    reponse_immediate, contexte = preparer_tour_message(user_msg)
+    if reponse_immediate is not None:
+        return Response(sse_event({"reply": reponse_immediate}, event="fin"), mimetype="text/event-stream")
+
+    def abandonner_tour():
+        # message élève retiré de l'historique (la transcription le garde) ;
+        # la réponse est déjà partie : session persistée à la main
+        history_pop(engine)
+        tour_ecrire(engine)
+        session.modified = True
+        app.session_interface.save_session(app, session, Response())
+
+    def generer():
+        contexte_usage.set(contexte["usage"])  # le générateur peut s'exécuter hors du contexte de la vue
+        morceaux = []
+        refus = None
+        # modération de sortie active : rien n'est montré avant son verdict (fin de tour)
+        diffuser = not MODERATION_ACTIVE
+        try:
+            for delta in correction_et_explication_stream_cachee(contexte["messages"], user_id=session["student_id"],
+                                                                 cle=contexte["cle_cache"],
+                                                                 route=contexte["route"]):
+                if not morceaux:
+                    # aucun token n'est montré avant le verdict de la modération d'entrée
+                    resultat = moderation_entree(user_msg, contexte["moderation_entree"])
+                    if resultat.get("error") or resultat.get("blocked"):
+                        refus = ("🚫 Impossible d’analyser le message (modération indisponible)."
+                                 if resultat.get("error") else "Conversation modérée. Veuillez reformuler.")
+                        break
+                morceaux.append(delta)
+                if diffuser:
+                    yield sse_event({"delta": delta})
+            complet = bool(morceaux)
+        except GeneratorExit:
+            app.logger.warning("⚠️ Client déconnecté pendant le streaming : tour abandonné.")
+            abandonner_tour()
+            raise
+        except Exception as e:
+            app.logger.error(f"❌ Streaming LLM interrompu : {e}")
+            complet = False
 
-                    reply += enonce
+        if refus is not None:
+            abandonner_tour()
+            yield sse_event({"reply": refus}, event="fin")
+            return
+        if not complet:
+            # réponse partielle : ni historique, ni log WORM, ni tentative
+            abandonner_tour()
+            message = ("Réponse interrompue, merci de renvoyer ton message." if morceaux
+                       else "Impossible de contacter l'assistant.")
+            yield sse_event({"error": message}, event="erreur")
+            return
 
-    # renvoi : réponse GPT + éventuel énoncé demandé
-    return jsonify({"reply": reply + nav_enonce})
+        reply = finaliser_tour_message(user_msg, "".join(morceaux), contexte)
 
+        # la réponse est déjà partie : on persiste la session à la main
+        session.modified = True
+        app.session_interface.save_session(app, session, Response())
 
+        yield sse_event({"reply": reply}, event="fin")
+
+    return Response(
+        stream_with_context(generer()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # ─────────── reset session ─────────────────────────────────────────
 @app.route("/logout")
@@ -1028,6 +1257,8 @@ def activate_scenario():
             WHERE scenario_id = :sid
         """), {"sid": scenario_id})
 
+    invalider_cache_scenarios([scenario_id])
+
     return redirect(url_for("dashboard"))
 
 
@@ -1070,6 +1301,9 @@ def delete_scenario():
         # Étape 5 : Supprimer le scénario lui-même
         cn.execute(text("DELETE FROM scenarios WHERE id = :id"), {"id": scenario_id})
 
+    invalider_cache_corrections([scenario_id])
+    invalider_cache_scenarios([scenario_id])
+
     return redirect(url_for("dashboard"))
 
 
@@ -1206,10 +1440,11 @@ def upload_scenario():
         })
 
         # ✅ Désactiver les anciens scénarios de cette classe
-        cn.execute(text("""
+        anciens_ids = cn.execute(text("""
             UPDATE scenarios SET is_active = false
             WHERE class_name = :cls AND id != :id
-        """), {"cls": class_name, "id": scenario_id})
+            RETURNING id
+        """), {"cls": class_name, "id": scenario_id}).scalars().all()
         
         # 🔥 DÉSACTIVER tous les exercise_sets de la classe (sauf celui du nouveau scénario)
         cn.execute(text("""
@@ -1258,6 +1493,10 @@ def upload_scenario():
 
         # ✅ Mettre à jour profs.scenarios si besoin (on pourrait stocker les IDs dans un tableau plus tard si besoin)
 
+    # ♻️ Ré-import : les corrections mémorisées pour les fiches de la classe ne sont plus fiables
+    invalider_cache_corrections(anciens_ids + [scenario_id])
+    invalider_cache_scenarios(anciens_ids + [scenario_id])
+
     flash(f"✅ Scénario '{nom_fiche}' importé avec succès !", "success")
     return redirect(url_for("dashboard"))
 
@@ -1324,6 +1563,30 @@ def export_csv():
         
 
 
+@app.route("/dashboard/cache_stats")
+@login_required_admin
+def cache_stats():
+    """
+    Renvoie en JSON les compteurs des caches mémoire du worker (hits, misses, taille…)
+    et les métriques de taille des sessions.
+    """
+    stats = [correction_cache.stats(), moderation_cache.stats(), scenario_cache.stats(), conversation_cache.stats(),
+             tampon_journal.stats()]
+    if isinstance(app.session_interface, CompactSessionInterface):
+        stats.append(app.session_interface.stats())
+    return jsonify(stats)
+
+
+@app.route("/dashboard/llm_routes")
+@login_required_admin
+def llm_routes():
+    """
+    Renvoie en JSON les métriques du routage des corrections (latence et tokens moyens par route)
+    pour ajuster la table ROUTAGE_CORRECTION.
+    """
+    return jsonify(stats_routes())
+
+
 ##########################  RGPD   ############################
 @app.route("/dashboard/rgpd")
 @login_required_admin
@@ -1334,6 +1597,8 @@ def dashboard_rgpd():
     Fonctionnalités :
     - Vérifie que l'utilisateur est authentifié en tant qu'administrateur.
     - Nettoie automatiquement le dossier /export/ en supprimant les fichiers WORM (.zip) vieux de plus de 90 jours.
+    - Vérifie le chaînage WORM des seuls logs ajoutés depuis la dernière vérification
+      (vérification complète : bouton dédié ou `flask verifier-worm`).
     - Récupère et affiche :
         - Liste des élèves inscrits et consentements RGPD
         - Historique des exports WORM récents
@@ -1342,6 +1607,7 @@ def dashboard_rgpd():
     - Détecte automatiquement :
         - Si une purge récente a eu lieu (moins de PURGE_DAYS)
         - Si des incidents critiques récents sont présents (ex: self-harm)
+        - Si des logs ont été refusés par chat_logs (mis à l'écart, hors chaîne WORM)
     - Affiche les alertes RGPD correspondantes (purge / flags graves) dans le dashboard.
 
     Sécurité :
@@ -1353,9 +1619,14 @@ def dashboard_rgpd():
     init_export_directories()
     clean_export_folder()  # 🔥 Nettoyage automatique au chargement
     
-    # verification de la non rupture d'intégrité du chainage 
-    if not verifier_integrite_worm(engine_rgpd):
+    # verification de la non rupture d'intégrité du chainage (logs ajoutés depuis la dernière vérification)
+    if not verifier_integrite_worm_incrementale(engine_rgpd, engine):
         flash("⚠️ Nouveau Problème détecté dans l'intégrité WORM.", "error")
+    # logs refusés par chat_logs : absents de la chaîne, la vérification ci-dessus ne peut pas les voir
+    nb_rejetes = compter_logs_rejetes(engine_log)
+    if nb_rejetes:
+        flash(f"🚨 {nb_rejetes} log(s) refusé(s) par chat_logs, mis à l'écart dans chat_logs_rejets "
+              f"(absents de la chaîne WORM).", "error")
     selected_class = request.args.get("classe")
 
     with engine.connect() as cn:
@@ -1383,7 +1654,7 @@ def dashboard_rgpd():
         """)).mappings().all()
 
         purge_history = cn.execute(text("""
-            SELECT purge_date, nb_logs_deleted, nb_attempts_anonymized
+            SELECT purge_date, nb_logs_deleted, nb_attempts_anonymized, nb_messages_deleted
             FROM logs_purges
             ORDER BY purge_date DESC
             LIMIT 10
@@ -1474,6 +1745,33 @@ def get_last_flag_export_time():
 
 
 
+@app.route("/dashboard/rgpd/verifier_worm", methods=["POST"])
+@login_required_admin
+def verifier_worm_route():
+    """
+    Vérification complète du chaînage WORM (tout chat_logs), à la demande de l'administrateur.
+
+    - Génère un rapport scellé si de nouvelles anomalies sont détectées.
+    - Réinitialise les points de reprise de la vérification incrémentale du tableau de bord.
+    """
+    if verifier_integrite_worm(engine_rgpd, engine_checkpoints=engine):
+        flash("✅ Vérification complète WORM : aucun nouveau problème d'intégrité.", "success")
+    else:
+        flash("⚠️ Nouveau Problème détecté dans l'intégrité WORM.", "error")
+    return redirect(url_for('dashboard_rgpd'))
+
+
+@app.cli.command("verifier-worm")
+def verifier_worm_commande():
+    """
+    Vérification complète du chaînage WORM, pour une tâche planifiée (cron) : `flask --app app verifier-worm`.
+    """
+    ok = verifier_integrite_worm(engine_rgpd, engine_checkpoints=engine)
+    print("✅ Intégrité WORM vérifiée." if ok else "⚠️ Nouveau Problème détecté dans l'intégrité WORM.")
+
+
+
+
 @app.route("/dashboard/export_flags_graves", methods=["POST"])
 @login_required_admin
 def export_flags_graves_route():
@@ -1705,6 +2003,7 @@ def dashboard_eleve():
         hist = []
         feedback = None
         stats = []
+        usage_llm = []
 
         if selected_class:
             # Charger tous les scénarios de la classe
@@ -1783,6 +2082,11 @@ def dashboard_eleve():
                     ORDER BY exercises.ordinal
                 """), {"cls": selected_class, "scenario_id": selected_scenario}).mappings().all()
 
+    # 📊 usage LLM (tokens, latence, cache) : par classe (vue globale), par scénario pour la classe,
+    # par exercice pour un scénario
+    if not student_id:
+        usage_llm = rapport_usage(engine, selected_class, selected_scenario)
+
     return render_template("dashboard_eleve.html",
                            all_classes=all_classes,
                            selected_class=selected_class,
@@ -1793,7 +2097,8 @@ def dashboard_eleve():
                            evolution=evolution,
                            hist=hist,
                            feedback=feedback,
-                           stats=stats)
+                           stats=stats,
+                           usage_llm=usage_llm)
 
 
 
@@ -1848,58 +2153,11 @@ def export_rapport_txt_internal(classe, scenario):
     if not classe or not scenario:
         return "❌ Classe ou scénario manquant", 400
 
-    with engine.connect() as cn:
-        # Récupérer les élèves
-        students = cn.execute(text("""
-            SELECT student_id FROM students
-            WHERE class = :cls
-            ORDER BY student_id
-        """), {"cls": classe}).scalars().all()
-
-        # Récupérer le nom du scénario
-        scenario_name = cn.execute(text("""
-            SELECT name FROM scenarios
-            WHERE id = :scid
-        """), {"scid": scenario}).scalar()
-
-        rapport = ""
-
-        for sid in students:
-            rapport += f"Rapport élève : {sid}\n"
-            rapport += f"Scénario : {scenario_name}\n\n"
-
-            # Résultats par exercice
-            exos = cn.execute(text("""
-                SELECT e.ordinal, a.is_correct, a.given_answer
-                FROM attempts a
-                JOIN exercises e ON e.exercise_id = a.exercise_id
-                JOIN exercise_sets s ON s.set_id = e.set_id
-                WHERE a.student_id = :sid
-                AND s.scenario_id = :scid
-                ORDER BY e.ordinal
-            """), {"sid": sid, "scid": scenario}).mappings().all()
-
-            for exo in exos:
-                status = "✅ Réussi" if exo["is_correct"] else "❌ Échec"
-                answer = exo["given_answer"] or "(aucune réponse)"
-                rapport += f"Exercice {exo['ordinal']} : {status} - Dernière réponse : \"{answer}\"\n"
-
-            # Feedback éventuel
-            fb = cn.execute(text("""
-                SELECT feedback FROM feedbacks
-                WHERE student_id = :sid
-                AND scenario_id = :scid
-            """), {"sid": sid, "scid": scenario}).scalar()
-
-            if fb:
-                rapport += "\n📘 Feedback IA :\n" + fb.strip() + "\n"
-
-            rapport += "\n" + "-"*50 + "\n\n"
-
     filename = f"rapport_{classe}_scenario{scenario}.txt"
 
+    # Rapport produit élève par élève pendant l'envoi (deux requêtes, mémoire constante)
     return Response(
-        rapport,
+        stream_with_context(rapport_classe_txt(engine, classe, scenario)),
         mimetype="text/plain",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
@@ -1916,71 +2174,8 @@ def export_rapport_tex_internal(classe, scenario):
     if not classe or not scenario:
         return "Paramètres manquants", 400
 
-    with engine.connect() as cn:
-        # Récupérer tous les élèves de la classe
-        students = [r[0] for r in cn.execute(text("""
-            SELECT student_id FROM students
-            WHERE class = :cls
-            ORDER BY student_id
-        """), {"cls": classe})]
-
-        # Récupérer le nom du scénario
-        scenario_name = cn.execute(text("""
-            SELECT name FROM scenarios
-            WHERE id = :scid
-        """), {"scid": scenario}).scalar()
-
-    rapport = r"""
-\documentclass{article}
-\usepackage[utf8]{inputenc}
-\usepackage{amssymb}
-\usepackage{pifont}
-\usepackage{geometry}
-\geometry{a4paper, margin=1in}
-\begin{document}
-
-\title{Résultats globaux \\ \textbf{Scénario : """ + scenario_name + r"""}}
-\date{}
-\maketitle
-"""
-
-    for sid in students:
-        rapport += r"\section*{" + sid + "}\n\n"
-
-        with engine.connect() as cn:
-            exos = cn.execute(text("""
-                SELECT e.ordinal, a.is_correct, a.given_answer
-                FROM attempts a
-                JOIN exercises e ON e.exercise_id = a.exercise_id
-                JOIN exercise_sets s ON s.set_id = e.set_id
-                WHERE a.student_id = :sid
-                  AND s.scenario_id = :scid
-                ORDER BY e.ordinal
-            """), {"sid": sid, "scid": scenario}).mappings().all()
-
-            for exo in exos:
-                status = r"\ding{51} Réussi" if exo["is_correct"] else r"\ding{55} Échec"
-                answer = sanitize_tex(exo["given_answer"]) or "(aucune réponse)"
-                rapport += f"Exercice {exo['ordinal']} : {status} -- Réponse : \"{answer}\"\n\n"
-
-            fb = cn.execute(text("""
-                SELECT feedback FROM feedbacks
-                WHERE student_id = :sid
-                AND scenario_id = :scid
-            """), {"sid": sid, "scid": scenario}).scalar()
-
-            if fb:
-                clean_feedback = sanitize_tex(fb.strip())
-                rapport += r"\ding{41} \textbf{Feedback IA :}" + "\n\n" + clean_feedback + "\n\n"
-                # ou variante bulle      rapport += r"\ding{102} \textbf{Feedback IA :}" + "\n\n" + fb.strip() + "\n\n"
-                
-
-        rapport += r"\bigskip\hrule\bigskip" + "\n\n"
-
-    rapport += r"\end{document}"
-
     filename = f"rapport_{classe}_scenario{scenario}.tex"
-    return Response(rapport, headers={
+    return Response(stream_with_context(rapport_classe_tex(engine, classe, scenario)), headers={
         "Content-Disposition": f"attachment; filename={filename}",
         "Content-Type": "application/x-tex"
     })
@@ -1989,76 +2184,16 @@ def export_rapport_tex_internal(classe, scenario):
 
 def export_rapport_pdf_internal(classe: str, scenario: str):
     """
-    Génère un rapport PDF compilé à partir du LaTeX en mémoire,
+    Génère un rapport PDF compilé à partir du LaTeX écrit au fil de l'eau dans un fichier temporaire,
     pour la classe et le scénario spécifiés.
     """
-    # Récupérer les élèves et le scénario
-    with engine.connect() as cn:
-        students = [r[0] for r in cn.execute(text("""
-            SELECT student_id FROM students
-            WHERE class = :cls
-            ORDER BY student_id
-        """), {"cls": classe})]
-
-        scenario_name = cn.execute(text("""
-            SELECT name FROM scenarios
-            WHERE id = :scid
-        """), {"scid": scenario}).scalar()
-
-    # Construire le contenu LaTeX
-    tex_content = r"""
-\documentclass{article}
-\usepackage[utf8]{inputenc}
-\usepackage{amssymb}
-\usepackage{pifont}
-\usepackage{geometry}
-\geometry{a4paper, margin=1in}
-\begin{document}
-
-\title{Résultats globaux \\ \textbf{Scénario : """ + scenario_name + r"""}}
-\date{}
-\maketitle
-"""
-
-    for sid in students:
-        tex_content += r"\section*{" + sid + "}\n\n"
-
-        with engine.connect() as cn:
-            exos = cn.execute(text("""
-                SELECT e.ordinal, a.is_correct, a.given_answer
-                FROM attempts a
-                JOIN exercises e ON e.exercise_id = a.exercise_id
-                JOIN exercise_sets s ON s.set_id = e.set_id
-                WHERE a.student_id = :sid
-                  AND s.scenario_id = :scid
-                ORDER BY e.ordinal
-            """), {"sid": sid, "scid": scenario}).mappings().all()
-
-            for exo in exos:
-                status = r"\ding{51} Réussi" if exo["is_correct"] else r"\ding{55} Échec"
-                answer = sanitize_tex(exo["given_answer"]) or "(aucune réponse)"
-                tex_content += f"Exercice {exo['ordinal']} : {status} -- Réponse : \"{answer}\"\n\n"
-
-            fb = cn.execute(text("""
-                SELECT feedback FROM feedbacks
-                WHERE student_id = :sid
-                AND scenario_id = :scid
-            """), {"sid": sid, "scid": scenario}).scalar()
-
-            if fb:
-                tex_content += r"\ding{41} \textbf{Feedback IA :}" + "\n\n" + sanitize_tex(fb.strip()) + "\n\n"
-
-        tex_content += r"\bigskip\hrule\bigskip" + "\n\n"
-
-    tex_content += r"\end{document}"
-
     # Compiler en PDF
     tmpdirname = tempfile.mkdtemp()  # Pas de "with", on nettoiera après
 
     try:
         tex_path = os.path.join(tmpdirname, "rapport.tex")
         with open(tex_path, "w", encoding="utf-8") as f:
-            f.write(tex_content)
+            f.writelines(rapport_classe_tex(engine, classe, scenario))
 
         # Lance pdflatex
         subprocess.run(["pdflatex", "-interaction=nonstopmode", "rapport.tex"], cwd=tmpdirname, check=True)
@@ -2114,7 +2249,7 @@ def latest_scenarios_without_feedback(engine, class_name, student_id, limit=3):
 @login_required
 def telecharger_conversation():
     """
-    Génère un export de la conversation pédagogique actuelle (session['cconv']).
+    Génère un export de la conversation pédagogique du scénario actif (table conversation_messages).
 
     - Tente en priorité de générer un PDF via LaTeX (build_conversation_pdf)
     - Si la génération échoue (erreur ou compilation), bascule vers un export texte brut (build_conversation_txt)
@@ -2186,26 +2321,20 @@ def mon_dashboard():
         session["active_matiere"] = active_matiere
         
         
-        # 🔥 Charger TOUS les scénarios possibles pour la classe dans la matiere active
-        results = conn.execute(text("""
-            SELECT id, name, matiere, resume
-            FROM scenarios
-            WHERE class_name = :cls
-              AND (:mat='' OR matiere = :mat)
-            ORDER BY created_at DESC
-        """), {"cls": class_name, "mat": active_matiere or ''}).mappings().all()
+        # 🔥 Charger TOUS les scénarios possibles pour la classe dans la matiere active,
+        # avec l'état du feedback de l'élève (une seule requête)
+        results = etats_scenarios(engine, class_name, student_id, active_matiere)
 
         if results:
             latest_id = max([r["id"] for r in results], key=int)
             
             for r in results:
                 fid = r["id"]
-                feedback_exists = has_feedback(engine, student_id, scenario_id=fid)
                 is_latest = (fid == latest_id)
                 scenarios_disponibles.append({
                     "id": fid,
                     "nom": r["name"],
-                    "done": bool(feedback_exists),
+                    "done": r["has_feedback"],
                     "is_latest": is_latest,
                     "matiere": r["matiere"],  # ← ajoute cette ligne
                     "resume": r.get("resume", "")
@@ -2304,25 +2433,16 @@ def changer_scenario():
     session["active_matiere"] = matiere
     session["active_scenario_id"] = scid
 
-    # Recharger MAP_JSON, ANS_JSON, CAT_JSON
-    map_json, ans_json, cat_json = load_json_from_db(engine, class_name, nouveau_scenario)
-
     # Recharger exos déjà faits et feedback pour ce scénario
     done_refs = load_done_refs(engine, student_id, scenario_id=nouveau_scenario)
     feedback_exists = has_feedback(engine, student_id, scenario_id=nouveau_scenario)
 
-    # 🔑  RAZ du fil de discussion et des compteurs
-    session.pop("history",     None)
+    # 🔑  RAZ des compteurs (le fil de discussion est conservé par scénario en base)
     session.pop("exo_courant", None)
     session.pop("exo_id",      None)
     session.pop("start",       None)
     
-    session["cconv"] = []
-    
-    # Mettre à jour la session
-    session["MAP_JSON"] = map_json
-    session["ANS_JSON"] = ans_json
-    session["CAT_JSON"] = cat_json
+    # Mettre à jour la session (énoncés, réponses et catégories : cache des scénarios)
     session["exo_valide"] = done_refs
     session["has_feedback"] = feedback_exists
 
@@ -2381,25 +2501,16 @@ def changer_scenario_ia():
     session["active_matiere"] = matiere
     session["active_scenario_id"] = scid
 
-    # Recharger MAP_JSON, ANS_JSON, CAT_JSON
-    map_json, ans_json, cat_json = load_json_from_db(engine, class_name, nouveau_scenario)
-
     # Recharger exos déjà faits et feedback pour ce scénario
     done_refs = load_done_refs(engine, student_id, scenario_id=nouveau_scenario)
     feedback_exists = has_feedback(engine, student_id, scenario_id=nouveau_scenario)
 
-    # 🔑  RAZ du fil de discussion et des compteurs
-    session.pop("history",     None)
+    # 🔑  RAZ des compteurs (le fil de discussion est conservé par scénario en base)
     session.pop("exo_courant", None)
     session.pop("exo_id",      None)
     session.pop("start",       None)
     
-    session["cconv"] = []
-    
-    # Mettre à jour la session
-    session["MAP_JSON"] = map_json
-    session["ANS_JSON"] = ans_json
-    session["CAT_JSON"] = cat_json
+    # Mettre à jour la session (énoncés, réponses et catégories : cache des scénarios)
     session["exo_valide"] = done_refs
     session["has_feedback"] = feedback_exists
 
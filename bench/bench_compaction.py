@@ -0,0 +1,117 @@
+"""
+📏 Benchmark des stratégies de compaction de l'historique - bench_compaction.py
+
+Rejoue une conversation synthétique (prompt de scénario + N tours élève / IA) et compare, tour par tour :
+- "fenetre"          : troncature par fenêtre glissante (aucun appel LLM)
+- "resume-glissant"  : résumé incrémental, derniers tours gardés mot pour mot
+- "resume-complet"   : résumé de tout l'historique (ancien comportement)
+
+Mesures par tour (moyennes sur la conversation) :
+- tokens envoyés pour la correction (historique après compaction)
+- tokens envoyés pour les résumés (0 pour la fenêtre glissante)
+- temps de compaction sur le chemin de la requête (ms)
+- latence LLM des résumés (ms) : mesurée avec --live, sinon estimée (--latence-resume-ms)
+
+Utilisation :
+    python bench/bench_compaction.py --tours 60
+    python bench/bench_compaction.py --tours 60 --live     # vrais appels de résumé (OPENAI_API_KEY requis)
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LIVE = "--live" in sys.argv
+if not LIVE:
+    os.environ.setdefault("OPENAI_API_KEY", "bench-hors-ligne")  # aucun appel réseau hors --live
+
+from utils import llm  # noqa: E402
+
+
+PHRASE = "On factorise l'expression puis on vérifie la solution en la remplaçant dans l'équation. "
+
+
+def texte(n_phrases: int) -> str:
+    return PHRASE * n_phrases
+
+
+def conversation(tours: int, phrases_eleve: int, phrases_ia: int):
+    """
+    Génère les tours (message élève, réponse IA) de la conversation synthétique.
+    """
+    for i in range(tours):
+        yield ({"role": "user", "content": f"Tour {i} : " + texte(phrases_eleve)},
+               {"role": "assistant", "content": f"Réponse {i} : " + texte(phrases_ia)})
+
+
+def resumer(prompt: list[dict], latence_estimee_ms: float):
+    """
+    Exécute (--live) ou simule un appel de résumé. Retourne (résumé, latence en ms).
+    """
+    if LIVE:
+        debut = time.perf_counter()
+        resume = llm.call_llm(prompt, model=llm.MODEL_RESUME, temperature=llm.TEMPERATURE_RESUME,
+                              type_appel="resume")
+        return resume.strip(), (time.perf_counter() - debut) * 1000
+    return texte(5), latence_estimee_ms
+
+
+def rejouer(strategie: str, args) -> dict:
+    """
+    Rejoue la conversation avec une stratégie et cumule les mesures.
+    """
+    history = [{"role": "system", "content": texte(args.phrases_scenario)}]
+    enonce = "🧩 EXERCICE 1 [niveau 2]\n\n" + texte(3)
+    mesures = {"tokens_correction": 0, "tokens_resume": 0, "compaction_ms": 0.0, "resume_ms": 0.0, "resumes": 0}
+
+    for user, assistant in conversation(args.tours, args.phrases_eleve, args.phrases_ia):
+        total = llm.estimate_tokens(history)
+        debut = time.perf_counter()
+        if llm.should_summarize(history, total_tokens=total):
+            if strategie == "fenetre":
+                history = llm.tronquer_historique(history, enonce)
+            else:
+                mode = "glissant" if strategie == "resume-glissant" else "complet"
+                prepare = llm.preparer_resume(history, mode)
+                if prepare is not None:
+                    prompt, coupe = prepare
+                    resume, latence = resumer(prompt, args.latence_resume_ms)
+                    mesures["tokens_resume"] += llm.estimate_tokens(prompt)
+                    mesures["resume_ms"] += latence
+                    mesures["resumes"] += 1
+                    history = [history[0], llm.message_resume(resume), *history[coupe:]]
+        mesures["compaction_ms"] += (time.perf_counter() - debut) * 1000
+
+        history.append(user)
+        mesures["tokens_correction"] += llm.estimate_tokens(history)
+        history.append(assistant)
+
+    return {k: (v / args.tours if k != "resumes" else v) for k, v in mesures.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare les stratégies de compaction de l'historique.")
+    parser.add_argument("--tours", type=int, default=60)
+    parser.add_argument("--phrases-scenario", type=int, default=40)
+    parser.add_argument("--phrases-eleve", type=int, default=2)
+    parser.add_argument("--phrases-ia", type=int, default=8)
+    parser.add_argument("--latence-resume-ms", type=float, default=1500.0,
+                        help="latence estimée d'un appel de résumé (hors --live)")
+    parser.add_argument("--live", action="store_true", help="effectue les vrais appels de résumé")
+    args = parser.parse_args()
+
+    print(f"{args.tours} tours — seuil de compaction : {llm.seuil_resume():.0f} tokens"
+          f" — latence des résumés {'mesurée' if LIVE else 'estimée'}\n")
+    print(f"{'stratégie':<18}{'tokens corr./tour':>19}{'tokens résumé/tour':>20}"
+          f"{'compaction ms/tour':>20}{'résumé ms/tour':>16}{'résumés':>9}")
+    for strategie in ("fenetre", "resume-glissant", "resume-complet"):
+        m = rejouer(strategie, args)
+        print(f"{strategie:<18}{m['tokens_correction']:>19.0f}{m['tokens_resume']:>20.0f}"
+              f"{m['compaction_ms']:>20.2f}{m['resume_ms']:>16.0f}{m['resumes']:>9}")
+
+
+if __name__ == "__main__":
+    main()
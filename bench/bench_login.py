@@ -0,0 +1,111 @@
+"""
+⏱️ Benchmark de la connexion élève - bench_login.py
+
+Compare, pour un même élève, le chargement du contexte de session à la connexion :
+- "sequentiel" : ancienne séquence de requêtes (existence, consentement, scénario actif,
+                 matière, exercices, done_refs, feedback, dernier hash) — 8 allers-retours ou plus
+- "bootstrap"  : requête unique `bootstrap_eleve` (LATERAL)
+
+Les connexions sont simulées en rafale par plusieurs threads (début de cours : toute la classe
+se connecte en même temps). Les requêtes sont faites directement sur la base, sans Flask.
+
+Mesures : latence moyenne, p50, p95, max (ms) et débit (connexions / s).
+
+Utilisation :
+    DATABASE_URL=postgresql://... python bench/bench_login.py --eleve 3A-001 --connexions 300 --threads 30
+"""
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench-hors-ligne")  # aucun appel LLM
+
+from sqlalchemy import create_engine, text  # noqa: E402
+
+from utils.session_utils import (  # noqa: E402
+    bootstrap_eleve,
+    get_active_scenario_id_for_class,
+    load_json_from_db,
+    load_done_refs,
+    has_feedback,
+    get_last_hash,
+)
+
+
+def connexion_sequentielle(engine, sid: str):
+    """
+    Ancienne séquence de la connexion (login + init_session_context), requête par requête.
+    """
+    with engine.connect() as cn:
+        cn.scalar(text("SELECT 1 FROM students WHERE student_id=:sid"), {"sid": sid})
+    with engine.connect() as cn:
+        cn.scalar(text("SELECT rgpd_consent_date FROM students WHERE student_id = :sid"), {"sid": sid})
+
+    class_name = sid.split("-")[0]
+    scenario_id = get_active_scenario_id_for_class(engine, class_name)
+    with engine.connect() as cn:
+        cn.scalar(text("SELECT matiere FROM scenarios WHERE id = :id"), {"id": scenario_id})
+    load_json_from_db(engine, class_name, scenario_id)
+    load_done_refs(engine, sid, scenario_id)
+    has_feedback(engine, sid, scenario_id)
+    get_last_hash(engine, sid)
+
+
+def connexion_bootstrap(engine, sid: str):
+    bootstrap_eleve(engine, sid)
+
+
+def mesurer(fonction, engine, sid: str, connexions: int, threads: int) -> dict:
+    """
+    Lance `connexions` connexions réparties sur `threads` threads et collecte les latences.
+    """
+    def une_connexion(_):
+        debut = time.perf_counter()
+        fonction(engine, sid)
+        return (time.perf_counter() - debut) * 1000
+
+    debut = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latences = sorted(pool.map(une_connexion, range(connexions)))
+    duree = time.perf_counter() - debut
+
+    n = len(latences)
+    return {
+        "moy": sum(latences) / n,
+        "p50": latences[n // 2],
+        "p95": latences[min(n - 1, int(0.95 * n))],
+        "max": latences[-1],
+        "debit": n / duree,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare la connexion séquentielle et la requête de bootstrap.")
+    parser.add_argument("--eleve", required=True, help="identifiant d'un élève existant (ex : 3A-001)")
+    parser.add_argument("--connexions", type=int, default=300)
+    parser.add_argument("--threads", type=int, default=30)
+    parser.add_argument("--pool", type=int, default=10, help="taille du pool de connexions SQLAlchemy")
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        sys.exit("DATABASE_URL manquant.")
+    engine = create_engine(url, future=True, pool_size=args.pool, max_overflow=0)
+
+    if bootstrap_eleve(engine, args.eleve) is None:
+        sys.exit(f"Élève inconnu : {args.eleve}")
+
+    print(f"{args.connexions} connexions — {args.threads} threads — pool {args.pool}\n")
+    print(f"{'méthode':<14}{'moy ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'connexions/s':>15}")
+    for nom, fonction in (("sequentiel", connexion_sequentielle), ("bootstrap", connexion_bootstrap)):
+        mesurer(fonction, engine, args.eleve, min(args.connexions, args.threads), args.threads)  # chauffe du pool
+        m = mesurer(fonction, engine, args.eleve, args.connexions, args.threads)
+        print(f"{nom:<14}{m['moy']:>10.1f}{m['p50']:>10.1f}{m['p95']:>10.1f}{m['max']:>10.1f}{m['debit']:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,11 @@ load_dotenv()
 class Config:
     SECRET_KEY = os.getenv("FLASK_SECRET_KEY", "dev")
     SESSION_TYPE = "filesystem"
+    SESSION_BACKEND = os.getenv("SESSION_BACKEND", "compact")  # "compact" (utils/session_backend.py) ou "filesystem"
+    SESSION_COMPACT_DIR = os.getenv("SESSION_COMPACT_DIR", os.path.join(os.getcwd(), "flask_session_compact"))
+    SESSION_COMPRESSION_SEUIL = 4096          # octets : au-delà, la session est compressée (zlib)
+    SESSION_TAILLE_ALERTE = 256 * 1024        # octets : au-delà, avertissement dans les logs
+    SESSION_CLEANUP_N_REQUESTS = 1000         # purge des sessions expirées, en moyenne toutes les N requêtes
     SESSION_PERMANENT = False
     PERMANENT_SESSION_LIFETIME = timedelta(hours=2)
     DEBUG = False
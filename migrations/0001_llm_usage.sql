@@ -0,0 +1,20 @@
+-- 0001 — Télémétrie des appels LLM et de modération (utils/telemetry_utils.py)
+-- Écriture : rôle principal de l'application (DATABASE_URL), lecture : tableau de bord enseignant.
+
+CREATE TABLE IF NOT EXISTS llm_usage (
+    id                BIGSERIAL PRIMARY KEY,
+    created_at        TIMESTAMPTZ NOT NULL DEFAULT now(),
+    type_appel        TEXT NOT NULL,
+    model             TEXT,
+    prompt_tokens     INTEGER,
+    completion_tokens INTEGER,
+    latency_ms        INTEGER NOT NULL DEFAULT 0,
+    cache_hit         BOOLEAN NOT NULL DEFAULT false,
+    erreur            BOOLEAN NOT NULL DEFAULT false,
+    class_name        TEXT,
+    scenario_id       INTEGER,
+    ordinal           INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS llm_usage_class_scenario_idx
+    ON llm_usage (class_name, scenario_id, created_at);
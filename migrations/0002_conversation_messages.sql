@@ -0,0 +1,19 @@
+-- 0002 — Conversations élève ↔ IA stockées côté serveur (utils/conversation_store.py)
+-- Flux "history" (contexte LLM, par générations) et "cconv" (transcription affichée / exportée).
+
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    id          BIGSERIAL PRIMARY KEY,
+    student_id  TEXT NOT NULL,
+    scenario_id INTEGER NOT NULL,
+    flux        TEXT NOT NULL,
+    generation  INTEGER NOT NULL DEFAULT 0,
+    role        TEXT NOT NULL,
+    subtype     TEXT,
+    content     TEXT NOT NULL,
+    tokens      INTEGER,
+    retire      BOOLEAN NOT NULL DEFAULT false,
+    created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS conversation_messages_fil_idx
+    ON conversation_messages (student_id, scenario_id, flux, generation, id);
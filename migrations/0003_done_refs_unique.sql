@@ -0,0 +1,34 @@
+-- 0003 — Une seule ligne done_refs par (élève, scénario), cible de l'upsert de session_utils.ajouter_done_ref
+-- Les doublons existants (autorisés jusqu'ici, lus avec LIMIT 1) sont fusionnés avant la création de l'index.
+
+-- aucune écriture concurrente entre la fusion et la création de l'index
+LOCK TABLE done_refs IN SHARE ROW EXCLUSIVE MODE;
+
+-- lignes de chaque groupe en double, la première (ctid) étant conservée
+CREATE TEMP TABLE done_refs_doublons ON COMMIT DROP AS
+SELECT ctid AS ligne, student_id, scenario_id,
+       row_number() OVER (PARTITION BY student_id, scenario_id ORDER BY ctid) AS rang
+FROM done_refs
+WHERE (student_id, scenario_id) IN (
+    SELECT student_id, scenario_id FROM done_refs
+    GROUP BY student_id, scenario_id
+    HAVING count(*) > 1
+);
+
+-- la ligne conservée reçoit l'union des refs validées du groupe
+UPDATE done_refs d
+SET refs = (
+    SELECT COALESCE(jsonb_agg(DISTINCT r.ref), '[]'::jsonb)
+    FROM done_refs d2
+    CROSS JOIN LATERAL jsonb_array_elements(COALESCE(d2.refs, '[]'::jsonb)) AS r(ref)
+    WHERE d2.student_id = d.student_id AND d2.scenario_id = d.scenario_id
+)
+FROM done_refs_doublons x
+WHERE d.ctid = x.ligne AND x.rang = 1;
+
+DELETE FROM done_refs d
+USING done_refs_doublons x
+WHERE d.ctid = x.ligne AND x.rang > 1;
+
+CREATE UNIQUE INDEX IF NOT EXISTS done_refs_student_scenario_uidx
+    ON done_refs (student_id, scenario_id);
@@ -0,0 +1,68 @@
+-- 0004 — Chaînage WORM de chat_logs calculé par la base (utils/log_writer.py)
+-- Appelée par le rôle de journalisation (engine_log, app_log) qui n'est pas propriétaire de chat_logs :
+-- la fonction s'exécute avec les droits de son propriétaire (SECURITY DEFINER) et ne fait qu'ajouter.
+
+-- dernier log d'un élève (lecture du hash précédent)
+CREATE INDEX IF NOT EXISTS chat_logs_user_ts_idx ON chat_logs (user_id, ts);
+
+CREATE OR REPLACE FUNCTION ajouter_logs_chaines(
+    p_user_id TEXT[], p_prompt TEXT[], p_completion TEXT[], p_flags TEXT[], p_model TEXT[],
+    p_prev_initial TEXT[]
+) RETURNS TABLE (eleve TEXT, hash TEXT)
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public, pg_temp
+AS $$
+DECLARE
+    v_prev    TEXT;
+    v_ts_prec TIMESTAMPTZ;
+    v_ts      TIMESTAMPTZ;
+    v_hash    TEXT;
+BEGIN
+    -- un seul ajout à la fois par élève, jusqu'à la fin de la transaction ; tous les verrous du lot
+    -- sont pris d'abord, une fois par élève, dans un ordre fixe : deux lots concurrents ne peuvent
+    -- pas s'attendre mutuellement (pas d'interblocage)
+    PERFORM pg_advisory_xact_lock(v.cle)
+    FROM (SELECT DISTINCT hashtextextended('chat_logs:' || u, 0) AS cle
+          FROM unnest(p_user_id) AS u
+          ORDER BY cle) AS v;
+
+    FOR i IN 1 .. coalesce(array_length(p_user_id, 1), 0) LOOP
+        v_prev := NULL;
+        v_ts_prec := NULL;
+        SELECT c.this_hash, c.ts INTO v_prev, v_ts_prec
+        FROM chat_logs c
+        WHERE c.user_id = p_user_id[i]
+        ORDER BY c.ts DESC
+        LIMIT 1;
+
+        v_prev := coalesce(v_prev, nullif(p_prev_initial[i], ''), repeat('0', 64));
+        v_ts := greatest(clock_timestamp(), v_ts_prec + interval '1 microsecond');
+        v_hash := encode(sha256(convert_to(
+            to_char(v_ts AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"')
+            || p_user_id[i] || coalesce(p_prompt[i], '') || coalesce(p_completion[i], '')
+            || p_flags[i] || coalesce(p_model[i], '') || v_prev,
+            'UTF8')), 'hex');
+
+        INSERT INTO chat_logs(ts, user_id, prompt, completion, flags, model, prev_hash, this_hash)
+        VALUES (v_ts, p_user_id[i], p_prompt[i], p_completion[i], CAST(p_flags[i] AS jsonb),
+                p_model[i], v_prev, v_hash);
+
+        eleve := p_user_id[i];
+        hash := v_hash;
+        RETURN NEXT;
+    END LOOP;
+END
+$$;
+
+REVOKE ALL ON FUNCTION ajouter_logs_chaines(TEXT[], TEXT[], TEXT[], TEXT[], TEXT[], TEXT[]) FROM PUBLIC;
+
+-- rôle de journalisation (DATABASE_URL_LOG) ; sur une autre installation, accorder EXECUTE à son rôle
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'app_log') THEN
+        GRANT EXECUTE ON FUNCTION ajouter_logs_chaines(TEXT[], TEXT[], TEXT[], TEXT[], TEXT[], TEXT[])
+            TO app_log;
+    END IF;
+END
+$$;
@@ -0,0 +1,9 @@
+-- 0005 — Index de chaînage couvrant : lecture du dernier hash (ajouter_logs_chaines) et vérification
+-- d'intégrité (rgpd.verifier_integrite_worm) par parcours d'index seul.
+-- Nouveau nom : un CREATE INDEX IF NOT EXISTS sous l'ancien nom ne remplacerait pas l'index existant.
+
+CREATE INDEX IF NOT EXISTS chat_logs_user_ts_chain_idx
+    ON chat_logs (user_id, ts) INCLUDE (prev_hash, this_hash);
+
+-- remplacé par le précédent (mêmes colonnes de tête)
+DROP INDEX IF EXISTS chat_logs_user_ts_idx;
@@ -0,0 +1,12 @@
+-- 0006 — Vérification WORM incrémentale (rgpd.verifier_integrite_worm_incrementale)
+-- Points de reprise : rôle principal de l'application (DATABASE_URL), lecture et écriture.
+
+CREATE TABLE IF NOT EXISTS worm_checkpoints (
+    user_id     TEXT PRIMARY KEY,
+    ts          TIMESTAMPTZ NOT NULL,
+    this_hash   TEXT NOT NULL,
+    verified_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- seuls les logs postérieurs au plus récent point de reprise sont relus
+CREATE INDEX IF NOT EXISTS chat_logs_ts_idx ON chat_logs (ts);
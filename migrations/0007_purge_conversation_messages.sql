@@ -0,0 +1,17 @@
+-- 0007 — Rétention des conversations élève ↔ IA (rgpd.purge_old_logs)
+-- Les messages de plus de PURGE_DAYS jours sont supprimés par la purge RGPD, comptés dans logs_purges.
+
+CREATE INDEX IF NOT EXISTS conversation_messages_created_at_idx
+    ON conversation_messages (created_at);
+
+ALTER TABLE logs_purges ADD COLUMN IF NOT EXISTS nb_messages_deleted INTEGER NOT NULL DEFAULT 0;
+
+-- la purge s'exécute avec le rôle de journalisation (DATABASE_URL_LOG) ; sur une autre installation,
+-- accorder DELETE sur conversation_messages à son rôle
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'app_log') THEN
+        GRANT SELECT (created_at), DELETE ON conversation_messages TO app_log;
+    END IF;
+END
+$$;
@@ -0,0 +1,24 @@
+-- 0008 — Logs refusés par chat_logs (utils/log_writer.py) : jamais écrits sur disque, mis à l'écart ici.
+-- Ils ne font pas partie de la chaîne WORM : le tableau de bord RGPD les signale tant qu'il en reste.
+-- Couverts par la suppression d'un élève (rgpd.delete_student) et la purge (rgpd.purge_old_logs).
+
+CREATE TABLE IF NOT EXISTS chat_logs_rejets (
+    id         BIGSERIAL PRIMARY KEY,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    user_id    TEXT,
+    ligne      TEXT NOT NULL,  -- log refusé (JSON, caractères non ASCII échappés)
+    erreur     TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS chat_logs_rejets_user_idx ON chat_logs_rejets (user_id);
+CREATE INDEX IF NOT EXISTS chat_logs_rejets_created_at_idx ON chat_logs_rejets (created_at);
+
+-- rôle de journalisation (DATABASE_URL_LOG) : mise à l'écart, suppression et purge
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'app_log') THEN
+        GRANT SELECT, INSERT, DELETE ON chat_logs_rejets TO app_log;
+        GRANT USAGE ON SEQUENCE chat_logs_rejets_id_seq TO app_log;
+    END IF;
+END
+$$;
@@ -9,7 +9,9 @@ from sqlalchemy import text
 from io import BytesIO
 from zipfile import ZipFile, ZIP_DEFLATED
 
-from utils.session_utils import init_session_context
+from utils.session_utils import init_session_context, conversation_cache
+from utils.conversation_store import supprimer_conversations
+from utils.log_writer import vider_journal
 
 """
 🔐 Module de Gestion RGPD & WORM - rgpd.py
@@ -19,7 +21,8 @@ Ce module gère toutes les opérations critiques RGPD du projet :
 - Purge des logs anciens et anonymisation des réponses
 - Suppression d'élèves RGPD
 - Gestion du consentement explicite des élèves
-- Vérification de la continuité du chaînage WORM (prev_hash ➔ this_hash)
+- Vérification de la continuité du chaînage WORM (prev_hash ➔ this_hash) : incrémentale au tableau de bord
+  (points de reprise worm_checkpoints), complète à la demande ou par tâche planifiée (`flask verifier-worm`)
 - Génération systématique de rapports texte horodatés et scellés SHA256
 - Organisation rigoureuse des rapports dans /export/audit_reports/
 
@@ -238,41 +241,147 @@ def handle_consent(engine):
 
 # 🔍 Vérification intégrité WORM
 
-def verifier_integrite_worm(engine, generate_report=True):
+# marge de relecture de la vérification incrémentale : logs d'un lot encore non commité lors du passage précédent
+MARGE_CHECKPOINT_WORM = timedelta(minutes=5)
+
+
+def verifier_integrite_worm(engine, generate_report=True, engine_checkpoints=None):
     """
-    Vérifie la continuité du chaînage prev_hash / this_hash dans chat_logs.
+    Vérifie la continuité du chaînage prev_hash / this_hash dans chat_logs (vérification complète).
     Génère un rapport uniquement en cas d'anomalies nouvelles depuis le dernier rapport existant.
     Enregistre un rapport scellé sha 256
     Les rapports sont stockés dans /audit_reports/integrite_worm/
+
+    La comparaison est faite par la base (LAG sur chaque élève, dans l'ordre de ts) : seuls les maillons
+    rompus sont renvoyés. L'index chat_logs_user_ts_chain_idx (user_id, ts) INCLUDE (prev_hash, this_hash),
+    livré par migrations/0005_chat_logs_index_chainage.sql, permet un parcours d'index seul, sans tri.
+
+    Si engine_checkpoints est fourni, les points de reprise de la vérification incrémentale
+    (table worm_checkpoints) sont réinitialisés à partir de cette vérification complète.
     """
     with engine.connect() as cn:
-        logs = cn.execute(text("""
-            SELECT user_id, ts, prev_hash, this_hash
-            FROM chat_logs
-            ORDER  BY user_id ASC, ts ASC     -- 🔑  reset automatique
-        """)).mappings().all()
+        anomalies, derniers = anomalies_worm(cn)
 
-    previous_user = None
-    previous_this_hash = None
-    anomalies = []
+    if engine_checkpoints is not None:
+        enregistrer_checkpoints_worm(engine_checkpoints, derniers, complet=True)
 
-    for log in logs:
-        # ⚠️  Ne casse pas la verification chaîne sur les lignes anonymisées
-        if log["user_id"] == "ANONYMISED":
-            previous_this_hash = log["this_hash"]
-            continue
-        # on change d'élève → on remet les compteurs à zéro
-        if log["user_id"] != previous_user:
-            previous_user = log["user_id"]
-            previous_this_hash = None
+    return rapport_anomalies_worm(anomalies, generate_report)
+
+
+def verifier_integrite_worm_incrementale(engine, engine_checkpoints, generate_report=True):
+    """
+    Vérifie seulement les logs ajoutés depuis la dernière vérification (complète ou incrémentale).
+
+    Pour chaque élève, le point de reprise (table worm_checkpoints, migrations/0006_worm_checkpoints.sql)
+    garde le dernier log vérifié (ts, this_hash) : le premier nouveau log doit pointer sur ce hash,
+    les suivants sur leur prédécesseur. Seuls les logs postérieurs au plus récent point de reprise
+    (moins une marge de MARGE_CHECKPOINT_WORM, pour les transactions encore en cours) sont lus,
+    via chat_logs_ts_idx.
+
+    Sans point de reprise (premier appel), la vérification porte sur tout l'historique.
+    Retourne True si aucune nouvelle anomalie, comme verifier_integrite_worm.
+    """
+    checkpoints = charger_checkpoints_worm(engine_checkpoints)
+    depuis = max((cp[1] for cp in checkpoints), default=None)
+    if depuis is not None:
+        depuis -= MARGE_CHECKPOINT_WORM
+
+    with engine.connect() as cn:
+        anomalies, derniers = anomalies_worm(cn, checkpoints, depuis)
+
+    enregistrer_checkpoints_worm(engine_checkpoints, derniers)
+    return rapport_anomalies_worm(anomalies, generate_report)
+
+
+def anomalies_worm(cn, checkpoints=None, depuis=None):
+    """
+    Maillons rompus du chaînage, et dernier log de chaque élève parmi les logs vérifiés.
+
+    - checkpoints : [(user_id, ts, this_hash)] derniers logs déjà vérifiés (logs antérieurs ignorés)
+    - depuis : ne lit que les logs de ts > depuis (None = tout l'historique)
+
+    Retour : (anomalies [(ts, user_id, prev attendu, prev trouvé)], derniers [(user_id, ts, this_hash)])
+    """
+    checkpoints = checkpoints or []
+    rows = cn.execute(text("""
+        WITH cp AS (
+            SELECT * FROM unnest(CAST(:uids AS TEXT[]), CAST(:tss AS TIMESTAMPTZ[]), CAST(:hashes AS TEXT[]))
+                AS cp(user_id, ts, this_hash)
+        ),
+        chaine AS (
+            SELECT l.user_id, l.ts, l.prev_hash, l.this_hash,
+                   COALESCE(LAG(l.this_hash) OVER w, cp.this_hash) AS attendu,
+                   ROW_NUMBER() OVER (PARTITION BY l.user_id ORDER BY l.ts DESC) AS rang_fin
+            FROM chat_logs l
+            LEFT JOIN cp ON cp.user_id = l.user_id
+            WHERE l.user_id IS DISTINCT FROM 'ANONYMISED'   -- ⚠️ lignes anonymisées hors vérification
+              AND (CAST(:depuis AS TIMESTAMPTZ) IS NULL OR l.ts > CAST(:depuis AS TIMESTAMPTZ))
+              AND (cp.ts IS NULL OR l.ts > cp.ts)
+            WINDOW w AS (PARTITION BY l.user_id ORDER BY l.ts)
+        )
+        SELECT user_id, ts, prev_hash, this_hash, attendu,
+               attendu <> '' AND prev_hash IS DISTINCT FROM attendu AS rompu,
+               rang_fin = 1 AS dernier
+        FROM chaine
+        WHERE rang_fin = 1
+           OR (attendu <> '' AND prev_hash IS DISTINCT FROM attendu)
+        ORDER BY user_id, ts
+    """), {
+        "uids": [cp[0] for cp in checkpoints],
+        "tss": [cp[1] for cp in checkpoints],
+        "hashes": [cp[2] for cp in checkpoints],
+        "depuis": depuis,
+    }).mappings()
+
+    anomalies, derniers = [], []
+    for row in rows:
+        if row["rompu"]:
+            anomalies.append((row["ts"], row["user_id"], row["attendu"], row["prev_hash"]))
+        if row["dernier"]:
+            derniers.append((row["user_id"], row["ts"], row["this_hash"]))
+    return anomalies, derniers
+
+
+def charger_checkpoints_worm(engine) -> list[tuple]:
+    """
+    Points de reprise de la vérification WORM : [(user_id, ts, this_hash)].
+    """
+    with engine.connect() as cn:
+        return [tuple(r) for r in cn.execute(text("SELECT user_id, ts, this_hash FROM worm_checkpoints"))]
 
-        if previous_this_hash and log["prev_hash"] != previous_this_hash:
-            anomalies.append((
-                log["ts"], log["user_id"],
-                previous_this_hash, log["prev_hash"]
-            ))
 
-        previous_this_hash = log["this_hash"]
+def enregistrer_checkpoints_worm(engine, derniers, complet=False):
+    """
+    Avance les points de reprise au dernier log vérifié de chaque élève (complet=True : remplace tout).
+    """
+    with engine.begin() as cn:
+        if complet:
+            cn.execute(text("DELETE FROM worm_checkpoints"))
+        if not derniers:
+            return
+        cn.execute(text("""
+            INSERT INTO worm_checkpoints (user_id, ts, this_hash)
+            SELECT * FROM unnest(CAST(:uids AS TEXT[]), CAST(:tss AS TIMESTAMPTZ[]), CAST(:hashes AS TEXT[]))
+            ON CONFLICT (user_id) DO UPDATE
+            SET ts = EXCLUDED.ts, this_hash = EXCLUDED.this_hash, verified_at = now()
+        """), {"uids": [d[0] for d in derniers], "tss": [d[1] for d in derniers],
+               "hashes": [d[2] for d in derniers]})
+
+
+def supprimer_checkpoint_worm(engine, student_id):
+    """
+    Retire le point de reprise d'un élève (suppression RGPD : une nouvelle chaîne repartirait de zéro).
+    """
+    with engine.begin() as cn:
+        cn.execute(text("DELETE FROM worm_checkpoints WHERE user_id = :sid"), {"sid": student_id})
+
+
+def rapport_anomalies_worm(anomalies, generate_report=True) -> bool:
+    """
+    Génère le rapport scellé des anomalies si elles sont nouvelles depuis le dernier rapport.
+    Retourne False si une nouvelle anomalie est détectée, True sinon.
+    """
+    need_new_report = bool(anomalies)
 
     if anomalies and generate_report:
         # Trouver la date du dernier rapport WORM existant par recherche dans le sous-dossier integrite_worm
@@ -339,6 +448,25 @@ def anonymiser_logs_student(engine_log, student_id):
     return result.rowcount  # nombre de lignes anonymisées
 
 
+def supprimer_logs_rejetes_student(engine_log, student_id):
+    """
+    Supprime les logs de l'élève mis à l'écart (chat_logs_rejets : refusés par chat_logs, hors chaîne WORM).
+
+    Moteur utilisé : engine_log (rôle app_log).
+    """
+    with engine_log.begin() as conn:
+        result = conn.execute(text("DELETE FROM chat_logs_rejets WHERE user_id = :sid"), {"sid": student_id})
+    return result.rowcount
+
+
+def compter_logs_rejetes(engine_log) -> int:
+    """
+    Nombre de logs mis à l'écart (refusés par chat_logs) : ils manquent à la chaîne WORM.
+    """
+    with engine_log.connect() as conn:
+        return conn.scalar(text("SELECT count(*) FROM chat_logs_rejets"))
+
+
 def delete_student_record(engine, student_id):
     """
     Supprime un élève de la base students.
@@ -359,7 +487,8 @@ def delete_student(engine, engine_log,student_id):
     """
     Supprime l'élève et ses données associées pour respect du RGPD.
 
-    - Anonymise les logs liés dans chat_logs.
+    - Anonymise les logs liés dans chat_logs, supprime ses logs mis à l'écart (chat_logs_rejets).
+    - Supprime ses conversations (conversation_messages) et son point de reprise WORM.
     - Supprime l'entrée correspondante dans students.
     - Génère un rapport scellé SHA256 dans /audit_reports/Deleted_students/
 
@@ -390,7 +519,12 @@ def delete_student(engine, engine_log,student_id):
         # donc l'intégrité du scellage est strictement préservée.
 
 
+        vider_journal()  # logs de l'élève encore en file : écrits avant l'anonymisation
         nb_anonymised = anonymiser_logs_student(engine_log, student_id)
+        nb_rejetes = supprimer_logs_rejetes_student(engine_log, student_id)
+        nb_messages = supprimer_conversations(engine, student_id)
+        conversation_cache.invalidate(lambda cle: cle[0] == student_id)
+        supprimer_checkpoint_worm(engine, student_id)  # logs anonymisés : chaîne de l'élève hors vérification
         nb_deleted = delete_student_record(engine, student_id)
             
         now = datetime.now(timezone.utc)
@@ -402,6 +536,8 @@ def delete_student(engine, engine_log,student_id):
             f"Date de suppression : {now.strftime('%Y-%m-%d %H:%M UTC')}",
             f"Élève : {student_id}",
             f"Nombre de logs anonymisés : {nb_anonymised}",
+            f"Nombre de messages de conversation supprimés : {nb_messages}",
+            f"Nombre de logs mis à l'écart supprimés : {nb_rejetes}",
             f"Suppression de la fiche élève : {'Oui' if nb_deleted > 0 else 'Non (inexistant)'}"
         ]
         # Générer le rapport scellé SHA256
@@ -767,6 +903,8 @@ def purge_old_logs(engine,days=15):
 
     - Anonymise les anciens logs de chat_logs (> PURGE_DAYS).
     - Supprime les réponses données par les élèves dans attempts (> PURGE_DAYS).
+    - Supprime les messages des conversations élève ↔ IA (conversation_messages, > PURGE_DAYS).
+    - Supprime les logs mis à l'écart (chat_logs_rejets, > PURGE_DAYS).
     - Ne supprime rien de WORM (respect de l'intégrité chaînée).
     - Génère un rapport SHA256 dans /audit_reports/purges/
     """
@@ -789,13 +927,26 @@ def purge_old_logs(engine,days=15):
                 WHERE ended_at < now() - interval '{PURGE_DAYS} days'
             """))
 
+            # ✅ Supprimer les anciens messages des conversations (historique LLM et transcription)
+            messages = conn.execute(text(f"""
+                DELETE FROM conversation_messages
+                WHERE created_at < now() - interval '{PURGE_DAYS} days'
+            """))
+
+            # ✅ Supprimer les anciens logs mis à l'écart (refusés par chat_logs)
+            rejetes = conn.execute(text(f"""
+                DELETE FROM chat_logs_rejets
+                WHERE created_at < now() - interval '{PURGE_DAYS} days'
+            """))
+
             # ✅ Enregistrer dans logs_purges
             conn.execute(text("""
-                INSERT INTO logs_purges (nb_logs_deleted, nb_attempts_anonymized)
-                VALUES (:logs, :ans)
+                INSERT INTO logs_purges (nb_logs_deleted, nb_attempts_anonymized, nb_messages_deleted)
+                VALUES (:logs, :ans, :msgs)
             """), {
                 "logs": anonymized_logs.rowcount,
-                "ans": cleared.rowcount
+                "ans": cleared.rowcount,
+                "msgs": messages.rowcount
             })
 
         now_str = now.strftime("%Y-%m-%d_%H-%M-%S")
@@ -804,12 +955,14 @@ def purge_old_logs(engine,days=15):
         lines = [
             f"Date de la purge : {now.strftime('%Y-%m-%d %H:%M UTC')}",
             f"Nombre de logs anonymisés : {anonymized_logs.rowcount}",
-            f"Nombre d'attempts anonymisés : {cleared.rowcount}"
+            f"Nombre d'attempts anonymisés : {cleared.rowcount}",
+            f"Nombre de messages de conversation supprimés : {messages.rowcount}",
+            f"Nombre de logs mis à l'écart supprimés : {rejetes.rowcount}"
         ]
 
         generate_report_sha256(filename, lines, "purges")        
 
-        flash(f"✅ Purge terminée : {anonymized_logs.rowcount} logs anonymisés, {cleared.rowcount} réponses anonymisées.", "success")
+        flash(f"✅ Purge terminée : {anonymized_logs.rowcount} logs anonymisés, {cleared.rowcount} réponses anonymisées, {messages.rowcount} messages supprimés.", "success")
 
     except Exception as e:
         flash(f"❌ Erreur lors de la purge : {e}", "error")
@@ -0,0 +1,36 @@
+// static/js/dashboard_llm_chart.js
+
+document.addEventListener("DOMContentLoaded", function () {
+    const canvas = document.getElementById('graph-usage-llm');
+    if (!canvas) return;
+  
+    const labels = JSON.parse(canvas.getAttribute("data-labels"));
+    const latences = JSON.parse(canvas.getAttribute("data-latences"));
+    const tokens = JSON.parse(canvas.getAttribute("data-tokens"));
+  
+    const usageData = {
+      labels: labels,
+      datasets: [{
+        label: "Latence moyenne (ms)",
+        data: latences,
+        backgroundColor: "rgba(0,0,255,0.3)",
+        yAxisID: "y"
+      }, {
+        label: "Tokens générés",
+        data: tokens,
+        backgroundColor: "rgba(255,140,0,0.3)",
+        yAxisID: "y1"
+      }]
+    };
+  
+    new Chart(canvas, {
+      type: 'bar',
+      data: usageData,
+      options: {
+        scales: {
+          y: { beginAtZero: true, position: "left" },
+          y1: { beginAtZero: true, position: "right", grid: { drawOnChartArea: false } }
+        }
+      }
+    });
+  });
@@ -226,6 +226,67 @@ function renderUserBubble(id, message, codeText) {
 
 
 
+// Lit la réponse SSE de /api/message/stream : affiche les tokens au fil de l'eau
+// dans une bulle provisoire, puis renvoie le texte final (événement "fin").
+async function lireFluxReponse(response, conv) {
+  // erreur HTTP, session expirée (redirection vers la page de connexion)… : rien à afficher comme réponse
+  const type = response.headers.get("Content-Type") || "";
+  if (!response.ok || !response.body || !type.includes("text/event-stream")) {
+    throw new Error(`Réponse inattendue du serveur (${response.status})`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let partiel = "";
+  let final = null;
+  let bulle = null;
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let sep;
+    while ((sep = buffer.indexOf("\n\n")) !== -1) {
+      const bloc = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+
+      let event = "message";
+      let data = "";
+      for (const ligne of bloc.split("\n")) {
+        if (ligne.startsWith("event:")) event = ligne.slice(6).trim();
+        else if (ligne.startsWith("data:")) data += ligne.slice(5).trim();
+      }
+      if (!data) continue;
+
+      const payload = JSON.parse(data);
+      if (event === "fin") {
+        final = payload.reply;
+      } else if (event === "erreur") {
+        if (bulle) bulle.remove();
+        throw new Error(payload.error);
+      } else if (payload.delta) {
+        partiel += payload.delta;
+        if (!bulle) {
+          document.getElementById("dot-loader").style.display = "none";
+          conv.insertAdjacentHTML("beforeend", `<div class="message assistant streaming"><div class="bubble"></div></div>`);
+          bulle = conv.lastElementChild;
+        }
+        bulle.querySelector(".bubble").textContent = partiel;
+        scrollConvToBottom();
+      }
+    }
+  }
+
+  // la bulle provisoire est remplacée par le rendu final (code, MathJax, réactions)
+  if (bulle) bulle.remove();
+  // flux coupé avant l'événement `fin` : la réponse partielle n'est pas une réponse
+  if (final === null) throw new Error("Réponse interrompue");
+  return final;
+}
+
+
         
   async function sendMessage(message, codeText = "",hiddenPrompt = null) {
 
@@ -271,15 +332,14 @@ function renderUserBubble(id, message, codeText) {
                 document.getElementById("dot-loader").style.display = "flex";
 
 
-                const response = await fetch('/api/message', {
+                const response = await fetch('/api/message/stream', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify({ message: fullMessage })
                 });
 
         
-                const data = await response.json();
-                let reply = data.reply;
+                let reply = await lireFluxReponse(response, conv);
 
 
                 const formattedReply = formatCodeBlocks(reply);
@@ -299,7 +359,7 @@ function renderUserBubble(id, message, codeText) {
 
 
                   // il suffit de retirer reaction si on veut pas
-                  const rawTex = data.reply;
+                  const rawTex = reply;
                   let reactionButtons = `
                         <button class="react" data-emoji="❓" title="Expliquer">❓</button>
                         <button class="react" data-emoji="🚩" title="Signaler">🚩</button>
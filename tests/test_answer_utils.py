@@ -0,0 +1,50 @@
+"""
+Tests de la vérification locale des réponses (utils/answer_utils.py).
+"""
+
+from fractions import Fraction
+
+from utils.answer_utils import decouper_collection, parse_nombre, separer_variable, verifier_reponse
+
+
+# 🔢 Nombres
+
+def test_virgule_decimale():
+    assert parse_nombre("-2,5") == Fraction(-5, 2)
+    assert verifier_reponse("2,5", "2.5") is True
+
+
+def test_virgule_suivie_d_un_espace_n_est_pas_decimale():
+    assert parse_nombre("2, 3") is None
+    assert parse_nombre("1,2,3") is None
+
+
+# 🧺 Collections
+
+def test_collection_sans_delimiteurs():
+    assert decouper_collection("2, 3") == (["2", "3"], False)
+    assert decouper_collection("1,2,3") == (["1", "2", "3"], False)
+    assert decouper_collection("2,3") == (None, None)
+
+
+def test_ensemble_sans_delimiteurs_ordre_indifferent():
+    assert verifier_reponse("3, 2", "2, 3") is True
+    assert verifier_reponse("3;2", "2, 3") is True
+
+
+def test_decimal_contre_ensemble_indecidable():
+    # « 3,2 » peut être le décimal 3,2 : jamais un faux certain face à l'ensemble {2 ; 3}
+    assert verifier_reponse("3,2", "2, 3") is None
+    assert verifier_reponse("2,3", "2, 3") is None
+
+
+# 🏷️ Préfixe de variable
+
+def test_prefixe_variable_facultatif():
+    assert separer_variable("f(x) = 3") == ("f(x)", "3")
+    assert verifier_reponse("x = 3", "x = 3") is True
+    assert verifier_reponse("3", "x = 3") is True
+
+
+def test_variables_differentes_indecidable():
+    assert verifier_reponse("y = 3", "x = 3") is None
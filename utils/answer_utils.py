@@ -0,0 +1,221 @@
+"""
+answer_utils.py — Vérification locale et déterministe des réponses d'élèves.
+
+Compare le message de l'élève à la réponse attendue de l'exercice (ANS_JSON),
+sans appel au LLM, pour trancher en quelques microsecondes les cas évidents :
+
+- nombres : entiers, décimaux (virgule ou point), fractions, pourcentages, avec tolérance
+- textes courts : insensibles à la casse, aux accents et aux espaces
+- ensembles {a ; b} (ordre indifférent) et listes [a ; b] / (a ; b) (ordre imposé) ;
+  sans délimiteurs, « a ; b », « a, b » (virgule suivie d'un espace) et « a,b,c » sont des ensembles
+- virgule décimale seulement entre deux chiffres collés : « 2,3 » = 2,3 mais « 2, 3 » n'est pas un nombre
+- préfixe de variable facultatif : « x = 3 » ≡ « 3 » ; deux noms de variable différents
+  (« y = 3 » / « x = 3 ») rendent la réponse indécidable
+
+Retour de `verifier_reponse` :
+    True  → réponse correcte de façon certaine
+    False → réponse fausse de façon certaine
+    None  → indécidable localement (texte libre, approximation…) : le LLM tranche
+"""
+
+import re
+import math
+import unicodedata
+from fractions import Fraction
+
+
+TOLERANCE_RELATIVE = 1e-6
+
+_PREFIXE_VARIABLE = re.compile(r"^([a-z][a-z0-9_()']*)\s*=\s*(?=\S)", re.IGNORECASE)
+_VIRGULE_SEPARATEUR = re.compile(r",\s|,.*,")
+_NOMBRE = re.compile(r"^[+-]?(\d+([.,]\d*)?|[.,]\d+)(e[+-]?\d+)?%?$", re.IGNORECASE)
+_FRACTION = re.compile(r"^([+-]?\d+)\s*/\s*([+-]?\d+)$")
+
+
+def normaliser_texte(txt: str) -> str:
+    """
+    Forme canonique d'un texte court : NFKC, sans accents, casse ignorée,
+    sans espaces ni ponctuation finale.
+    """
+    txt = unicodedata.normalize("NFKD", txt or "")
+    txt = "".join(c for c in txt if not unicodedata.combining(c))
+    txt = re.sub(r"\s+", "", txt.casefold())
+    return txt.rstrip(".!?")
+
+
+def parse_nombre(txt: str):
+    """
+    Convertit un texte en nombre exact (Fraction) si possible, sinon None.
+
+    Accepte : "3", "-2,5", "0.75", "3/4", "1e-3", "75%".
+    Refuse les virgules de séparation : "2, 3" et "1,2,3" ne sont pas des nombres.
+    """
+    s = (txt or "").strip()
+    if _VIRGULE_SEPARATEUR.search(s):
+        return None
+    s = s.replace("−", "-").replace(" ", "")
+    if not s:
+        return None
+
+    m = _FRACTION.match(s)
+    if m:
+        den = int(m.group(2))
+        return Fraction(int(m.group(1)), den) if den else None
+
+    if _NOMBRE.match(s):
+        pourcent = s.endswith("%")
+        s = s.rstrip("%").replace(",", ".")
+        try:
+            val = Fraction(s)
+        except (ValueError, ZeroDivisionError):
+            return None
+        return val / 100 if pourcent else val
+
+    return None
+
+
+def nb_decimales(txt: str) -> int:
+    """
+    Nombre de décimales écrites par l'élève (« 0,33 » → 2), utilisé pour les approximations.
+    """
+    m = re.search(r"[.,](\d+)", txt or "")
+    return len(m.group(1)) if m else 0
+
+
+def comparer_nombres(donne_txt: str, attendu_txt: str):
+    """
+    Compare deux nombres. True si égaux (tolérance relative), None si la valeur donnée
+    est un arrondi de la valeur attendue, False sinon. None si l'un n'est pas un nombre.
+    """
+    donne, attendu = parse_nombre(donne_txt), parse_nombre(attendu_txt)
+    if donne is None or attendu is None:
+        return None
+
+    if math.isclose(float(donne), float(attendu), rel_tol=TOLERANCE_RELATIVE, abs_tol=1e-12):
+        return True
+
+    # arrondi (0,33 pour 1/3) : acceptable ou non selon la consigne → le LLM décide
+    decimales = nb_decimales(donne_txt)
+    if decimales and abs(float(donne) - float(attendu)) <= 10 ** (-decimales):
+        return None
+    return False
+
+
+def decouper_collection(txt: str):
+    """
+    Détecte une collection et la découpe.
+
+    Retourne (elements, ordonne) :
+    - {a ; b}          → ensemble (ordonne = False)
+    - [a ; b], (a ; b) → liste (ordonne = True)
+    - a ; b            → ensemble
+    - a, b / a,b,c     → ensemble (virgule suivie d'un espace, ou plusieurs virgules ; « 2,5 » reste un nombre)
+    ou (None, None) si le texte n'est pas une collection.
+    """
+    s = (txt or "").strip()
+    ordonne = None
+    if len(s) >= 2 and s[0] + s[-1] in ("{}", "[]", "()"):
+        ordonne = s[0] != "{"
+        s = s[1:-1]
+        sep = ";" if ";" in s else ","
+    elif ";" in s:
+        ordonne = False
+        sep = ";"
+    elif _VIRGULE_SEPARATEUR.search(s):
+        ordonne = False
+        sep = ","
+    else:
+        return None, None
+
+    elements = [e.strip() for e in s.split(sep) if e.strip()]
+    if len(elements) < 2 and ordonne is not False:
+        return None, None
+    return elements, ordonne
+
+
+def comparer_elements(donne: str, attendu: str):
+    """
+    Compare deux éléments simples : numériquement si possible, sinon textuellement.
+    """
+    verdict = comparer_nombres(donne, attendu)
+    if verdict is not None or (parse_nombre(donne) is not None and parse_nombre(attendu) is not None):
+        return verdict
+    return True if normaliser_texte(donne) == normaliser_texte(attendu) else None
+
+
+def separer_variable(txt: str) -> tuple[str | None, str]:
+    """
+    Sépare un préfixe du type « x = », « f(x) = », « y' = » du reste de la réponse.
+    Retourne (nom de la variable ou None, reste).
+    """
+    s = (txt or "").strip()
+    m = _PREFIXE_VARIABLE.match(s)
+    if not m:
+        return None, s
+    return m.group(1), s[m.end():]
+
+
+def retirer_prefixe_variable(txt: str) -> str:
+    """
+    Supprime un préfixe du type « x = », « f(x) = », « y' = » en début de réponse.
+    """
+    return separer_variable(txt)[1]
+
+
+def verifier_reponse(reponse_eleve: str, reponse_attendue: str | None):
+    """
+    Vérifie localement la réponse d'un élève.
+
+    Args:
+        reponse_eleve (str): Message envoyé par l'élève.
+        reponse_attendue (str | None): Réponse attendue de l'exercice (ANS_JSON[ref]).
+
+    Returns:
+        bool | None: True (correct), False (faux) ou None (indécidable localement).
+    """
+    if not reponse_attendue or not reponse_eleve or not reponse_eleve.strip():
+        return None
+
+    # un message long (raisonnement, question, code…) n'est pas une simple réponse
+    if len(reponse_eleve) > 4 * len(reponse_attendue) + 20 or "\n" in reponse_eleve.strip():
+        return None
+
+    variable_donnee, donne = separer_variable(reponse_eleve)
+    variable_attendue, attendu = separer_variable(reponse_attendue)
+
+    # « y = 3 » pour « x = 3 » : autre variable (ou autre notation) → le LLM tranche
+    if variable_donnee and variable_attendue and variable_donnee != variable_attendue:
+        return None
+
+    # ensembles et listes (avant la comparaison de texte : « 2,3 » n'est pas « 2, 3 »)
+    elements_attendus, ordonne = decouper_collection(attendu)
+    if elements_attendus is not None:
+        elements_donnes, _ = decouper_collection(donne)
+        if elements_donnes is None:
+            return None
+        if len(elements_donnes) != len(elements_attendus):
+            return False
+        if ordonne:
+            verdicts = [comparer_elements(d, a) for d, a in zip(elements_donnes, elements_attendus)]
+        else:
+            restants = list(elements_attendus)
+            verdicts = []
+            for d in elements_donnes:
+                match = next((a for a in restants if comparer_elements(d, a)), None)
+                if match is None:
+                    verdicts.append(None)
+                else:
+                    restants.remove(match)
+                    verdicts.append(True)
+        if all(v is True for v in verdicts):
+            return True
+        if any(v is False for v in verdicts) or (not ordonne and all(parse_nombre(e) is not None for e in elements_donnes + elements_attendus)):
+            return False
+        return None
+
+    # texte identique à la casse / aux espaces près
+    if normaliser_texte(donne) == normaliser_texte(attendu):
+        return True
+
+    # nombres (entiers, décimaux, fractions, pourcentages)
+    return comparer_nombres(donne, attendu)
@@ -0,0 +1,55 @@
+"""
+attempts_writer.py — Enregistrement des tentatives (table attempts).
+
+Chaque message élève (hors navigation) produit une tentative, écrite immédiatement, dans la requête
+qui la produit : une lecture de attempts (dashboards, exports, évolution, suppression de scénario)
+voit toujours toutes les tentatives déjà enregistrées, quel que soit le worker gunicorn qui les a
+reçues. Les tentatives d'un même appel sont insérées ensemble (un INSERT multi-lignes via unnest,
+un commit) ; aucune file n'est partagée entre requêtes.
+
+ended_at est fixé au moment de l'enregistrement.
+"""
+
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+
+_engine = None
+
+
+def demarrer_tentatives(engine):
+    """
+    Associe le moteur SQLAlchemy utilisé pour l'écriture.
+    """
+    global _engine
+    _engine = engine
+
+
+def enregistrer_tentative(student_id: str, exercise_id, started_at: float, elapsed_s: int,
+                          given_answer: str, is_correct: bool):
+    """
+    Enregistre une tentative (écriture synchrone, visible de toutes les lectures dès le retour).
+    started_at : timestamp Unix du début de l'exercice.
+    """
+    ecrire_tentatives(_engine, [{"sid": student_id, "eid": exercise_id, "s": started_at,
+                                 "fin": datetime.now(timezone.utc), "e": elapsed_s,
+                                 "ans": given_answer, "ok": is_correct}])
+
+
+def ecrire_tentatives(engine, lot: list[dict]):
+    """
+    Insère un lot de tentatives en une seule requête.
+    Les tentatives d'un exercice supprimé entre-temps (scénario effacé) sont ignorées.
+    """
+    with engine.begin() as cn:
+        cn.execute(text("""
+            INSERT INTO attempts(student_id,exercise_id,started_at,ended_at,
+                                 elapsed_s,given_answer,is_correct)
+            SELECT t.sid, t.eid, to_timestamp(t.s), t.fin, t.e, t.ans, t.ok
+            FROM unnest(CAST(:sid AS TEXT[]), CAST(:eid AS INTEGER[]), CAST(:s AS DOUBLE PRECISION[]),
+                        CAST(:fin AS TIMESTAMPTZ[]), CAST(:e AS INTEGER[]), CAST(:ans AS TEXT[]),
+                        CAST(:ok AS BOOLEAN[]))
+                 AS t(sid, eid, s, fin, e, ans, ok)
+            JOIN exercises ex ON ex.exercise_id = t.eid
+        """), {cle: [ligne[cle] for ligne in lot] for cle in ("sid", "eid", "s", "fin", "e", "ans", "ok")})
@@ -0,0 +1,97 @@
+"""
+cache_utils.py — Petit cache mémoire LRU + TTL, partagé par les threads d'un worker.
+
+Utilisé pour éviter de répéter des appels coûteux (LLM, modération, base de données)
+dont le résultat ne change pas d'un élève à l'autre.
+
+Caractéristiques :
+- éviction LRU au-delà de `maxsize` entrées
+- expiration de chaque entrée après `ttl` secondes
+- compteurs hits / misses / évictions exposés par `stats()`
+- invalidation ciblée par prédicat sur la clé (ex : toutes les entrées d'un scénario)
+
+Remarque : le cache est propre à chaque processus (un worker gunicorn = un cache).
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Cache clé → valeur borné en taille (LRU) et en durée de vie (TTL).
+    Toutes les opérations sont protégées par un verrou (sûr en multi-threads).
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 3600, name: str = "cache"):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict()  # clé → (expire_at, valeur)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Renvoie la valeur associée à `key`, ou `default` si absente ou expirée.
+        Met à jour les compteurs hits / misses.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        """
+        Enregistre `value` pour `key` et évince les entrées les moins récemment utilisées si besoin.
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate=None) -> int:
+        """
+        Supprime les entrées dont la clé vérifie `predicate(key)` (toutes si predicate est None).
+        Retourne le nombre d'entrées supprimées.
+        """
+        with self._lock:
+            if predicate is None:
+                n = len(self._data)
+                self._data.clear()
+                return n
+            keys = [k for k in self._data if predicate(k)]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """
+        Renvoie les compteurs du cache : taille, hits, misses, évictions et taux de succès (%).
+        """
+        total = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_s": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(100 * self.hits / total, 1) if total else 0.0,
+        }
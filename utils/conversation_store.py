@@ -0,0 +1,154 @@
+"""
+conversation_store.py — Stockage serveur des conversations élève ↔ IA (table conversation_messages).
+
+Remplace session["history"] (contexte LLM) et session["cconv"] (fil affiché / exporté) :
+les conversations ne sont plus réécrites en entier dans la session à chaque requête
+et survivent à la déconnexion.
+
+Deux flux par (élève, scénario) :
+- "history" : contexte envoyé au LLM (hors prompt du scénario, ajouté à la lecture)
+- "cconv"   : transcription pour l'affichage et les exports (intro, titres d'exercice, messages, feedback)
+
+Principes :
+- append-only : les messages d'un tour (history et cconv) sont écrits ensemble, en un seul INSERT
+  multi-lignes (cf. session_utils.tour_ecrire) ; un message déjà écrit puis refusé est seulement marqué `retire`
+- compaction (résumé, fenêtre glissante) : les messages conservés sont réécrits dans une nouvelle
+  `generation`, seule la dernière génération est lue
+- l'historique courant est gardé en mémoire par le worker (cache chaud) ; la session porte un jeton
+  de version pour détecter qu'un autre worker l'a modifié entre-temps
+
+La table est créée par la migration migrations/0002_conversation_messages.sql (cf. utils/migrations.py).
+
+Rétention (RGPD) : les messages de plus de PURGE_DAYS jours sont supprimés par rgpd.purge_old_logs,
+tous les messages d'un élève par rgpd.delete_student.
+"""
+
+from sqlalchemy import text
+
+
+def charger_historique(engine, student_id: str, scenario_id) -> dict:
+    """
+    Charge la dernière génération du flux "history".
+
+    Returns:
+        dict: {"generation": int, "ids": [...], "messages": [{"role", "content"}...], "tokens": [...]}
+    """
+    with engine.connect() as cn:
+        rows = cn.execute(text("""
+            SELECT id, generation, role, content, tokens
+            FROM conversation_messages
+            WHERE student_id = :sid AND scenario_id = :scid AND flux = 'history'
+              AND NOT retire
+              AND generation = (
+                  SELECT COALESCE(MAX(generation), 0) FROM conversation_messages
+                  WHERE student_id = :sid AND scenario_id = :scid AND flux = 'history'
+              )
+            ORDER BY id
+        """), {"sid": student_id, "scid": scenario_id}).mappings().all()
+
+    return {
+        "generation": rows[0]["generation"] if rows else 0,
+        "ids": [r["id"] for r in rows],
+        "messages": [{"role": r["role"], "content": r["content"]} for r in rows],
+        "tokens": [r["tokens"] for r in rows],
+    }
+
+
+def ajouter_messages(engine, student_id: str, scenario_id, lignes: list[dict]) -> list[int]:
+    """
+    Ajoute des messages aux flux d'une conversation, dans l'ordre, en un seul INSERT (une transaction).
+
+    Chaque ligne : {"flux", "generation", "role", "subtype", "content", "tokens"}.
+    Retourne les ids des lignes insérées, dans l'ordre de `lignes`.
+    """
+    if not lignes:
+        return []
+    with engine.begin() as cn:
+        ids = cn.execute(text("""
+            INSERT INTO conversation_messages (student_id, scenario_id, flux, generation, role, subtype, content, tokens)
+            SELECT :sid, :scid, m.flux, m.generation, m.role, m.subtype, m.content, m.tokens
+            FROM unnest(CAST(:flux AS TEXT[]), CAST(:gens AS INTEGER[]), CAST(:roles AS TEXT[]),
+                        CAST(:subtypes AS TEXT[]), CAST(:contents AS TEXT[]), CAST(:tokens AS INTEGER[]))
+                 WITH ORDINALITY AS m(flux, generation, role, subtype, content, tokens, n)
+            ORDER BY m.n
+            RETURNING id
+        """), {"sid": student_id, "scid": scenario_id,
+               "flux": [l["flux"] for l in lignes], "gens": [l.get("generation", 0) for l in lignes],
+               "roles": [l["role"] for l in lignes], "subtypes": [l.get("subtype") for l in lignes],
+               "contents": [l["content"] for l in lignes], "tokens": [l.get("tokens") for l in lignes]}
+        ).scalars().all()
+    return sorted(ids)  # BIGSERIAL attribué dans l'ordre de l'ORDER BY
+
+
+def retirer_message(engine, message_id: int):
+    """
+    Marque un message comme retiré (ex : message élève bloqué par la modération).
+    """
+    with engine.begin() as cn:
+        cn.execute(text("UPDATE conversation_messages SET retire = true WHERE id = :id"), {"id": message_id})
+
+
+def nouvelle_generation(engine, student_id: str, scenario_id, generation: int,
+                        messages: list[dict], tokens: list[int]) -> list[int]:
+    """
+    Écrit l'historique compacté dans une nouvelle génération du flux "history".
+    Retourne les ids des lignes insérées.
+    """
+    if not messages:
+        # génération vide : on la matérialise par une ligne retirée pour que MAX(generation) avance
+        messages, tokens, retirer = [{"role": "system", "content": ""}], [0], True
+    else:
+        retirer = False
+    with engine.begin() as cn:
+        ids = cn.execute(text("""
+            INSERT INTO conversation_messages (student_id, scenario_id, flux, generation, role, content, tokens, retire)
+            SELECT :sid, :scid, 'history', :gen, m.role, m.content, m.tokens, :retire
+            FROM unnest(CAST(:roles AS TEXT[]), CAST(:contents AS TEXT[]), CAST(:tokens AS INTEGER[]))
+                 WITH ORDINALITY AS m(role, content, tokens, n)
+            ORDER BY m.n
+            RETURNING id
+        """), {"sid": student_id, "scid": scenario_id, "gen": generation, "retire": retirer,
+               "roles": [m["role"] for m in messages], "contents": [m["content"] for m in messages],
+               "tokens": tokens}).scalars().all()
+    return [] if retirer else sorted(ids)
+
+
+def charger_transcription(engine, student_id: str, scenario_id) -> list[dict]:
+    """
+    Transcription (flux "cconv") d'un élève pour un scénario, dans l'ordre d'écriture.
+    Format identique à l'ancien session["cconv"] : {"role", "content"[, "subtype"]}.
+    """
+    with engine.connect() as cn:
+        rows = cn.execute(text("""
+            SELECT role, subtype, content
+            FROM conversation_messages
+            WHERE student_id = :sid AND scenario_id = :scid AND flux = 'cconv' AND NOT retire
+            ORDER BY id
+        """), {"sid": student_id, "scid": scenario_id}).mappings().all()
+
+    return [{"role": r["role"], "content": r["content"], **({"subtype": r["subtype"]} if r["subtype"] else {})}
+            for r in rows]
+
+
+def transcription_existe(engine, student_id: str, scenario_id) -> bool:
+    """
+    True si la transcription de l'élève pour ce scénario contient déjà au moins un message.
+    """
+    with engine.connect() as cn:
+        return bool(cn.scalar(text("""
+            SELECT 1 FROM conversation_messages
+            WHERE student_id = :sid AND scenario_id = :scid AND flux = 'cconv'
+            LIMIT 1
+        """), {"sid": student_id, "scid": scenario_id}))
+
+
+def supprimer_conversations(engine, student_id: str) -> int:
+    """
+    Supprime toutes les conversations d'un élève (droit à l'effacement). Retourne le nombre de lignes supprimées.
+    """
+    with engine.begin() as cn:
+        if not cn.scalar(text("SELECT to_regclass('conversation_messages') IS NOT NULL")):
+            return 0
+        return cn.execute(text("""
+            DELETE FROM conversation_messages WHERE student_id = :sid
+        """), {"sid": student_id}).rowcount
@@ -2,12 +2,13 @@
 Fonctions d'export LaTeX et texte brut pour les conversations assistant-élève.
 
 Ce module fournit :
-- la conversion des messages assistant/élève (cconv) en format LaTeX ou TXT
+- la conversion des messages assistant/élève (transcription stockée dans conversation_messages) en format LaTeX ou TXT
 - le nettoyage des caractères problématiques pour LaTeX
 - la normalisation des titres d'exercice
 - la découpe intelligente des messages en sections par exercice
 - la compilation automatique d'un fichier PDF via pdflatex
 - un fallback vers un fichier texte brut si la génération LaTeX échoue
+- les rapports de classe (txt / tex) produits par morceaux à partir de deux requêtes
 
 Les formats gérés :
 - `.pdf` (via LaTeX) avec math, code (`lstlisting`), titres, rôles
@@ -28,11 +29,15 @@ import tempfile
 import subprocess
 from io import StringIO
 from textwrap import indent
+from itertools import groupby
 from collections import defaultdict
 
 from flask import session, Response, send_file, current_app as app
 from sqlalchemy import text
 
+from utils.session_utils import get_scenario
+from utils.conversation_store import charger_transcription
+
 
 def normalize_quotes(text):
     """
@@ -341,20 +346,16 @@ def build_conversation_txt(engine):
     """
 
 
-    history = session.get("cconv", [])
+    history = charger_transcription(engine, session.get("student_id"), session.get("active_scenario_id"))
     if not history:
-        app.logger.warning("TXT : aucun historique dans cconv.")
+        app.logger.warning("TXT : aucune conversation enregistrée pour ce scénario.")
         return ""
 
     # Récupération des infos de contexte
     matiere = session.get("active_matiere", "Inconnue").capitalize()
-    scenario_id = session.get("active_scenario_id")
-    scenario_name = "Scénario en cours"
-
-    with engine.connect() as cn:
-        scenario_name = cn.scalar(text("""
-            SELECT name FROM scenarios WHERE id = :sid
-        """), {"sid": scenario_id}) or scenario_name
+    scenario = get_scenario(engine, session.get("active_scenario_id")) or {}
+    scenario_name = scenario.get("name") or "Scénario en cours"
+    map_json = scenario.get("MAP_JSON", {})
         
         
     # creation des sections
@@ -375,8 +376,8 @@ def build_conversation_txt(engine):
 
         # Injection automatique de l'énoncé si section = "Exercice X"
         ref = extract_ref_from_section_title(section)
-        if ref and ref in session.get("MAP_JSON", {}):
-            enonce = session["MAP_JSON"][ref].strip()
+        if ref and ref in map_json:
+            enonce = map_json[ref].strip()
             enonce = retirer_premiere_ligne_si_titre(enonce)
             output.write(indent(enonce, "    "))
             output.write("\n\n")
@@ -431,21 +432,18 @@ def build_conversation_pdf(engine):
     """
     
 
-    history = session.get("cconv", [])
+    history = charger_transcription(engine, session.get("student_id"), session.get("active_scenario_id"))
     if not history:
-        app.logger.warning("PDF : aucun historique dans cconv.")
+        app.logger.warning("PDF : aucune conversation enregistrée pour ce scénario.")
         return None
 
     # Informations de contexte
     matiere = session.get("active_matiere", "").capitalize()
-    scenario_id = session.get("active_scenario_id")
-    scenario_name = "Scénario en cours"
 
-    # Récupération du nom de la fiche
-    with engine.connect() as cn:
-        scenario_name = cn.scalar(text("""
-            SELECT name FROM scenarios WHERE id = :sid
-        """), {"sid": scenario_id}) or scenario_name
+    # Récupération du nom de la fiche et des énoncés (cache des scénarios)
+    scenario = get_scenario(engine, session.get("active_scenario_id")) or {}
+    scenario_name = scenario.get("name") or "Scénario en cours"
+    map_json = scenario.get("MAP_JSON", {})
 
     # Tri des messages par bloc d'exercice
     sections = decouper_conversation_par_exercice(history)
@@ -493,8 +491,8 @@ def build_conversation_pdf(engine):
 
         # Injection automatique de l'énoncé si section = "Exercice X"
         ref = extract_ref_from_section_title(section)
-        if ref and ref in session.get("MAP_JSON", {}): # si cest un exo de la fiche
-            enonce = session["MAP_JSON"][ref].strip()
+        if ref and ref in map_json: # si cest un exo de la fiche
+            enonce = map_json[ref].strip()
             enonce = retirer_premiere_ligne_si_titre(enonce)
             tex += format_content_latex(enonce) + "\n\n"
 
@@ -566,3 +564,114 @@ def build_conversation_pdf(engine):
             app.logger.warning(f"Erreur nettoyage : {e}")
 
 
+
+# ─────────── Rapports de classe (txt / tex / pdf) ────────────────────
+#
+# Toutes les tentatives et tous les feedbacks d'une classe pour un scénario sont lus en deux requêtes
+# (curseur serveur pour les tentatives), puis le document est produit morceau par morceau :
+# la mémoire reste constante quel que soit le nombre d'élèves.
+
+ENTETE_RAPPORT_TEX = r"""
+\documentclass{article}
+\usepackage[utf8]{inputenc}
+\usepackage{amssymb}
+\usepackage{pifont}
+\usepackage{geometry}
+\geometry{a4paper, margin=1in}
+\begin{document}
+
+\title{Résultats globaux \\ \textbf{Scénario : %s}}
+\date{}
+\maketitle
+"""
+
+
+def donnees_rapport_classe(engine, classe: str, scenario_id):
+    """
+    Parcourt les élèves de la classe (ordre alphabétique) avec leurs tentatives et leur feedback
+    pour le scénario. Deux requêtes au total ; les tentatives sont lues par paquets.
+
+    Génère des tuples (student_id, tentatives, feedback | None),
+    tentatives = [{"ordinal", "is_correct", "given_answer"}, ...] triées par exercice.
+    """
+    with engine.connect() as cn:
+        feedbacks = dict(cn.execute(text("""
+            SELECT DISTINCT ON (f.student_id) f.student_id, f.feedback
+            FROM feedbacks f
+            JOIN students st ON st.student_id = f.student_id
+            WHERE st.class = :cls
+              AND f.scenario_id = :scid
+            ORDER BY f.student_id, f.created_at DESC
+        """), {"cls": classe, "scid": scenario_id}).all())
+
+        rows = cn.execution_options(stream_results=True, yield_per=500).execute(text("""
+            SELECT st.student_id, t.ordinal, t.is_correct, t.given_answer
+            FROM students st
+            LEFT JOIN (
+                SELECT a.student_id, e.ordinal, a.is_correct, a.given_answer, a.ended_at
+                FROM attempts a
+                JOIN exercises e ON e.exercise_id = a.exercise_id
+                JOIN exercise_sets s ON s.set_id = e.set_id
+                WHERE s.scenario_id = :scid
+            ) t ON t.student_id = st.student_id
+            WHERE st.class = :cls
+            ORDER BY st.student_id, t.ordinal, t.ended_at
+        """), {"cls": classe, "scid": scenario_id}).mappings()
+
+        for sid, groupe in groupby(rows, key=lambda r: r["student_id"]):
+            tentatives = [
+                {"ordinal": r["ordinal"], "is_correct": r["is_correct"], "given_answer": r["given_answer"]}
+                for r in groupe if r["ordinal"] is not None
+            ]
+            yield sid, tentatives, feedbacks.get(sid)
+
+
+def _nom_scenario(engine, scenario_id) -> str:
+    scenario = get_scenario(engine, scenario_id) or {}
+    return scenario.get("name") or f"Scénario {scenario_id}"
+
+
+def rapport_classe_txt(engine, classe: str, scenario_id):
+    """
+    Rapport texte de la classe pour un scénario, produit élève par élève (générateur de morceaux).
+    """
+    scenario_name = _nom_scenario(engine, scenario_id)
+
+    for sid, exos, fb in donnees_rapport_classe(engine, classe, scenario_id):
+        morceaux = [f"Rapport élève : {sid}\n", f"Scénario : {scenario_name}\n\n"]
+
+        # Résultats par exercice
+        for exo in exos:
+            status = "✅ Réussi" if exo["is_correct"] else "❌ Échec"
+            answer = exo["given_answer"] or "(aucune réponse)"
+            morceaux.append(f"Exercice {exo['ordinal']} : {status} - Dernière réponse : \"{answer}\"\n")
+
+        # Feedback éventuel
+        if fb:
+            morceaux.append("\n📘 Feedback IA :\n" + fb.strip() + "\n")
+
+        morceaux.append("\n" + "-"*50 + "\n\n")
+        yield "".join(morceaux)
+
+
+def rapport_classe_tex(engine, classe: str, scenario_id):
+    """
+    Rapport LaTeX de la classe pour un scénario, produit élève par élève (générateur de morceaux).
+    """
+    yield ENTETE_RAPPORT_TEX % _nom_scenario(engine, scenario_id)
+
+    for sid, exos, fb in donnees_rapport_classe(engine, classe, scenario_id):
+        morceaux = [r"\section*{" + sid + "}\n\n"]
+
+        for exo in exos:
+            status = r"\ding{51} Réussi" if exo["is_correct"] else r"\ding{55} Échec"
+            answer = sanitize_tex(exo["given_answer"]) or "(aucune réponse)"
+            morceaux.append(f"Exercice {exo['ordinal']} : {status} -- Réponse : \"{answer}\"\n\n")
+
+        if fb:
+            morceaux.append(r"\ding{41} \textbf{Feedback IA :}" + "\n\n" + sanitize_tex(fb.strip()) + "\n\n")
+
+        morceaux.append(r"\bigskip\hrule\bigskip" + "\n\n")
+        yield "".join(morceaux)
+
+    yield r"\end{document}"
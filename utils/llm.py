@@ -3,8 +3,43 @@ llm.py — Interface centralisée pour l'utilisation des modèles OpenAI dans le
 
 Ce module fournit des fonctions pour interagir avec l'API OpenAI :
 - Génération de corrections et explications avec une température basse (réponses fiables et rigoureuses)
+- Variante en streaming (token par token) des corrections, pour l'affichage progressif côté élève
 - Génération de feedbacks finaux avec une température plus élevée (réponses nuancées et variées)
-- Modération des messages entrants pour vérifier leur conformité
+- Modération des messages entrants pour vérifier leur conformité (verdicts mis en cache par empreinte du texte)
+- Routage des corrections (modèle, température, max_tokens) selon le niveau, la catégorie
+  et la longueur de l'historique, avec métriques de latence et de tokens par route
+- Cache des corrections de premier tour, clé (scénario, exercice, réponse normalisée)
+- Résumé de l'historique préparé en arrière-plan (seuil bas), substitué sans attente au seuil haut ;
+  en mode glissant, les derniers tours restent mot pour mot et seuls les plus anciens sont intégrés
+  au résumé courant (chaque appel ne couvre que le delta)
+- Alternative sans appel LLM : fenêtre glissante (prompt du scénario + énoncé courant + derniers tours
+  tenant dans un budget de tokens), sélectionnable par classe ou par scénario
+- Signalement de chaque appel (LLM, modération, hits de cache) aux observateurs d'usage
+  (modèle, tokens, latence, contexte classe / scénario / exercice), cf. utils/telemetry_utils.py
+- Appels synchrones (client `OpenAI`) : le thread du worker WSGI est occupé pendant toute la durée
+  de l'appel, streaming compris (borné par LLM_TIMEOUT_S par requête HTTP, nouvelles tentatives
+  du client en plus) ; la capacité se règle par le nombre de workers / threads gunicorn.
+  Seuls les appels dont la vue n'attend pas le résultat tout de suite (résumé préparé à l'avance,
+  modération du message élève pendant la complétion) passent par un petit pool de threads.
+
+Variables d'environnement :
+    LLM_TIMEOUT_S (float)           — délai maximal d'une requête HTTP vers OpenAI, streaming compris (défaut : 60)
+    LLM_TACHES_FOND (int)           — nombre de threads du pool d'arrière-plan, par worker (défaut : 8)
+    CORRECTION_CACHE_SIZE (int)     — nombre maximal de corrections mémorisées (défaut : 2000)
+    CORRECTION_CACHE_TTL (int)      — durée de vie d'une correction mémorisée, en secondes (défaut : 3600)
+    MODERATION_CACHE_SIZE (int)     — nombre maximal de verdicts de modération mémorisés (défaut : 5000)
+    MODERATION_CACHE_TTL (int)      — durée de vie d'un verdict de modération, en secondes (défaut : 86400)
+    ROUTAGE_CORRECTION (json)       — remplace la table ROUTAGE_CORRECTION (liste de routes, même format ;
+                                      valeur invalide ignorée, avec une erreur dans les logs)
+    RATIO_PRE_RESUME (float)        — fraction du seuil de résumé à partir de laquelle le résumé est
+                                      préparé en arrière-plan (défaut : 0.7)
+    RESUME_MODE (str)               — "glissant" : seuls les anciens échanges sont intégrés au résumé courant,
+                                      les derniers tours restent mot pour mot ; "complet" : tout l'historique
+                                      est résumé (défaut : glissant)
+    RESUME_TOURS_CONSERVES (int)    — nombre de tours élève gardés mot pour mot en mode glissant (défaut : 4)
+    STRATEGIE_COMPACTION (json)     — stratégie de compaction de l'historique par classe / scénario, ex :
+                                      {"defaut": "resume", "classes": {"TSTI2B": "fenetre"}, "scenarios": {"12": "fenetre"}}
+    FENETRE_RATIO (float)           — taille de la fenêtre glissante, en fraction du seuil de résumé (défaut : 0.6)
 
 Paramètre important :
     temperature (float) — Contrôle la créativité des réponses générées :
@@ -16,11 +51,29 @@ Paramètre important :
 
 
 import os
+import re
+import json
+import time
+import logging
+import hashlib
+import threading
+import concurrent.futures
+import unicodedata
+import contextvars
+from collections import defaultdict
+from functools import lru_cache
 from openai import OpenAI
 import tiktoken
 
+from utils.cache_utils import TTLCache
+
+
+logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "60"))
+LLM_TACHES_FOND = int(os.getenv("LLM_TACHES_FOND", "8"))
+
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=LLM_TIMEOUT_S)
 
 
 
@@ -34,6 +87,12 @@ TEMPERATURE_RESUME=0
 
 MAX_RESUME_TOKENS = 8000
 TOKEN_USAGE_RATIO_BEFORE_SUMMARIZE = 0.5  # 50% de la limite
+RATIO_PRE_RESUME = float(os.getenv("RATIO_PRE_RESUME", "0.7"))  # résumé préparé en arrière-plan à 70% du seuil
+RESUME_MODE = os.getenv("RESUME_MODE", "glissant")                # "glissant" (incrémental) ou "complet"
+RESUME_TOURS_CONSERVES = int(os.getenv("RESUME_TOURS_CONSERVES", "4"))  # tours gardés mot pour mot (mode glissant)
+PREFIXE_RESUME = "📝 Résumé des échanges précédents :\n"
+FENETRE_RATIO = float(os.getenv("FENETRE_RATIO", "0.6"))  # budget de la fenêtre glissante, en fraction du seuil
+PREFIXE_ENONCE = "📌 Exercice en cours :\n\n"
 MAX_TOKENS_BY_MODEL = {
     "gpt-4": 8192,
     "gpt-4-0613": 8192,
@@ -45,10 +104,171 @@ MAX_TOKENS_BY_MODEL = {
     "gpt-3.5-turbo-16k": 16384
 }
 
+# Routage des corrections : la première route dont toutes les conditions sont vérifiées est utilisée.
+# Conditions possibles (toutes facultatives) :
+#   niveau_max      — niveau de l'exercice ([niveau N]) inférieur ou égal
+#   niveau_min      — niveau de l'exercice supérieur ou égal
+#   categories      — liste de catégories d'exercice (comparaison insensible à la casse)
+#   historique_min  — tokens de l'historique supérieurs ou égaux
+# Paramètres : model, temperature, max_tokens (None = pas de limite)
+# ⚠️ Une réponse coupée par max_tokens peut perdre la ligne « EXERCICE TERMINE : ✅ » : aucune limite
+# par défaut ; les réponses tronquées sont comptées par route (cf. `stats_routes`).
+ROUTAGE_CORRECTION = [
+    {"nom": "historique_long", "historique_min": 6000,
+     "model": "gpt-4.1", "temperature": TEMPERATURE_CORRECTION, "max_tokens": None},
+    {"nom": "niveau_1", "niveau_max": 1,
+     "model": "gpt-4o-mini", "temperature": TEMPERATURE_CORRECTION, "max_tokens": None},
+    {"nom": "niveau_2", "niveau_max": 2,
+     "model": MODEL_CORRECTION, "temperature": TEMPERATURE_CORRECTION, "max_tokens": None},
+    {"nom": "niveau_3_plus", "niveau_min": 3,
+     "model": "gpt-4.1", "temperature": TEMPERATURE_CORRECTION, "max_tokens": None},
+]
+
+
+def json_env(nom: str, defaut, valider):
+    """
+    Lit une variable d'environnement JSON ; `defaut` si elle est absente, illisible
+    ou refusée par `valider(valeur) -> bool` (erreur dans les logs, jamais d'échec au chargement).
+    """
+    brut = os.getenv(nom)
+    if not brut:
+        return defaut
+    try:
+        valeur = json.loads(brut)
+        if valider(valeur):
+            return valeur
+    except (ValueError, TypeError, KeyError, AttributeError):
+        pass
+    logger.error(f"❌ Variable {nom} invalide : valeur par défaut conservée.")
+    return defaut
+
+
+def route_valide(route) -> bool:
+    """
+    Une route doit au moins donner le modèle (str) et la température (nombre).
+    """
+    return (isinstance(route, dict) and isinstance(route.get("model"), str)
+            and isinstance(route.get("temperature"), (int, float))
+            and isinstance(route.get("max_tokens"), (int, type(None))))
+
+
+ROUTAGE_CORRECTION = json_env("ROUTAGE_CORRECTION", ROUTAGE_CORRECTION,
+                              lambda v: isinstance(v, list) and v and all(route_valide(r) for r in v))
+
+# Compaction de l'historique : "resume" (LLM, cf. RESUME_MODE) ou "fenetre" (troncature, aucun appel LLM).
+# Priorité : scénario, puis classe, puis défaut.
+STRATEGIES_COMPACTION = ("resume", "fenetre")
+STRATEGIE_COMPACTION = {"defaut": "resume", "classes": {}, "scenarios": {}}
+STRATEGIE_COMPACTION.update(json_env("STRATEGIE_COMPACTION", {}, lambda v: isinstance(v, dict)))
+
+ROUTE_PAR_DEFAUT = {"nom": "defaut", "model": MODEL_CORRECTION,
+                    "temperature": TEMPERATURE_CORRECTION, "max_tokens": None}
+
+
+
+
+# ─────────── Observateurs d'usage ────────────────────────────────────
+#
+# Chaque appel (LLM, modération, hit de cache) est signalé aux observateurs enregistrés
+# (ex : télémétrie en base). Le contexte du tour (classe, scénario, exercice) est porté par
+# `contexte_usage`, renseigné par l'application et propagé jusqu'aux tâches d'arrière-plan.
+
+MODEL_MODERATION = "text-moderation-latest"
+
+contexte_usage = contextvars.ContextVar("contexte_usage", default={})
+_observateurs_usage = []
+
+
+def ajouter_observateur_usage(fonction):
+    """
+    Enregistre `fonction(ligne: dict)`, appelée pour chaque appel signalé par `signaler_usage`.
+    L'observateur doit être rapide et non bloquant (il s'exécute sur le chemin de la requête).
+    """
+    _observateurs_usage.append(fonction)
+
+
+def signaler_usage(type_appel: str, model: str | None, latence_s: float = 0.0, usage=None,
+                   cache_hit: bool = False, erreur: bool = False):
+    """
+    Transmet un appel aux observateurs d'usage.
+
+    Args:
+        type_appel (str): "correction", "feedback", "resume", "moderation"…
+        model (str | None): Modèle appelé
+        latence_s (float): Durée de l'appel en secondes (0 pour un hit de cache)
+        usage: Objet `usage` OpenAI ou dict prompt_tokens / completion_tokens
+        cache_hit (bool): Réponse servie par un cache, sans appel à l'API
+        erreur (bool): L'appel a échoué
+    """
+    if not _observateurs_usage:
+        return
+    if isinstance(usage, dict):
+        prompt, completion_ = usage.get("prompt_tokens"), usage.get("completion_tokens")
+    else:
+        prompt = getattr(usage, "prompt_tokens", None)
+        completion_ = getattr(usage, "completion_tokens", None)
+
+    ligne = {
+        **contexte_usage.get(),
+        "type_appel": type_appel,
+        "model": model,
+        "prompt_tokens": prompt,
+        "completion_tokens": completion_,
+        "latency_ms": int(latence_s * 1000),
+        "cache_hit": cache_hit,
+        "erreur": erreur,
+    }
+    for observateur in _observateurs_usage:
+        try:
+            observateur(ligne)
+        except Exception:
+            pass  # la télémétrie ne doit jamais faire échouer un appel
+
+
+# ─────────── Tâches d'arrière-plan ───────────────────────────────────
 
+_pool_llm = None
+_verrou_pool = threading.Lock()
 
 
-def call_llm(messages, user_id=None, model="gpt-4o", temperature=0.5):
+def pool_llm() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Renvoie le pool de threads des appels LLM d'arrière-plan (LLM_TACHES_FOND threads au plus).
+
+    Le pool est créé au premier appel (donc après le fork des workers, jamais au chargement du module).
+    """
+    global _pool_llm
+    with _verrou_pool:
+        if _pool_llm is None:
+            _pool_llm = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_TACHES_FOND,
+                                                              thread_name_prefix="llm-fond")
+    return _pool_llm
+
+
+def soumettre(fonction, *args, **kwargs) -> concurrent.futures.Future:
+    """
+    Exécute `fonction(*args, **kwargs)` dans le pool d'arrière-plan sans attendre son résultat
+    (résumé préparé à l'avance, modération du message élève pendant la complétion).
+
+    Le contexte d'usage de l'appelant (`contexte_usage`) est transmis à la tâche.
+    """
+    return pool_llm().submit(contextvars.copy_context().run, fonction, *args, **kwargs)
+
+
+def parametres_completion(messages, user_id, model, temperature, max_tokens=None) -> dict:
+    """
+    Paramètres communs des appels `chat.completions.create` (max_tokens omis si None).
+    """
+    params = {"model": model, "messages": messages, "user": user_id, "temperature": temperature}
+    if max_tokens:
+        params["max_tokens"] = max_tokens
+    return params
+
+
+# ─────────── Appels synchrones ───────────────────────────────────────
+
+
+def call_llm(messages, user_id=None, model="gpt-4o", temperature=0.5, type_appel="llm"):
     """
     Appel générique à l'API OpenAI ChatCompletion.
 
@@ -61,16 +281,156 @@ def call_llm(messages, user_id=None, model="gpt-4o", temperature=0.5):
     Returns:
         str: Contenu textuel de la réponse générée par l'IA
     """
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        user=user_id,
-        temperature=temperature
-    )
-    return response.choices[0].message.content
+    return completion(messages, user_id=user_id, model=model, temperature=temperature,
+                      type_appel=type_appel).choices[0].message.content
+
+
+def completion(messages, user_id=None, model="gpt-4o", temperature=0.5, max_tokens=None, type_appel="llm"):
+    """
+    Appel brut à l'API ChatCompletion : renvoie la réponse complète (texte et `usage`).
+    L'appel est signalé aux observateurs d'usage sous le type `type_appel`.
+    """
+    debut = time.perf_counter()
+    try:
+        response = client.chat.completions.create(
+            **parametres_completion(messages, user_id, model, temperature, max_tokens)
+        )
+    except Exception:
+        signaler_usage(type_appel, model, time.perf_counter() - debut, erreur=True)
+        raise
+    signaler_usage(type_appel, model, time.perf_counter() - debut, response.usage)
+    return response
+
+
+def call_llm_stream(messages, user_id=None, model="gpt-4o", temperature=0.5, max_tokens=None, usage=None,
+                    type_appel="llm"):
+    """
+    Variante en streaming de `call_llm` : les tokens sont renvoyés au fur et à mesure.
 
+    Args:
+        messages (list): Historique des messages au format OpenAI
+        user_id (str): ID de l'utilisateur, transmis pour le suivi par OpenAI
+        model (str): Nom du modèle à utiliser
+        temperature (float): Contrôle la créativité de la réponse
+        max_tokens (int | None): Limite de tokens générés (None = pas de limite)
+        usage (dict | None): Si fourni, rempli en fin de flux avec prompt_tokens / completion_tokens
+                             et finish_reason ("length" : réponse coupée par max_tokens)
+        type_appel (str): Type signalé aux observateurs d'usage en fin de flux
 
-def correction_et_explication(messages, user_id):
+    Yields:
+        str: Fragments successifs du texte généré (les fragments vides sont ignorés)
+    """
+    usage = {} if usage is None else usage
+    debut = time.perf_counter()
+    try:
+        stream = client.chat.completions.create(
+            **parametres_completion(messages, user_id, model, temperature, max_tokens),
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage["prompt_tokens"] = chunk.usage.prompt_tokens
+                usage["completion_tokens"] = chunk.usage.completion_tokens
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason:
+                usage["finish_reason"] = chunk.choices[0].finish_reason
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    except Exception:
+        signaler_usage(type_appel, model, time.perf_counter() - debut, usage, erreur=True)
+        raise
+    signaler_usage(type_appel, model, time.perf_counter() - debut, usage)
+
+
+# ─────────── Routage des corrections ─────────────────────────────────
+
+_metriques_routes = defaultdict(lambda: {
+    "appels": 0, "erreurs": 0, "tronquees": 0, "latence_totale_s": 0.0, "latence_max_s": 0.0,
+    "prompt_tokens": 0, "completion_tokens": 0
+})
+_verrou_metriques = threading.Lock()
+
+
+def choisir_route(niveau: int = 1, categorie: str | None = None, tokens_historique: int = 0) -> dict:
+    """
+    Choisit la route de correction (modèle, température, max_tokens) dans ROUTAGE_CORRECTION.
+
+    Args:
+        niveau (int): Niveau de l'exercice (tag [niveau N], cf. `extract_niveau`).
+        categorie (str | None): Catégorie de l'exercice (CAT_JSON).
+        tokens_historique (int): Taille actuelle de l'historique en tokens.
+
+    Returns:
+        dict: Première route dont toutes les conditions sont vérifiées, sinon ROUTE_PAR_DEFAUT.
+    """
+    cat = (categorie or "").casefold()
+    for route in ROUTAGE_CORRECTION:
+        if "niveau_max" in route and niveau > route["niveau_max"]:
+            continue
+        if "niveau_min" in route and niveau < route["niveau_min"]:
+            continue
+        if "historique_min" in route and tokens_historique < route["historique_min"]:
+            continue
+        if "categories" in route and cat not in {c.casefold() for c in route["categories"]}:
+            continue
+        return route
+    return ROUTE_PAR_DEFAUT
+
+
+def enregistrer_metrique_route(route: dict, latence_s: float, usage=None, erreur: bool = False,
+                               finish_reason: str | None = None):
+    """
+    Ajoute un appel aux métriques de la route : latence et tokens (objet `usage` OpenAI ou dict).
+    finish_reason == "length" : réponse coupée par max_tokens (comptée et signalée dans les logs).
+    """
+    tronquee = finish_reason == "length"
+    if tronquee:
+        logger.warning(f"⚠️ Correction tronquée par max_tokens={route.get('max_tokens')} "
+                       f"(route {route.get('nom', route['model'])})")
+    if isinstance(usage, dict):
+        prompt, completion_ = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    else:
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        completion_ = getattr(usage, "completion_tokens", 0) or 0
+
+    with _verrou_metriques:
+        m = _metriques_routes[route.get("nom", route["model"])]
+        m["appels"] += 1
+        m["erreurs"] += int(erreur)
+        m["tronquees"] += int(tronquee)
+        m["latence_totale_s"] += latence_s
+        m["latence_max_s"] = max(m["latence_max_s"], latence_s)
+        m["prompt_tokens"] += prompt
+        m["completion_tokens"] += completion_
+
+
+def stats_routes() -> list[dict]:
+    """
+    Renvoie les métriques cumulées par route (appels, latence moyenne/max, tokens moyens).
+    """
+    routes = {r.get("nom", r["model"]): r for r in ROUTAGE_CORRECTION + [ROUTE_PAR_DEFAUT]}
+    stats = []
+    with _verrou_metriques:
+        for nom, m in _metriques_routes.items():
+            n = m["appels"] or 1
+            stats.append({
+                "route": nom,
+                "model": routes.get(nom, {}).get("model"),
+                "appels": m["appels"],
+                "erreurs": m["erreurs"],
+                "tronquees": m["tronquees"],
+                "latence_moy_s": round(m["latence_totale_s"] / n, 3),
+                "latence_max_s": round(m["latence_max_s"], 3),
+                "prompt_tokens_moy": round(m["prompt_tokens"] / n),
+                "completion_tokens_moy": round(m["completion_tokens"] / n),
+            })
+    return stats
+
+
+def correction_et_explication(messages, user_id, route=None):
     """
     Génère une réponse rigoureuse à une question d'élève, avec explication et correction éventuelle.
 
@@ -79,11 +439,140 @@ def correction_et_explication(messages, user_id):
     Args:
         messages (list): Historique des échanges avec l'élève
         user_id (str): Identifiant unique de l'élève
+        route (dict | None): Route choisie par `choisir_route` (ROUTE_PAR_DEFAUT si None)
 
     Returns:
         str: Réponse générée par l'IA
     """
-    return call_llm(messages, user_id=user_id, model=MODEL_CORRECTION,temperature=TEMPERATURE_CORRECTION)
+    route = route or ROUTE_PAR_DEFAUT
+    debut = time.perf_counter()
+    try:
+        response = completion(messages, user_id=user_id, model=route["model"],
+                              temperature=route["temperature"], max_tokens=route.get("max_tokens"),
+                              type_appel="correction")
+    except Exception:
+        enregistrer_metrique_route(route, time.perf_counter() - debut, erreur=True)
+        raise
+    enregistrer_metrique_route(route, time.perf_counter() - debut, response.usage,
+                               finish_reason=response.choices[0].finish_reason)
+    return response.choices[0].message.content
+
+def correction_et_explication_stream(messages, user_id, route=None):
+    """
+    Version streaming de `correction_et_explication` (même routage, mêmes métriques).
+
+    Args:
+        messages (list): Historique des échanges avec l'élève
+        user_id (str): Identifiant unique de l'élève
+        route (dict | None): Route choisie par `choisir_route` (ROUTE_PAR_DEFAUT si None)
+
+    Yields:
+        str: Fragments de la réponse générée par l'IA
+    """
+    route = route or ROUTE_PAR_DEFAUT
+    usage = {}
+    debut = time.perf_counter()
+    try:
+        yield from call_llm_stream(messages, user_id=user_id, model=route["model"],
+                                   temperature=route["temperature"], max_tokens=route.get("max_tokens"),
+                                   usage=usage, type_appel="correction")
+    except Exception:
+        enregistrer_metrique_route(route, time.perf_counter() - debut, erreur=True)
+        raise
+    enregistrer_metrique_route(route, time.perf_counter() - debut, usage, finish_reason=usage.get("finish_reason"))
+
+# ─────────── Cache des corrections ───────────────────────────────────
+#
+# Corrections à TEMPERATURE_CORRECTION basse : pour un même exercice, une même réponse
+# donne quasiment la même correction. On ne met en cache que le premier tour sur un
+# exercice, le seul où l'historique ne change pas la réponse attendue.
+# Le contexte propre à l'élève qui entre dans la requête (exercices restants, verdict local) fait
+# partie de la clé ; le temps écoulé n'est pas transmis au LLM sur ces tours.
+# Une correction n'est mémorisée (`memoriser_correction`) qu'après le passage de la modération.
+
+correction_cache = TTLCache(
+    maxsize=int(os.getenv("CORRECTION_CACHE_SIZE", "2000")),
+    ttl=int(os.getenv("CORRECTION_CACHE_TTL", "3600")),
+    name="corrections"
+)
+
+
+def normaliser_reponse(reponse: str) -> str:
+    """
+    Normalise une réponse d'élève pour la clé du cache :
+    unicode NFKC, casse ignorée, espaces regroupés (supprimés autour des opérateurs),
+    ponctuation finale retirée.
+
+    Exemple : "  Y = 3x + 2 ." → "y=3x+2"
+    """
+    txt = unicodedata.normalize("NFKC", reponse or "").casefold().strip()
+    txt = re.sub(r"\s+", " ", txt)
+    txt = re.sub(r"\s*([=+\-*/^<>(),;:])\s*", r"\1", txt)
+    return txt.rstrip(" .!?")
+
+
+def correction_cache_key(scenario_id, exo_courant, reponse: str, contexte: tuple = ()) -> tuple:
+    """
+    Clé du cache de corrections : (scenario_id, exercice courant, réponse normalisée, contexte de l'élève).
+    `contexte` : valeurs propres à l'élève présentes dans la requête (ex : verdict, exercices restants).
+    """
+    return (str(scenario_id), int(exo_courant), normaliser_reponse(reponse), tuple(contexte))
+
+
+def memoriser_correction(cle, reply: str):
+    """
+    Mémorise une correction, une fois la réponse validée par la modération (rien si cle est None).
+    """
+    if cle is not None and reply:
+        correction_cache.set(cle, reply)
+
+
+def invalider_cache_corrections(scenario_ids) -> int:
+    """
+    Supprime les corrections mémorisées des scénarios donnés (ré-import ou suppression).
+    Retourne le nombre d'entrées supprimées.
+    """
+    ids = {str(sid) for sid in scenario_ids}
+    return correction_cache.invalidate(lambda key: key[0] in ids)
+
+
+def correction_et_explication_cachee(messages, user_id, cle=None, route=None):
+    """
+    `correction_et_explication` précédée d'une lecture du cache de corrections.
+    La réponse générée n'est pas mémorisée ici : cf. `memoriser_correction`, après modération.
+
+    Args:
+        messages (list): Requête assemblée pour le LLM
+        user_id (str): Identifiant unique de l'élève
+        cle (tuple | None): Clé `correction_cache_key(...)`, ou None si le tour n'est pas cachable
+        route (dict | None): Route de correction (cf. `choisir_route`)
+
+    Returns:
+        str: Réponse (mémorisée ou générée par l'IA)
+    """
+    if cle is not None:
+        reply = correction_cache.get(cle)
+        if reply is not None:
+            signaler_usage("correction", (route or ROUTE_PAR_DEFAUT)["model"], cache_hit=True)
+            return reply
+
+    return correction_et_explication(messages, user_id, route=route)
+
+
+def correction_et_explication_stream_cachee(messages, user_id, cle=None, route=None):
+    """
+    Variante streaming de `correction_et_explication_cachee` :
+    en cas de hit, la correction mémorisée est renvoyée en un seul fragment.
+    """
+    if cle is not None:
+        reply = correction_cache.get(cle)
+        if reply is not None:
+            signaler_usage("correction", (route or ROUTE_PAR_DEFAUT)["model"], cache_hit=True)
+            yield reply
+            return
+
+    yield from correction_et_explication_stream(messages, user_id, route=route)
+
 
 def feedback_final(messages, user_id):
     """
@@ -98,10 +587,61 @@ def feedback_final(messages, user_id):
     Returns:
         str: Feedback final
     """
-    return call_llm(messages, user_id=user_id, model=MODEL_FEEDBACK,temperature=TEMPERATURE_FEEDBACK)
+    return call_llm(messages, user_id=user_id, model=MODEL_FEEDBACK,temperature=TEMPERATURE_FEEDBACK,
+                    type_appel="feedback")
+
+
+# ─────────── Cache de modération ─────────────────────────────────────
+#
+# Les élèves renvoient souvent les mêmes messages courts (« ex2 », « oui », « je ne sais pas »…) :
+# leur verdict de modération est mémorisé par empreinte SHA-256 du contenu exact.
+
+moderation_cache = TTLCache(
+    maxsize=int(os.getenv("MODERATION_CACHE_SIZE", "5000")),
+    ttl=int(os.getenv("MODERATION_CACHE_TTL", "86400")),
+    name="moderation"
+)
+
+
+def moderation_cache_key(texte: str) -> str:
+    """
+    Clé du cache de modération : empreinte SHA-256 du texte (aucun contenu élève conservé en clair dans la clé).
+    """
+    return hashlib.sha256((texte or "").encode("utf-8")).hexdigest()
+
+
+def lire_cache_moderation(inputs: list[str], cacheable: list[bool] | None = None):
+    """
+    Cherche chaque texte dans le cache de modération.
+
+    Returns:
+        tuple: (resultats, cles, manquants)
+        - resultats : verdicts trouvés (None pour les textes à envoyer à l'API)
+        - cles : clé de cache de chaque texte (None si cache refusé)
+        - manquants : indices des textes à envoyer à l'API
+    """
+    if cacheable is None:
+        cacheable = [True] * len(inputs)
+    cles = [moderation_cache_key(t) if ok else None for t, ok in zip(inputs, cacheable)]
+    resultats = [moderation_cache.get(c) if c else None for c in cles]
+    manquants = [i for i, r in enumerate(resultats) if r is None]
+    for _ in range(len(inputs) - len(manquants)):
+        signaler_usage("moderation", MODEL_MODERATION, cache_hit=True)
+    return resultats, cles, manquants
 
 
-def moderation_par_llm(user_input):
+def completer_cache_moderation(resultats, cles, manquants, flags) -> list[dict]:
+    """
+    Insère les verdicts renvoyés par l'API dans `resultats` et dans le cache (jamais les erreurs).
+    """
+    for i, f in zip(manquants, flags):
+        resultats[i] = f
+        if cles[i] and not f.get("error"):
+            moderation_cache.set(cles[i], f)
+    return [dict(r) for r in resultats]
+
+
+def moderation_par_llm(user_input, cacheable=True):
     """
     Analyse un message (provenant d’un utilisateur ou de l’IA) pour détecter des contenus sensibles ou inappropriés.
 
@@ -132,24 +672,87 @@ def moderation_par_llm(user_input):
         - Ce dictionnaire correspond à `response.results[0].categories` de l’API OpenAI Moderation.
         - La structure peut évoluer si OpenAI modifie ou ajoute des catégories.
         - Ce système peut être utilisé pour filtrer les messages entrants et sortants.
+        - Le verdict est mis en cache par empreinte SHA-256 du texte, sauf si `cacheable=False`
+          (à utiliser pour les textes contenant une réponse générée par l'IA).
+    """
+    return moderation_batch([user_input], [cacheable])[0]
+
+
+def moderation_batch(inputs: list[str], cacheable: list[bool] | None = None) -> list[dict]:
+    """
+    Modère plusieurs textes en un seul aller-retour vers l'API de modération.
+
+    Les textes déjà présents dans le cache de modération ne sont pas renvoyés à l'API.
+
+    Args:
+        inputs (list[str]): Textes à analyser (ex : [message élève, message élève + réponse IA]).
+        cacheable (list[bool] | None): Pour chaque texte, autorise ou non le cache (tous par défaut).
+
+    Returns:
+        list[dict]: Catégories de chaque texte, dans le même ordre que `inputs`
+        (même format que `moderation_par_llm`, {"error": True} pour chaque texte en cas d'échec).
     """
+    resultats, cles, manquants = lire_cache_moderation(inputs, cacheable)
+    if not manquants:
+        return resultats
+
+    debut = time.perf_counter()
     try:
         response = client.moderations.create(
-            model="text-moderation-latest",
-            input=user_input
+            model=MODEL_MODERATION,
+            input=[inputs[i] for i in manquants]
         )
-        return response.results[0].categories.to_dict()
+        flags = [result.categories.to_dict() for result in response.results]
+        signaler_usage("moderation", MODEL_MODERATION, time.perf_counter() - debut)
 
     except Exception as e:
-        return {"error": True}
+        flags = [{"error": True} for _ in manquants]
+        signaler_usage("moderation", MODEL_MODERATION, time.perf_counter() - debut, erreur=True)
+
+    return completer_cache_moderation(resultats, cles, manquants, flags)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = MODEL_CORRECTION):
+    """
+    Renvoie l'encodeur `tiktoken` du modèle, mis en cache (une seule construction par modèle et par processus).
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_message_tokens(msg: dict, model: str = MODEL_CORRECTION) -> int:
+    """
+    Compte les tokens d'un seul message (overhead de 4 tokens par message compris).
+
+    Permet de tenir un compte incrémental : chaque message de l'historique
+    n'est encodé qu'une seule fois, au moment où il est ajouté.
+
+    Args:
+        msg (dict): Message au format OpenAI ({"role": ..., "content": ...}).
+        model (str): Nom du modèle utilisé (définit l'encodeur).
+
+    Returns:
+        int: Nombre de tokens du message.
+    """
+    encoding = get_encoding(model)
+    total = 4  # overhead par message
+    for key, value in msg.items():
+        total += len(encoding.encode(value))
+        if key == "name":
+            total += 1
+    return total
 
 
 def estimate_tokens(messages: list[dict], model: str = MODEL_CORRECTION) -> int:
     """
     Estime le nombre de tokens utilisés par une liste de messages pour un modèle donné.
 
-    Utilise la bibliothèque `tiktoken` si disponible pour un calcul précis,
-    sinon effectue une estimation simple en divisant la longueur du texte par 4.
+    Utilise la bibliothèque `tiktoken` (encodeur mis en cache par `get_encoding`).
+    Ré-encode toute la liste : à réserver aux recalculs complets, le suivi courant
+    de l'historique passant par `count_message_tokens`.
 
     Args:
         messages (list[dict]): Historique de la conversation (messages OpenAI).
@@ -158,23 +761,20 @@ def estimate_tokens(messages: list[dict], model: str = MODEL_CORRECTION) -> int:
     Returns:
         int: Nombre estimé de tokens utilisés.
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-
-    total = 0
-    for msg in messages:
-        total += 4  # overhead par message
-        for key, value in msg.items():
-            total += len(encoding.encode(value))
-            if key == "name":
-                total += 1
+    total = sum(count_message_tokens(msg, model=model) for msg in messages)
     total += 2  # overhead final
     return total
 
 
-def should_summarize(history: list[dict], model: str = MODEL_CORRECTION) -> bool:
+def seuil_resume(model: str = MODEL_CORRECTION) -> float:
+    """
+    Nombre de tokens d'historique au-delà duquel l'historique doit être résumé.
+    """
+    max_tokens = MAX_TOKENS_BY_MODEL.get(model, 8192)
+    return min(max_tokens * TOKEN_USAGE_RATIO_BEFORE_SUMMARIZE, MAX_RESUME_TOKENS)
+
+
+def should_summarize(history: list[dict], model: str = MODEL_CORRECTION, total_tokens: int | None = None) -> bool:
     """
     Détermine si l'historique est suffisamment long pour justifier un résumé.
 
@@ -184,13 +784,24 @@ def should_summarize(history: list[dict], model: str = MODEL_CORRECTION) -> bool
     Args:
         history (list[dict]): Historique actuel de la conversation.
         model (str): Modèle utilisé pour la correction (définit la limite de tokens).
+        total_tokens (int | None): Total déjà connu (compte incrémental) ; évite de ré-encoder l'historique.
 
     Returns:
         bool: True si un résumé est nécessaire, False sinon.
     """
-    max_tokens = MAX_TOKENS_BY_MODEL.get(model, 8192)
-    seuil = min(max_tokens * TOKEN_USAGE_RATIO_BEFORE_SUMMARIZE,MAX_RESUME_TOKENS)
-    return estimate_tokens(history, model=model) > seuil
+    if total_tokens is None:
+        total_tokens = estimate_tokens(history, model=model)
+    return total_tokens > seuil_resume(model)
+
+
+def should_presummarize(history: list[dict], model: str = MODEL_CORRECTION, total_tokens: int | None = None) -> bool:
+    """
+    Seuil bas : True si le résumé doit être préparé en arrière-plan (RATIO_PRE_RESUME × seuil de résumé),
+    pour être prêt lorsque `should_summarize` deviendra vrai.
+    """
+    if total_tokens is None:
+        total_tokens = estimate_tokens(history, model=model)
+    return total_tokens > RATIO_PRE_RESUME * seuil_resume(model)
 
 
 
@@ -207,11 +818,214 @@ def summarize_history(history: list[dict]) -> str:
     Returns:
         str: Résumé généré à insérer dans une nouvelle session condensée.
     """
-    prompt = [
+    return call_llm(prompt_resume(history), model=MODEL_RESUME,temperature=TEMPERATURE_RESUME,
+                    type_appel="resume").strip()
+
+
+def prompt_resume(history: list[dict]) -> list[dict]:
+    """
+    Requête de résumé : consigne système + historique + demande de résumé en 5 lignes.
+    """
+    return [
         {"role": "system", "content": "Tu es un assistant qui résume efficacement."},
         *history,
         {"role": "user", "content": "Fais un résumé concis de cette conversation en 5 lignes max."}
     ]
-    return call_llm(prompt, model=MODEL_RESUME,temperature=TEMPERATURE_RESUME).strip()
+
+
+def prompt_resume_incremental(resume_precedent: str | None, delta: list[dict]) -> list[dict]:
+    """
+    Requête de résumé glissant : résumé courant + échanges à intégrer (sans le prompt du scénario).
+    """
+    echanges = "\n".join(f"{m['role']} : {m['content']}" for m in delta)
+    return [
+        {"role": "system", "content": "Tu es un assistant qui tient à jour le résumé d'une conversation."},
+        {"role": "user", "content": (
+            f"Résumé actuel :\n{resume_precedent or '(aucun)'}\n\n"
+            f"Nouveaux échanges :\n{echanges}\n\n"
+            "Mets à jour le résumé en intégrant ces échanges, en 5 lignes max."
+        )}
+    ]
+
+
+def message_resume(summary: str) -> dict:
+    """
+    Message d'historique portant le résumé (reconnu par `decouper_historique` via PREFIXE_RESUME).
+    """
+    return {"role": "assistant", "content": PREFIXE_RESUME + summary}
+
+
+def decouper_historique(history: list[dict], tours_conserves: int = RESUME_TOURS_CONSERVES):
+    """
+    Découpe l'historique pour le résumé glissant.
+
+    Structure attendue : [prompt système, (résumé courant), échanges…]
+
+    Returns:
+        tuple: (resume_precedent, debut, coupe)
+        - resume_precedent : texte du résumé courant, ou None
+        - debut : indice du premier échange (après prompt système et résumé)
+        - coupe : indice du premier message conservé mot pour mot (début des `tours_conserves` derniers tours)
+    """
+    resume_precedent, debut = None, 1
+    if len(history) > 1 and history[1]["role"] == "assistant" and history[1]["content"].startswith(PREFIXE_RESUME):
+        resume_precedent, debut = history[1]["content"][len(PREFIXE_RESUME):], 2
+
+    tours = [i for i in range(debut, len(history)) if history[i]["role"] == "user"]
+    if tours_conserves <= 0:
+        coupe = len(history)
+    elif len(tours) >= tours_conserves:
+        coupe = tours[-tours_conserves]
+    else:
+        coupe = debut
+    return resume_precedent, debut, coupe
+
+
+def preparer_resume(history: list[dict], mode: str = RESUME_MODE):
+    """
+    Prépare un résumé selon le mode ("glissant" ou "complet").
+
+    Returns:
+        tuple | None: (requête LLM, coupe) — le résumé remplace history[1:coupe] —
+        ou None s'il n'y a rien à résumer.
+    """
+    if mode == "complet":
+        return prompt_resume(history), len(history)
+
+    resume_precedent, debut, coupe = decouper_historique(history)
+    if coupe <= debut:
+        # moins de RESUME_TOURS_CONSERVES tours mais seuil atteint (messages très longs) : seul le dernier est gardé
+        resume_precedent, debut, coupe = decouper_historique(history, tours_conserves=1)
+    if coupe <= debut:
+        return None
+    return prompt_resume_incremental(resume_precedent, history[debut:coupe]), coupe
+
+
+def resumer(prompt: list[dict]) -> str:
+    """
+    Exécute une requête de résumé (lancée en arrière-plan par `lancer_resume`).
+    """
+    return call_llm(prompt, model=MODEL_RESUME, temperature=TEMPERATURE_RESUME, type_appel="resume").strip()
+
+
+# ─────────── Fenêtre glissante (sans LLM) ────────────────────────────
+
+
+def strategie_compaction(class_name: str | None = None, scenario_id=None) -> str:
+    """
+    Stratégie de compaction de l'historique ("resume" ou "fenetre") pour un scénario / une classe,
+    d'après STRATEGIE_COMPACTION (scénario prioritaire sur la classe, puis valeur par défaut).
+    """
+    strategie = (STRATEGIE_COMPACTION.get("scenarios", {}).get(str(scenario_id))
+                 or STRATEGIE_COMPACTION.get("classes", {}).get(class_name)
+                 or STRATEGIE_COMPACTION.get("defaut", "resume"))
+    return strategie if strategie in STRATEGIES_COMPACTION else "resume"
+
+
+def tronquer_historique(history: list[dict], enonce: str | None = None, budget_tokens: int | None = None,
+                        model: str = MODEL_CORRECTION, tokens: list[int] | None = None) -> list[dict]:
+    """
+    Compaction sans appel LLM : garde le prompt du scénario, l'énoncé de l'exercice courant
+    et les derniers échanges qui tiennent dans le budget de tokens.
+
+    La fenêtre commence toujours sur un message élève (pas de réponse IA orpheline) ;
+    l'énoncé n'est réinjecté que s'il ne figure pas déjà dans les échanges conservés.
+
+    Args:
+        history (list[dict]): Historique complet (history[0] = prompt du scénario).
+        enonce (str | None): Énoncé de l'exercice courant (MAP_JSON[ref]).
+        budget_tokens (int | None): Budget total (défaut : FENETRE_RATIO × seuil de résumé).
+        model (str): Modèle de référence pour le comptage des tokens.
+        tokens (list[int] | None): Tokens de chaque message s'ils sont déjà connus (cf. session_utils.history_tokens).
+
+    Returns:
+        list[dict]: Nouvel historique.
+    """
+    if not history:
+        return []
+    if budget_tokens is None:
+        budget_tokens = int(FENETRE_RATIO * seuil_resume(model))
+    if tokens is None or len(tokens) != len(history):
+        tokens = [count_message_tokens(m, model=model) for m in history]
+
+    tete = [history[0]]
+    total = tokens[0] + 2
+    message_enonce = {"role": "assistant", "content": PREFIXE_ENONCE + enonce} if enonce else None
+    if message_enonce:
+        total += count_message_tokens(message_enonce, model=model)
+
+    debut = len(history)
+    while debut > 1 and total + tokens[debut - 1] <= budget_tokens:
+        debut -= 1
+        total += tokens[debut]
+    while debut < len(history) and history[debut]["role"] != "user":
+        debut += 1
+
+    fenetre = history[debut:]
+    if message_enonce and not any(enonce in m["content"] for m in fenetre):
+        tete.append(message_enonce)
+    return tete + fenetre
+
+
+# ─────────── Résumés en arrière-plan ─────────────────────────────────
+#
+# Au seuil bas (`should_presummarize`), le résumé de l'historique est lancé dans le pool d'arrière-plan ;
+# au seuil haut (`should_summarize`), la requête substitue le résumé s'il est prêt, sans jamais l'attendre.
+# Les travaux sont propres au worker : un autre worker relancera simplement le résumé.
+
+resumes_en_cours = TTLCache(maxsize=2000, ttl=900, name="resumes")
+
+
+def lancer_resume(cle, history: list[dict], mode: str = RESUME_MODE) -> bool:
+    """
+    Lance le résumé de `history` en arrière-plan, sauf s'il y en a déjà un pour `cle`.
+
+    Args:
+        cle: Identifiant de la conversation (ex : (student_id, scenario_id)).
+        history (list[dict]): Historique à résumer (copié : la session peut évoluer entre-temps).
+        mode (str): "glissant" ou "complet" (cf. RESUME_MODE).
+
+    Returns:
+        bool: True si un nouveau résumé a été lancé.
+    """
+    if resumes_en_cours.get(cle) is not None:
+        return False
+    prepare = preparer_resume(list(history), mode)
+    if prepare is None:
+        return False
+    prompt, coupe = prepare
+    resumes_en_cours.set(cle, {
+        "future": soumettre(resumer, prompt),
+        "n": coupe,
+        "dernier": history[coupe - 1] if coupe else None,
+    })
+    return True
+
+
+def resume_pret(cle, history: list[dict]):
+    """
+    Renvoie (résumé, n) si le résumé lancé pour `cle` est terminé et couvre toujours
+    les n premiers messages de `history`, sinon None (sans attendre).
+    Le nouvel historique est alors [prompt système, message_resume(résumé), *history[n:]].
+    Un résumé en échec ou devenu obsolète (historique remplacé entre-temps) est oublié.
+    """
+    travail = resumes_en_cours.get(cle)
+    if travail is None or not travail["future"].done():
+        return None
+
+    n = travail["n"]
+    valide = (travail["future"].exception() is None
+              and len(history) >= n and (n == 0 or history[n - 1] == travail["dernier"]))
+    if not valide:
+        oublier_resume(cle)
+        return None
+    return travail["future"].result(), n
+
+
+def oublier_resume(cle):
+    """
+    Supprime le travail de résumé associé à `cle` (après substitution ou s'il est obsolète).
+    """
+    resumes_en_cours.invalidate(lambda k: k == cle)
 
 
@@ -0,0 +1,113 @@
+"""
+log_writer.py — Écriture différée et groupée des logs WORM (chat_logs), chaînage SHA-256 calculé par la base.
+
+Le chaînage ne dépend plus de session["last_this_hash"] : deux onglets, une session réinitialisée ou
+deux requêtes simultanées d'un même élève ne peuvent plus créer de fourche dans la chaîne.
+La fonction SQL `ajouter_logs_chaines` (migrations/0004_chat_logs_chainage.sql, appliquée par le
+propriétaire de chat_logs) fait, en une seule instruction côté application :
+
+- verrous consultatifs de transaction des élèves du lot (pg_advisory_xact_lock), pris avant toute
+  écriture, une fois par élève et dans un ordre fixe (pas d'interblocage entre lots concurrents)
+- puis, pour chaque log dans l'ordre du lot :
+  - lecture du dernier this_hash de l'élève dans chat_logs (index chat_logs_user_ts_chain_idx,
+    (user_id, ts) INCLUDE (prev_hash, this_hash) : migrations/0005_chat_logs_index_chainage.sql)
+  - ts = horloge du serveur, strictement croissant par élève (ordre de vérification = ordre de la chaîne)
+  - this_hash = SHA-256(ts ISO 8601 UTC à la microseconde, élève, prompt, réponse, flags, modèle, prev_hash)
+  - INSERT de la ligne
+
+Le premier log d'un élève est chaîné sur le hash initial généré au consentement (students.last_this_hash,
+transmis depuis la session) ; students n'est plus mis à jour ensuite : chat_logs fait foi.
+
+Écriture différée (file + thread : utils/write_buffer.py) :
+- un lot part dès JOURNAL_TAILLE_LOT logs ou après JOURNAL_INTERVALLE_MS millisecondes ; un seul appel
+  de la fonction et un seul commit par lot
+- erreurs transitoires réessayées sans limite ; un log refusé par la base (donnée invalide…) est
+  isolé du lot, signalé en CRITICAL et mis à l'écart dans chat_logs_rejets
+  (migrations/0008_chat_logs_rejets.sql) : hors chaîne WORM, il est signalé par le tableau de bord
+  RGPD et couvert par la suppression d'un élève et la purge
+- à l'arrêt du processus (atexit) la file est vidée ; `vider_journal()` force l'écriture de ce qui attend
+- le hash d'un log n'est pas retourné à l'appelant : chat_logs fait foi
+
+Aucun DDL ici : le rôle de engine_log n'a besoin que de EXECUTE sur la fonction. Une migration
+non appliquée est signalée au démarrage (utils.migrations.verifier_schema).
+
+Variables d'environnement :
+    JOURNAL_ASYNCHRONE (0/1)      — écriture différée (défaut : 1) ; 0 = écriture immédiate, un lot par log
+    JOURNAL_TAILLE_LOT (int)      — nombre maximal de logs par lot (défaut : 100)
+    JOURNAL_INTERVALLE_MS (float) — délai maximal avant écriture d'un lot, en millisecondes (défaut : 5)
+"""
+
+import os
+import json
+
+from sqlalchemy import text
+
+from utils.write_buffer import EcritureDifferee, resume_erreur
+
+
+JOURNAL_ASYNCHRONE = os.getenv("JOURNAL_ASYNCHRONE", "1") == "1"
+TAILLE_LOT = int(os.getenv("JOURNAL_TAILLE_LOT", "100"))
+INTERVALLE = float(os.getenv("JOURNAL_INTERVALLE_MS", "5")) / 1000
+
+_engine_log = None
+
+
+def demarrer_journal(engine_log):
+    """
+    Associe le moteur utilisé pour l'écriture de chat_logs. Le thread d'écriture démarre au premier log.
+    """
+    global _engine_log
+    _engine_log = engine_log
+
+
+def journaliser(user_id, prompt, completion, flags, model, prev_initial=None) -> None:
+    """
+    Met un log en file d'écriture (le hash est calculé par la base à l'écriture, et n'est pas retourné).
+    prev_initial : hash initial de l'élève (consentement), utilisé seulement pour son premier log.
+    """
+    ligne = {"u": user_id, "p": prompt, "c": completion, "f": json.dumps(flags), "m": model,
+             "pi": prev_initial or ""}
+    if JOURNAL_ASYNCHRONE:
+        tampon_journal.ajouter(ligne)
+    else:
+        ecrire_lot(_engine_log, [ligne])
+
+
+def vider_journal(timeout: float = 10.0) -> bool:
+    """
+    Attend l'écriture de tous les logs mis en file avant l'appel (suppression d'un élève…).
+    Retourne False si le délai est dépassé.
+    """
+    return tampon_journal.vider(timeout)
+
+
+def mettre_a_l_ecart(engine_log, ligne: dict, erreur: Exception):
+    """
+    Conserve dans chat_logs_rejets un log que chat_logs a refusé (le JSON échappe tout caractère
+    non ASCII, y compris NUL, pour que la mise à l'écart ne soit pas refusée à son tour).
+    """
+    with engine_log.begin() as cn:
+        cn.execute(text("""
+            INSERT INTO chat_logs_rejets (user_id, ligne, erreur)
+            VALUES (:u, :ligne, :erreur)
+        """), {"u": ligne["u"], "ligne": json.dumps(ligne, ensure_ascii=True, default=str),
+               "erreur": resume_erreur(erreur)})
+
+
+def ecrire_lot(engine_log, lot: list[dict]) -> list[str]:
+    """
+    Insère un lot de logs dans chat_logs, chaînés par la base dans l'ordre du lot (un appel, un commit).
+    Retourne les this_hash dans le même ordre.
+    """
+    with engine_log.begin() as cn:
+        return cn.execute(text("""
+            SELECT hash FROM ajouter_logs_chaines(
+                CAST(:u AS TEXT[]), CAST(:p AS TEXT[]), CAST(:c AS TEXT[]),
+                CAST(:f AS TEXT[]), CAST(:m AS TEXT[]), CAST(:pi AS TEXT[])
+            )
+        """), {cle: [ligne[cle] for ligne in lot] for cle in ("u", "p", "c", "f", "m", "pi")}).scalars().all()
+
+
+tampon_journal = EcritureDifferee(lambda lot: ecrire_lot(_engine_log, lot),
+                                  "journal-worm", TAILLE_LOT, INTERVALLE,
+                                  rejeter=lambda ligne, erreur: mettre_a_l_ecart(_engine_log, ligne, erreur))
@@ -0,0 +1,209 @@
+"""
+session_backend.py — Backend de session serveur compact (fichiers msgpack, compressés, répartis en sous-dossiers).
+
+Remplace le backend "filesystem" de Flask-Session (pickle via cachelib, réécrit à chaque requête) :
+
+- sérialisation msgpack (msgspec, déjà utilisé par Flask-Session ≥ 0.7)
+- compression zlib au-delà de SESSION_COMPRESSION_SEUIL octets
+- écriture uniquement si le contenu a changé (empreinte BLAKE2 comparée à celle lue en début de requête) ;
+  sinon simple mise à jour de la date du fichier, qui sert d'expiration
+- fichiers répartis sur 2 niveaux de sous-dossiers (256 × 256) pour garder des répertoires courts
+- écriture atomique (fichier temporaire + os.replace)
+- métriques de taille par session (dernières tailles écrites, moyenne, p95, max, taux de compression)
+
+Format d'un fichier : 1 octet (0 = brut, 1 = zlib) + données msgpack.
+
+Configuration (app.config) :
+    SESSION_BACKEND             — "compact" (ce module) ou "filesystem" (Flask-Session)
+    SESSION_COMPACT_DIR         — dossier des sessions (distinct de celui du backend "filesystem")
+    SESSION_COMPRESSION_SEUIL   — taille (octets) à partir de laquelle la session est compressée
+    SESSION_TAILLE_ALERTE       — taille (octets) au-delà de laquelle un avertissement est journalisé
+    SESSION_CLEANUP_N_REQUESTS  — purge des sessions expirées en moyenne toutes les N requêtes
+"""
+
+import os
+import time
+import zlib
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from datetime import timedelta
+
+from flask_session.base import ServerSideSessionInterface
+from flask_session.defaults import Defaults
+
+
+BRUT = b"\x00"
+ZLIB = b"\x01"
+
+
+class CompactSessionInterface(ServerSideSessionInterface):
+    """
+    Sessions serveur stockées en fichiers msgpack compacts, écrites seulement si elles ont changé.
+    """
+
+    ttl = False  # expiration gérée ici (date du fichier), purge via SESSION_CLEANUP_N_REQUESTS
+
+    def __init__(self, app, cache_dir: str, seuil_compression: int = 4096, taille_alerte: int = 256 * 1024,
+                 key_prefix: str = Defaults.SESSION_KEY_PREFIX, use_signer: bool = Defaults.SESSION_USE_SIGNER,
+                 permanent: bool = Defaults.SESSION_PERMANENT, sid_length: int = Defaults.SESSION_ID_LENGTH,
+                 cleanup_n_requests: int | None = Defaults.SESSION_CLEANUP_N_REQUESTS):
+        self.cache_dir = cache_dir
+        self.seuil_compression = seuil_compression
+        self.taille_alerte = taille_alerte
+        self._local = threading.local()
+        self._verrou = threading.Lock()
+        self._tailles = deque(maxlen=1000)
+        self.ecritures = 0
+        self.ecritures_evitees = 0
+        self.compressees = 0
+        self.lectures = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        super().__init__(app, key_prefix, use_signer, permanent, sid_length, "msgpack", cleanup_n_requests)
+
+    @classmethod
+    def depuis_config(cls, app):
+        """
+        Construit l'interface à partir de app.config (mêmes clés que Flask-Session quand elles existent).
+        """
+        config = app.config
+        return cls(
+            app,
+            cache_dir=config.get("SESSION_COMPACT_DIR", os.path.join(os.getcwd(), "flask_session_compact")),
+            seuil_compression=config.get("SESSION_COMPRESSION_SEUIL", 4096),
+            taille_alerte=config.get("SESSION_TAILLE_ALERTE", 256 * 1024),
+            key_prefix=config.get("SESSION_KEY_PREFIX", Defaults.SESSION_KEY_PREFIX),
+            use_signer=config.get("SESSION_USE_SIGNER", Defaults.SESSION_USE_SIGNER),
+            permanent=config.get("SESSION_PERMANENT", Defaults.SESSION_PERMANENT),
+            sid_length=config.get("SESSION_ID_LENGTH", Defaults.SESSION_ID_LENGTH),
+            cleanup_n_requests=config.get("SESSION_CLEANUP_N_REQUESTS", Defaults.SESSION_CLEANUP_N_REQUESTS),
+        )
+
+    # ─────────── fichiers ────────────────────────────────────────────
+
+    def _chemin(self, store_id: str) -> str:
+        """
+        Chemin du fichier de session : <dir>/ab/cd/<empreinte de store_id>.
+        """
+        nom = hashlib.blake2b(store_id.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, nom[:2], nom[2:4], nom)
+
+    def _duree_vie(self) -> float:
+        duree = self.app.permanent_session_lifetime
+        return duree.total_seconds() if isinstance(duree, timedelta) else float(duree)
+
+    @staticmethod
+    def _empreinte(donnees: bytes) -> bytes:
+        return hashlib.blake2b(donnees, digest_size=16).digest()
+
+    # ─────────── interface Flask-Session ─────────────────────────────
+
+    def open_session(self, app, request):
+        """
+        Ouvre la session et lui associe l'empreinte du contenu lu (pour l'écriture conditionnelle).
+        """
+        self._local.empreinte = None
+        session = super().open_session(app, request)
+        session.empreinte = self._local.empreinte
+        return session
+
+    def _retrieve_session_data(self, store_id: str) -> dict | None:
+        chemin = self._chemin(store_id)
+        try:
+            if os.path.getmtime(chemin) + self._duree_vie() < time.time():
+                self._delete_session(store_id)
+                return None
+            with open(chemin, "rb") as f:
+                contenu = f.read()
+        except FileNotFoundError:
+            return None
+
+        donnees = zlib.decompress(contenu[1:]) if contenu[:1] == ZLIB else contenu[1:]
+        self._local.empreinte = self._empreinte(donnees)
+        self.lectures += 1
+        return self.serializer.decode(donnees)
+
+    def _delete_session(self, store_id: str) -> None:
+        try:
+            os.remove(self._chemin(store_id))
+        except FileNotFoundError:
+            pass
+
+    def _upsert_session(self, session_lifetime, session, store_id: str) -> None:
+        """
+        Écrit la session si son contenu a changé ; sinon prolonge seulement sa durée de vie.
+        """
+        donnees = self.serializer.encode(session)
+        empreinte = self._empreinte(donnees)
+        chemin = self._chemin(store_id)
+
+        if empreinte == getattr(session, "empreinte", None):
+            try:
+                os.utime(chemin)
+                self.ecritures_evitees += 1
+                return
+            except FileNotFoundError:
+                pass  # fichier purgé entre-temps : on le réécrit
+
+        compressee = len(donnees) > self.seuil_compression
+        contenu = ZLIB + zlib.compress(donnees, 1) if compressee else BRUT + donnees
+
+        os.makedirs(os.path.dirname(chemin), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(chemin), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(contenu)
+            os.replace(tmp, chemin)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        session.empreinte = empreinte
+        self._enregistrer_taille(len(donnees), len(contenu), compressee, session)
+
+    def _delete_expired_sessions(self) -> None:
+        limite = time.time() - self._duree_vie()
+        for racine, _, fichiers in os.walk(self.cache_dir):
+            for nom in fichiers:
+                chemin = os.path.join(racine, nom)
+                try:
+                    if os.path.getmtime(chemin) < limite:
+                        os.remove(chemin)
+                except FileNotFoundError:
+                    pass
+
+    # ─────────── métriques ───────────────────────────────────────────
+
+    def _enregistrer_taille(self, brute: int, stockee: int, compressee: bool, session) -> None:
+        with self._verrou:
+            self.ecritures += 1
+            self.compressees += int(compressee)
+            self._tailles.append((brute, stockee))
+        if stockee > self.taille_alerte:
+            self.app.logger.warning(
+                f"⚠️ Session volumineuse : {stockee / 1024:.0f} Ko stockés "
+                f"({brute / 1024:.0f} Ko bruts) pour {session.get('student_id', 'anonyme')}"
+            )
+
+    def stats(self) -> dict:
+        """
+        Métriques du worker : lectures, écritures (évitées / compressées) et tailles des dernières sessions écrites.
+        """
+        with self._verrou:
+            tailles = list(self._tailles)
+        stockees = sorted(t[1] for t in tailles)
+        brutes = sum(t[0] for t in tailles)
+        n = len(stockees)
+        return {
+            "name": "sessions",
+            "lectures": self.lectures,
+            "ecritures": self.ecritures,
+            "ecritures_evitees": self.ecritures_evitees,
+            "compressees": self.compressees,
+            "taille_moy_octets": round(sum(stockees) / n) if n else 0,
+            "taille_p95_octets": stockees[min(n - 1, int(0.95 * n))] if n else 0,
+            "taille_max_octets": stockees[-1] if n else 0,
+            "ratio_compression": round(sum(stockees) / brutes, 3) if brutes else 1.0,
+        }
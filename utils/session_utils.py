@@ -1,4 +1,4 @@
-from flask import session
+from flask import session, g
 from sqlalchemy import text
 import re
 
@@ -6,6 +6,18 @@ import os
 import shutil
 from flask import current_app
 
+import secrets
+from functools import lru_cache
+
+from utils.llm import count_message_tokens
+from utils.cache_utils import TTLCache
+from utils.conversation_store import (
+    charger_historique,
+    ajouter_messages,
+    retirer_message,
+    nouvelle_generation,
+)
+
 
 
 def clean_temp_folder():
@@ -48,6 +60,187 @@ def clean_prompt(prompt: str) -> str:
     return "\n".join(lines).strip()
 
 
+# ─────────── Historique de conversation ──────────────────────────────
+#
+# L'historique envoyé au LLM est stocké dans la table conversation_messages (cf. utils.conversation_store),
+# par élève et par scénario : un message = un INSERT, au lieu de réécrire toute la session à chaque requête.
+# Le worker garde en mémoire la génération courante (messages, tokens, ids) ; session["conv_version"]
+# change à chaque modification, ce qui permet de détecter qu'un autre worker a écrit entre-temps
+# (l'entrée du cache est alors rechargée depuis la base).
+# Le prompt du scénario n'est pas stocké : il est ajouté en tête à la lecture.
+#
+# Pendant un tour élève → IA (`tour_ouvrir` … `tour_ecrire`), les messages history et cconv sont mis
+# en attente dans `g` et écrits ensemble en un seul INSERT multi-lignes, une seule transaction.
+# Un tour non écrit à la fin de la requête (erreur) est abandonné par `tour_annuler`.
+
+conversation_cache = TTLCache(
+    maxsize=int(os.getenv("CONVERSATION_CACHE_SIZE", "500")),
+    ttl=int(os.getenv("CONVERSATION_CACHE_TTL", "1800")),
+    name="conversations"
+)
+
+
+@lru_cache(maxsize=64)
+def _tokens_prompt(prompt: str) -> int:
+    return count_message_tokens({"role": "system", "content": prompt})
+
+
+def _prompt_scenario(engine) -> dict:
+    scenario = scenario_actif(engine)
+    return {"role": "system", "content": scenario["content"] if scenario else ""}
+
+
+def _nouvelle_version(conv: dict):
+    conv["version"] = session["conv_version"] = secrets.token_hex(8)
+
+
+def _conversation(engine) -> dict:
+    """
+    Génération courante de l'historique de l'élève pour le scénario actif (cache du worker ou base).
+    """
+    cle = (session["student_id"], int(session["active_scenario_id"]))
+    conv = conversation_cache.get(cle)
+    if conv is not None and conv["version"] == session.get("conv_version"):
+        return conv
+
+    conv = charger_historique(engine, *cle)
+    conv["tokens"] = [n if n is not None else count_message_tokens(m)
+                      for m, n in zip(conv["messages"], conv["tokens"])]
+    conv["total"] = sum(conv["tokens"])
+    _nouvelle_version(conv)
+    conversation_cache.set(cle, conv)
+    return conv
+
+
+def historique(engine) -> list[dict]:
+    """
+    Historique complet envoyé au LLM : prompt du scénario + messages de la génération courante.
+    """
+    return [_prompt_scenario(engine), *_conversation(engine)["messages"]]
+
+
+def history_tokens(engine) -> list[int]:
+    """
+    Nombre de tokens de chaque message de historique(engine), dans le même ordre.
+    """
+    return [_tokens_prompt(_prompt_scenario(engine)["content"]), *_conversation(engine)["tokens"]]
+
+
+def history_reset(engine, messages: list[dict]):
+    """
+    Remplace l'historique par `messages` (prompt du scénario en tête, non stocké) :
+    les messages conservés sont écrits dans une nouvelle génération (résumé, fenêtre glissante).
+    """
+    conv = _conversation(engine)
+    messages = list(messages[1:])
+    tokens = [count_message_tokens(m) for m in messages]
+    generation = conv["generation"] + 1
+    ids = nouvelle_generation(engine, session["student_id"], session["active_scenario_id"],
+                              generation, messages, tokens)
+    conv.update(generation=generation, ids=ids, messages=messages, tokens=tokens, total=sum(tokens))
+    _nouvelle_version(conv)
+
+
+def _ecrire(engine, ligne: dict, conv: dict | None = None):
+    """
+    Écrit une ligne (flux history ou cconv), ou la met en attente si un tour est ouvert.
+    Pour le flux history, l'id de la ligne est ajouté à conv["ids"] (None tant qu'elle est en attente).
+    """
+    attente = g.get("tour_conversation")
+    if attente is not None:
+        attente.append((ligne, conv))
+        if conv is not None:
+            conv["ids"].append(None)
+        return
+    ids = ajouter_messages(engine, session["student_id"], session["active_scenario_id"], [ligne])
+    if conv is not None:
+        conv["ids"].append(ids[0])
+
+
+def tour_ouvrir():
+    """
+    Ouvre un tour : les écritures history / cconv qui suivent sont différées jusqu'à `tour_ecrire`.
+    """
+    g.tour_conversation = []
+
+
+def tour_ecrire(engine):
+    """
+    Écrit les messages en attente du tour (history et cconv) en un seul INSERT, puis ferme le tour.
+    """
+    attente = g.pop("tour_conversation", None)
+    if not attente:
+        return
+    ids = ajouter_messages(engine, session["student_id"], session["active_scenario_id"],
+                           [ligne for ligne, _ in attente])
+    for (ligne, conv), id_ in zip(attente, ids):
+        if conv is not None:
+            conv["ids"][conv["ids"].index(None)] = id_
+
+
+def tour_annuler():
+    """
+    Abandonne un tour resté ouvert (exception avant `tour_ecrire`) : rien n'est écrit et l'historique
+    du worker est oublié (relu depuis la base à la prochaine requête).
+    """
+    attente = g.pop("tour_conversation", None)
+    if attente and "student_id" in session and "active_scenario_id" in session:
+        cle = (session["student_id"], int(session["active_scenario_id"]))
+        conversation_cache.invalidate(lambda k: k == cle)
+
+
+def history_append(engine, message: dict):
+    """
+    Ajoute un message à l'historique (un INSERT, ou celui du tour ouvert) : seul ce message est encodé,
+    le total de tokens est mis à jour de façon incrémentale.
+    """
+    conv = _conversation(engine)
+    n = count_message_tokens(message)
+    _ecrire(engine, {"flux": "history", "generation": conv["generation"], "role": message["role"],
+                     "content": message["content"], "tokens": n}, conv)
+    conv["messages"].append(message)
+    conv["tokens"].append(n)
+    conv["total"] += n
+    _nouvelle_version(conv)
+
+
+def history_pop(engine) -> dict | None:
+    """
+    Retire le dernier message de l'historique (ex : message élève bloqué par la modération)
+    et met à jour le compte de tokens.
+    """
+    conv = _conversation(engine)
+    if not conv["messages"]:
+        return None
+    message_id = conv["ids"].pop()
+    if message_id is None:
+        # message du tour encore en attente : il n'est simplement pas écrit
+        attente = g.get("tour_conversation") or []
+        dernier = max(i for i, (_, c) in enumerate(attente) if c is conv)
+        del attente[dernier]
+    else:
+        retirer_message(engine, message_id)
+    conv["total"] -= conv["tokens"].pop()
+    _nouvelle_version(conv)
+    return conv["messages"].pop()
+
+
+def history_token_total(engine) -> int:
+    """
+    Renvoie le nombre de tokens de historique(engine) en O(1) (overhead final de 2 tokens compris).
+    """
+    return _tokens_prompt(_prompt_scenario(engine)["content"]) + _conversation(engine)["total"] + 2
+
+
+def cconv_append(engine, entry: dict):
+    """
+    Ajoute une entrée à la transcription affichée / exportée (intro, titre d'exercice, message, feedback).
+    Écrite avec les autres messages du tour si un tour est ouvert.
+    """
+    _ecrire(engine, {"flux": "cconv", "role": entry["role"], "subtype": entry.get("subtype"),
+                     "content": entry["content"]})
+
+
 def has_feedback(engine, student_id: str, scenario_id=None) -> bool:
     """
     Vérifie si l'élève a déjà reçu un feedback final pour le scénario actif.
@@ -67,27 +260,44 @@ def has_feedback(engine, student_id: str, scenario_id=None) -> bool:
     return bool(feedback)
 
 
+def etats_scenarios(engine, class_name: str, student_id: str, matiere: str | None = None) -> list[dict]:
+    """
+    Tous les scénarios de la classe (éventuellement d'une matière) avec, pour l'élève,
+    l'existence d'un feedback final — en une seule requête, quel que soit le nombre de fiches.
+
+    Lignes : id, name, matiere, resume, created_at, has_feedback ; les plus récentes en premier.
+    """
+    with engine.connect() as cn:
+        return cn.execute(text("""
+            SELECT sc.id, sc.name, sc.matiere, sc.resume, sc.created_at,
+                   EXISTS (
+                       SELECT 1 FROM feedbacks f
+                       WHERE f.scenario_id = sc.id AND f.student_id = :sid
+                   ) AS has_feedback
+            FROM scenarios sc
+            WHERE sc.class_name = :cls
+              AND (CAST(:mat AS TEXT) IS NULL OR sc.matiere = :mat)
+            ORDER BY sc.created_at DESC
+        """), {"cls": class_name, "sid": student_id, "mat": matiere or None}).mappings().all()
+
+
 def latest_scenarios_without_feedback_matiere(engine, class_name: str, student_id: str) -> list[dict]:
     """
     Récupère la dernière fiche chargée de chaque matière si elle n'est pas encore terminée (pas de feedback).
     """
-    with engine.connect() as cn:
-        rows = cn.execute(text("""
-            SELECT DISTINCT ON (LOWER(matiere)) id, name, matiere
-            FROM scenarios
-            WHERE class_name = :cls AND matiere IS NOT NULL
-            ORDER BY LOWER(matiere), id DESC
-        """), {"cls": class_name}).mappings().all()
+    derniers = {}
+    for row in etats_scenarios(engine, class_name, student_id):
+        if row["matiere"] is None:
+            continue
+        cle = row["matiere"].lower()
+        if cle not in derniers or row["id"] > derniers[cle]["id"]:
+            derniers[cle] = row
 
-    results = []
-    for row in rows:
-        if not has_feedback(engine, student_id, row["id"]):
-            results.append({
-                "id": row["id"],
-                "name": row["name"],
-                "matiere": row["matiere"]
-            })
-    return results
+    return [
+        {"id": row["id"], "name": row["name"], "matiere": row["matiere"]}
+        for _, row in sorted(derniers.items())
+        if not row["has_feedback"]
+    ]
 
 
 
@@ -129,6 +339,14 @@ def load_json_from_db(engine, class_name: str, scenario_id: str = None):
                 ORDER BY e.ordinal
             """), {"cls": class_name}).mappings().all()
 
+    return formater_exercices(rows)
+
+
+def formater_exercices(rows) -> tuple[dict, dict, dict]:
+    """
+    Construit (map_json, ans_json, cat_json) à partir des lignes exercices (ordinal, prompt, answer, category).
+    """
+    map_json, ans_json, cat_json = {}, {}, {}
     for row in rows:
         ref = f"exo_{row['ordinal']}"
         map_json[ref] = f"🧩 EXERCICE {row['ordinal']} [niveau {extract_niveau(row['prompt'])}]\n\n{clean_prompt(row['prompt'])}"
@@ -138,6 +356,91 @@ def load_json_from_db(engine, class_name: str, scenario_id: str = None):
     return map_json, ans_json, cat_json
 
 
+# ─────────── Cache des scénarios ─────────────────────────────────────
+#
+# Le contenu d'un scénario (prompt, énoncés, réponses, catégories, exercise_id par ordinal)
+# est partagé par tous les élèves du worker : la session ne porte plus que active_scenario_id.
+# Un scenario_id ne change jamais de contenu (un ré-import crée un nouveau scénario) :
+# l'invalidation sert surtout à libérer la mémoire, le TTL borne la durée de vie côté autres workers.
+
+scenario_cache = TTLCache(
+    maxsize=int(os.getenv("SCENARIO_CACHE_SIZE", "200")),
+    ttl=int(os.getenv("SCENARIO_CACHE_TTL", "3600")),
+    name="scenarios"
+)
+
+
+def get_scenario(engine, scenario_id) -> dict | None:
+    """
+    Renvoie le scénario depuis le cache du worker (chargé depuis la base au premier accès).
+
+    Retour (à ne pas modifier, partagé entre les requêtes) :
+        {"id", "name", "matiere", "class_name", "content",
+         "MAP_JSON": énoncés, "ANS_JSON": réponses, "CAT_JSON": catégories,
+         "exercise_ids": {ordinal: exercise_id}}
+    ou None si le scénario n'existe pas.
+    """
+    if scenario_id is None:
+        return None
+    scenario = scenario_cache.get(int(scenario_id))
+    if scenario is not None:
+        return scenario
+
+    with engine.connect() as cn:
+        row = cn.execute(text("""
+            SELECT id, name, matiere, class_name, content
+            FROM scenarios
+            WHERE id = :scid
+        """), {"scid": scenario_id}).mappings().first()
+        if not row:
+            return None
+
+        rows = cn.execute(text("""
+            SELECT e.exercise_id, e.ordinal, e.prompt, e.answer, c.name AS category
+            FROM exercises e
+            JOIN exercise_sets s ON s.set_id = e.set_id
+            LEFT JOIN categories c ON c.category_id = e.category_id
+            WHERE s.scenario_id = :scid
+            ORDER BY e.ordinal
+        """), {"scid": scenario_id}).mappings().all()
+
+    return mettre_en_cache_scenario(row, rows)
+
+
+def mettre_en_cache_scenario(row, rows) -> dict:
+    """
+    Construit l'entrée du cache à partir de la ligne scénario (id, name, matiere, class_name, content)
+    et de ses exercices (exercise_id, ordinal, prompt, answer, category), puis l'enregistre.
+    """
+    map_json, ans_json, cat_json = formater_exercices(rows)
+    scenario = {
+        **row,
+        "MAP_JSON": map_json,
+        "ANS_JSON": ans_json,
+        "CAT_JSON": cat_json,
+        "exercise_ids": {r["ordinal"]: r["exercise_id"] for r in rows},
+    }
+    scenario_cache.set(int(row["id"]), scenario)
+    return scenario
+
+
+def scenario_actif(engine) -> dict | None:
+    """
+    Scénario actif de l'élève connecté (session["active_scenario_id"]), via le cache.
+    """
+    return get_scenario(engine, session.get("active_scenario_id"))
+
+
+def invalider_cache_scenarios(scenario_ids=None) -> int:
+    """
+    Retire des scénarios du cache (tous si scenario_ids est None) après import, activation ou suppression.
+    """
+    if scenario_ids is None:
+        return scenario_cache.invalidate()
+    ids = {int(sid) for sid in scenario_ids}
+    return scenario_cache.invalidate(lambda key: key in ids)
+
+
 def load_done_refs(engine, student_id: str, scenario_id=None) -> list[str]:
     """
     Charge la liste des références d'exercices déjà validés (refs) pour un élève et un scénario donné.
@@ -152,10 +455,31 @@ def load_done_refs(engine, student_id: str, scenario_id=None) -> list[str]:
             FROM done_refs
             WHERE student_id = :sid
               AND scenario_id = :scid
-            LIMIT 1
         """), {"sid": student_id, "scid": scenario_id}).mappings().first()
 
     return row["refs"] if row else []
+
+
+def ajouter_done_ref(engine, student_id: str, scenario_id, ref: str) -> list[str]:
+    """
+    Ajoute un exercice validé à done_refs en une seule instruction exécutée par le serveur
+    (INSERT … ON CONFLICT DO UPDATE) : pas de lecture préalable, pas de mise à jour perdue
+    si l'élève a deux onglets ouverts, et pas de doublon si la ref y est déjà.
+
+    Retourne la liste des refs validées à jour (y compris celles écrites par un autre onglet).
+
+    Cible de ON CONFLICT : index unique (student_id, scenario_id) créé par la migration
+    migrations/0003_done_refs_unique.sql (qui fusionne les doublons existants).
+    """
+    with engine.begin() as cn:
+        return cn.scalar(text("""
+            INSERT INTO done_refs (student_id, scenario_id, refs)
+            VALUES (:sid, :scid, jsonb_build_array(CAST(:ref AS TEXT)))
+            ON CONFLICT (student_id, scenario_id) DO UPDATE
+            SET refs = CASE WHEN done_refs.refs @> EXCLUDED.refs THEN done_refs.refs
+                            ELSE done_refs.refs || EXCLUDED.refs END
+            RETURNING refs
+        """), {"sid": student_id, "scid": scenario_id, "ref": ref})
     
     
 def get_last_hash(engine, student_id: str) -> str:
@@ -203,59 +527,104 @@ def get_active_scenario_id_for_class(engine, class_name):
 
 
 
-def init_session_context(engine,student_id: str):
+def bootstrap_eleve(engine, student_id: str) -> dict | None:
+    """
+    Charge en un seul aller-retour tout ce dont la connexion a besoin :
+    - l'élève (date de consentement RGPD, last_this_hash)
+    - le scénario actif de sa classe (ou à défaut le dernier chargé) et ses exercices
+    - ses exercices validés (done_refs) et l'existence d'un feedback final pour ce scénario
+
+    Retourne None si l'élève n'existe pas ; scenario_id vaut None si la classe n'a aucun scénario.
+    """
+    with engine.connect() as cn:
+        row = cn.execute(text("""
+            SELECT st.rgpd_consent_date,
+                   st.last_this_hash,
+                   sc.id AS scenario_id, sc.name, sc.matiere, sc.class_name, sc.content,
+                   ex.exercices,
+                   dr.refs,
+                   EXISTS (
+                       SELECT 1 FROM feedbacks f
+                       WHERE f.student_id = st.student_id AND f.scenario_id = sc.id
+                   ) AS has_feedback
+            FROM students st
+            LEFT JOIN LATERAL (
+                SELECT id, name, matiere, class_name, content
+                FROM scenarios
+                WHERE class_name = :cls
+                ORDER BY is_active IS TRUE DESC, id DESC
+                LIMIT 1
+            ) sc ON true
+            LEFT JOIN LATERAL (
+                SELECT json_agg(json_build_object(
+                           'exercise_id', e.exercise_id, 'ordinal', e.ordinal, 'prompt', e.prompt,
+                           'answer', e.answer, 'category', c.name
+                       ) ORDER BY e.ordinal) AS exercices
+                FROM exercises e
+                JOIN exercise_sets s ON s.set_id = e.set_id
+                LEFT JOIN categories c ON c.category_id = e.category_id
+                WHERE s.scenario_id = sc.id
+            ) ex ON true
+            LEFT JOIN LATERAL (
+                SELECT refs FROM done_refs d
+                WHERE d.student_id = st.student_id AND d.scenario_id = sc.id
+                LIMIT 1
+            ) dr ON true
+            WHERE st.student_id = :sid
+        """), {"sid": student_id, "cls": student_id.split("-")[0]}).mappings().first()
+
+    return dict(row) if row else None
+
+
+def init_session_context(engine,student_id: str, eleve: dict | None = None):
     """
     Initialise toutes les variables de session nécessaires pour l'élève :
-    - MAP_JSON : énoncés
-    - ANS_JSON : réponses attendues
-    - CAT_JSON : catégories
+    - active_scenario_id : scénario actif (énoncés, réponses et catégories restent dans le cache des scénarios)
     - exo_valide : exos déjà réussis
     - has_feedback : feedback final existant ou non
-    - last_this_hash : dernier hash enregistré pour assurer le chaînage WORM
+    - last_this_hash : hash initial du chaînage WORM (premier log de l'élève, cf. utils/log_writer.py)
+
+    `eleve` : résultat de bootstrap_eleve s'il a déjà été chargé (sinon il est chargé ici).
     """
     class_name = student_id.split("-")[0]
     session["class_name"] = class_name
     
-    # Récupérer le scénario actif de la classe
-    scenario_id = get_active_scenario_id_for_class(engine, class_name)
+    # Élève, scénario actif, exercices, done_refs, feedback et dernier hash : un seul aller-retour
+    if eleve is None:
+        eleve = bootstrap_eleve(engine, student_id) or {}
+    scenario_id = eleve.get("scenario_id")
 
     if scenario_id is None:
         flash("❌ Erreur : Aucun scénario disponible pour cette classe.", "error")
         return redirect(url_for("login"))  # ou raise une Exception RGPD ?
     
     session["active_scenario_id"] = scenario_id
-    session["cconv"] = []
 
-    # ─── récupérer la matière du scénario actif ───────────────────────
-    with engine.connect() as cn:
-        matiere = cn.scalar(text(
-            "SELECT matiere FROM scenarios WHERE id = :sid"
-        ), {"sid": scenario_id})
+    # ─── scénario actif (matière, exercices) : cache partagé, alimenté par le bootstrap si besoin ──
+    scenario = scenario_cache.get(int(scenario_id))
+    if scenario is None:
+        scenario = mettre_en_cache_scenario(
+            {"id": scenario_id, **{k: eleve[k] for k in ("name", "matiere", "class_name", "content")}},
+            eleve["exercices"] or []
+        )
+    matiere = scenario["matiere"] if scenario else None
 
     session["active_matiere"] = (
         matiere if matiere in ("MATHS", "SVT", "NSI") else ""
     )
-        
-    # Charger tous les exercices du scénario actif
-    map_json, ans_json, cat_json = load_json_from_db(engine, class_name, scenario_id)
-    
 
-    
-    # ─── charger les exercices du scénario ─────────────────────────────
-    if not map_json:
+    # ─── vérifier les exercices du scénario ────────────────────────────
+    if not scenario or not scenario["MAP_JSON"]:
         flash("❌ Erreur : Aucun exercice trouvé dans ce scénario.", "error")
         return redirect(url_for("login"))
 
-    done_refs = load_done_refs(engine,student_id,scenario_id)
-    feedback_exists = has_feedback(engine,student_id,scenario_id)
-    last_hash = get_last_hash(engine, student_id)
+    done_refs = eleve["refs"] or []
+    feedback_exists = eleve["has_feedback"]
+    last_hash = eleve["last_this_hash"] or "0" * 64
     
     
     # ─── stocker en session ────────────────────────────────────────────
     session.update(
-        MAP_JSON = map_json,
-        ANS_JSON = ans_json,
-        CAT_JSON = cat_json,
         active_scenario_id = scenario_id,   # ← ajouté
         last_this_hash = last_hash,
         exo_valide = done_refs,
@@ -0,0 +1,113 @@
+"""
+telemetry_utils.py — Télémétrie d'usage des appels LLM et de modération (table llm_usage).
+
+Chaque appel signalé par `utils.llm.signaler_usage` (modèle, tokens, latence, hit de cache,
+classe, scénario, exercice) est mis en file d'écriture différée (utils/write_buffer.py, comme le
+journal WORM et les tentatives) : un seul INSERT multi-lignes par lot, mêmes reprises et même
+vidage à l'arrêt du processus.
+
+- la table est créée par la migration migrations/0001_llm_usage.sql (cf. utils/migrations.py)
+- si la file est pleine (base indisponible…), les lignes sont abandonnées et comptées
+  (tampon_usage.perdues)
+- aucune donnée élève n'est enregistrée (ni identifiant ni contenu), seulement le contexte classe / scénario
+
+Variables d'environnement :
+    TELEMETRIE_LLM (0/1)           — active l'enregistrement (défaut : 1)
+    TELEMETRIE_TAILLE_LOT (int)    — nombre maximal de lignes par INSERT (défaut : 200)
+    TELEMETRIE_INTERVALLE (float)  — délai maximal avant écriture d'un lot, en secondes (défaut : 2)
+"""
+
+import os
+
+from sqlalchemy import text
+
+from utils.write_buffer import EcritureDifferee
+
+
+TELEMETRIE_LLM = os.getenv("TELEMETRIE_LLM", "1") == "1"
+TAILLE_LOT = int(os.getenv("TELEMETRIE_TAILLE_LOT", "200"))
+INTERVALLE = float(os.getenv("TELEMETRIE_INTERVALLE", "2"))
+
+COLONNES = ("type_appel", "model", "prompt_tokens", "completion_tokens", "latency_ms",
+            "cache_hit", "erreur", "class_name", "scenario_id", "ordinal")
+TAILLE_MAX_FILE = 10000
+
+_engine = None
+
+
+def demarrer_telemetrie(engine):
+    """
+    Associe le moteur SQLAlchemy utilisé pour l'écriture (le thread d'écriture démarre à la première ligne).
+    """
+    global _engine
+    _engine = engine
+
+
+def enregistrer_usage(ligne: dict):
+    """
+    Observateur d'usage (cf. `utils.llm.ajouter_observateur_usage`) : met la ligne en file, sans attendre.
+    """
+    if not TELEMETRIE_LLM or _engine is None:
+        return
+    tampon_usage.ajouter({c: ligne.get(c) for c in COLONNES})
+
+
+def ecrire_lot(engine, lot: list[dict]):
+    """
+    Insère un lot de lignes dans llm_usage en une seule requête.
+    """
+    with engine.begin() as cn:
+        cn.execute(text(f"""
+            INSERT INTO llm_usage ({", ".join(COLONNES)})
+            VALUES ({", ".join(":" + c for c in COLONNES)})
+        """), lot)
+
+
+def rapport_usage(engine, class_name: str | None = None, scenario_id: int | None = None) -> list[dict]:
+    """
+    Agrégats d'usage LLM :
+    - toutes classes confondues si aucune classe n'est sélectionnée : une ligne par classe,
+      puis une ligne de total (total = true, class_name = "Toutes les classes")
+    - par scénario pour une classe
+    - par exercice et type d'appel pour un scénario donné
+
+    Chaque ligne : appels, taux de hit de cache (%), erreurs, latence moyenne et p95 (ms),
+    tokens prompt / completion cumulés.
+    """
+    if scenario_id is not None:
+        colonnes = groupe = ordre = "ordinal, type_appel"
+        filtre = "scenario_id = :scid"
+    elif class_name is not None:
+        colonnes = groupe = ordre = "class_name, scenario_id"
+        filtre = "class_name = :cls"
+    else:
+        colonnes = """CASE WHEN GROUPING(class_name) = 1 THEN 'Toutes les classes'
+                           ELSE COALESCE(class_name, '(sans classe)') END AS class_name,
+                      GROUPING(class_name) = 1 AS total"""
+        groupe = "GROUPING SETS ((class_name), ())"
+        ordre = "GROUPING(class_name), class_name"
+        filtre = "true"
+
+    with engine.connect() as cn:
+        if not cn.scalar(text("SELECT to_regclass('llm_usage') IS NOT NULL")):
+            return []
+        return cn.execute(text(f"""
+            SELECT
+              {colonnes},
+              COUNT(*) AS appels,
+              ROUND(100.0 * AVG(CASE WHEN cache_hit THEN 1 ELSE 0 END), 1) AS taux_cache,
+              SUM(CASE WHEN erreur THEN 1 ELSE 0 END) AS erreurs,
+              ROUND(AVG(latency_ms) FILTER (WHERE NOT cache_hit)) AS latence_moy_ms,
+              PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY latency_ms)
+                FILTER (WHERE NOT cache_hit) AS latence_p95_ms,
+              COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+              COALESCE(SUM(completion_tokens), 0) AS completion_tokens
+            FROM llm_usage
+            WHERE {filtre}
+            GROUP BY {groupe}
+            ORDER BY {ordre}
+        """), {"cls": class_name, "scid": scenario_id}).mappings().all()
+
+
+tampon_usage = EcritureDifferee(lambda lot: ecrire_lot(_engine, lot), "telemetrie-llm",
+                                TAILLE_LOT, INTERVALLE, taille_max=TAILLE_MAX_FILE)
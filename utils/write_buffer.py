@@ -0,0 +1,196 @@
+"""
+write_buffer.py — Tampon d'écriture différée : les lignes sont mises en file et écrites par lots
+par un thread démon (une seule requête / un seul commit par lot).
+
+Utilisé par le journal WORM (utils/log_writer.py) et la télémétrie LLM (utils/telemetry_utils.py).
+
+- un lot part dès `taille_lot` lignes ou `intervalle` secondes après sa première ligne
+- l'ordre de la file est conservé (un seul thread d'écriture)
+- erreur transitoire (base indisponible, connexion coupée, interblocage) : le lot est réessayé
+  avec un délai croissant
+- autre erreur (contrainte, donnée invalide, droits, objet manquant) : le lot est coupé en deux
+  jusqu'à isoler les lignes fautives ; les autres lignes sont écrites et la file continue.
+  Une ligne fautive est signalée dans les logs (sans son contenu) et remise à `rejeter(ligne, erreur)`
+  si le tampon en a une (journal WORM : table chat_logs_rejets, couverte par la suppression et la
+  purge RGPD) ; sinon elle est abandonnée. Rien n'est jamais écrit sur disque.
+- `taille_max` (facultatif) borne la file : au-delà, les nouvelles lignes sont abandonnées et
+  comptées (données non essentielles, ex. télémétrie)
+- `vider()` attend l'écriture de tout ce qui a été mis en file avant l'appel
+  (lecture qui doit voir les dernières lignes, arrêt du processus via atexit)
+
+⚠️ La file est en mémoire : les lignes pas encore écrites sont perdues si le processus s'arrête
+brutalement (crash, SIGKILL, OOM) ; atexit ne couvre que les arrêts normaux.
+"""
+
+import time
+import queue
+import atexit
+import logging
+import threading
+
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+
+
+logger = logging.getLogger(__name__)
+
+
+def erreur_transitoire(e: Exception) -> bool:
+    """
+    True si l'écriture peut réussir plus tard sans changer le lot :
+    base injoignable, connexion coupée, interblocage / sérialisation (OperationalError).
+    """
+    if isinstance(e, (OperationalError, InterfaceError)):
+        return True
+    return isinstance(e, DBAPIError) and e.connection_invalidated
+
+
+def resume_erreur(e: Exception) -> str:
+    """
+    Résumé d'une erreur pour les logs, sans la requête ni ses paramètres (contenu des lignes).
+    """
+    return f"{e.__class__.__name__}: {getattr(e, 'orig', None) or e}".splitlines()[0]
+
+
+class EcritureDifferee:
+    """
+    File d'écriture par lots : `ecrire(lot)` est appelée par le thread démon avec une liste de lignes.
+    """
+
+    def __init__(self, ecrire, nom: str, taille_lot: int = 100, intervalle: float = 0.005,
+                 taille_max: int | None = None, rejeter=None):
+        self.ecrire = ecrire
+        self.nom = nom
+        self.taille_lot = taille_lot
+        self.intervalle = intervalle
+        self.taille_max = taille_max
+        self.rejeter = rejeter
+        self._file = queue.Queue()
+        self._thread = None
+        self._verrou = threading.Lock()
+        self.lots = 0
+        self.lignes = 0
+        self.rejetees = 0
+        self.perdues = 0
+        atexit.register(self.vider)
+
+    def ajouter(self, ligne) -> bool:
+        """
+        Met une ligne en file (le thread d'écriture démarre au premier appel, après le fork des workers).
+        Retourne False si la ligne est abandonnée (file pleine, cf. taille_max).
+        """
+        if self._thread is None:
+            with self._verrou:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._boucle, name=self.nom, daemon=True)
+                    self._thread.start()
+        if self.taille_max is not None and self._file.qsize() >= self.taille_max:
+            self.perdues += 1
+            return False
+        self._file.put(ligne)
+        return True
+
+    def vider(self, timeout: float = 10.0) -> bool:
+        """
+        Attend l'écriture de toutes les lignes mises en file avant l'appel.
+        Retourne False si le délai est dépassé.
+        """
+        if self._thread is None:
+            return True
+        fait = threading.Event()
+        self._file.put(fait)
+        if not fait.wait(timeout):
+            logger.error(f"❌ {self.nom} : environ {self._file.qsize()} lignes encore en attente d'écriture")
+            return False
+        return True
+
+    def _boucle(self):
+        """
+        Attend une première ligne, complète le lot pendant au plus `intervalle` secondes, puis l'écrit.
+        Un marqueur de vidage (Event) termine le lot en cours et est signalé une fois le lot écrit.
+        """
+        while True:
+            lot, marqueurs = [], []
+            element = self._file.get()
+            echeance = time.monotonic() + self.intervalle
+            while True:
+                if isinstance(element, threading.Event):
+                    marqueurs.append(element)
+                    break
+                lot.append(element)
+                reste = echeance - time.monotonic()
+                if len(lot) >= self.taille_lot or reste <= 0:
+                    break
+                try:
+                    element = self._file.get(timeout=reste)
+                except queue.Empty:
+                    break
+
+            if lot:
+                self._ecrire_ou_isoler(lot)
+            for marqueur in marqueurs:
+                marqueur.set()
+
+    def _ecrire_ou_isoler(self, lot: list):
+        """
+        Écrit le lot ; sur une erreur non transitoire, le coupe en deux (ordre conservé)
+        jusqu'à isoler les lignes qui ne peuvent pas être écrites, puis les rejette.
+        """
+        try:
+            self._ecrire_avec_reprise(lot)
+        except Exception as e:
+            if len(lot) == 1:
+                self._rejeter(lot[0], e)
+                return
+            milieu = len(lot) // 2
+            self._ecrire_ou_isoler(lot[:milieu])
+            self._ecrire_ou_isoler(lot[milieu:])
+
+    def _ecrire_avec_reprise(self, lot: list):
+        """
+        Écrit le lot ; sur une erreur transitoire, réessaie avec un délai croissant.
+        Les autres erreurs sont propagées (le lot ne réussira pas en l'état).
+        """
+        self._avec_reprise(lambda: self.ecrire(lot), f"écriture de {len(lot)} lignes")
+        self.lots += 1
+        self.lignes += len(lot)
+
+    def _avec_reprise(self, action, description: str):
+        """
+        Exécute `action()` ; réessaie indéfiniment, avec un délai croissant, tant que l'erreur est transitoire.
+        """
+        delai = 0.5
+        while True:
+            try:
+                return action()
+            except Exception as e:
+                if not erreur_transitoire(e):
+                    raise
+                logger.error(f"❌ {self.nom} : {description} échouée ({resume_erreur(e)}), "
+                             f"nouvel essai dans {delai:.1f} s")
+                time.sleep(delai)
+                delai = min(delai * 2, 30)
+
+    def _rejeter(self, ligne, erreur: Exception):
+        """
+        Ligne impossible à écrire : signalée dans les logs (sans son contenu), puis remise à `rejeter`.
+        """
+        self.rejetees += 1
+        if self.rejeter is None:
+            logger.error(f"❌ {self.nom} : ligne abandonnée ({resume_erreur(erreur)})")
+            return
+        logger.critical(f"🚨 {self.nom} : ligne refusée par la base ({resume_erreur(erreur)}), mise à l'écart")
+        try:
+            self._avec_reprise(lambda: self.rejeter(ligne, erreur), "mise à l'écart d'une ligne refusée")
+        except Exception as e:
+            logger.critical(f"🚨 {self.nom} : ligne refusée PERDUE, mise à l'écart impossible ({resume_erreur(e)})")
+
+    def stats(self) -> dict:
+        return {
+            "name": self.nom,
+            "en_attente": self._file.qsize(),
+            "lots": self.lots,
+            "lignes": self.lignes,
+            "rejetees": self.rejetees,
+            "perdues": self.perdues,
+            "lignes_par_lot": round(self.lignes / self.lots, 1) if self.lots else 0,
+        }